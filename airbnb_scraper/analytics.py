@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Occupancy, revenue and price reports over stored listing months.
+
+Reports are computed by the database with an aggregation pipeline.
+Listings matching a query are joined with their months in a date range
+through the `(listing_id, start_date)` month index, and grouped by
+listing fields such as `localized_neighborhood` and `room_type_category`.
+The join needs MongoDB 5.0 or later. The pipeline only computes sums
+and lists, which `AirbnbMemoryDB` also supports, and rates and price
+percentiles are derived from them afterwards.
+
+Results are cached as `AirbnbSummary` items in the `summaries`
+collection, and recomputed when they are stale.
+
+Usage:
+
+    rows = occupancy_report(city='Lisbon', start='2020-01', end='2021-01')
+
+or `scrapy report -c Lisbon --start 2020-01 --end 2021-01`.
+"""
+
+import math
+import arrow
+from airbnb_scraper.items import AirbnbListing, AirbnbListingCalendarMonth, AirbnbSummary, ID_KEY
+
+DEFAULT_GROUP_KEYS = ['localized_neighborhood', 'room_type_category']
+# Month keys read by reports
+MONTH_KEYS = [
+    'start_date',
+    'total_days',
+    'booked_days',
+    'blocked_days',
+    'partial_revenue',
+    'future_revenue',
+    'average_price',
+]
+PRICE_PERCENTILES = [25, 50, 75]
+
+
+def parse_month(value):
+    """Returns the first day of the month of a date, as a naive datetime."""
+    if not bool(value):
+        return None
+    return arrow.get(value).floor('month').naive
+
+
+def occupancy_pipeline(group_by=DEFAULT_GROUP_KEYS, listing_query=None, start=None, end=None):
+    """
+    Returns the aggregation pipeline of `occupancy_report()`,
+    which runs on the listings collection.
+    """
+    month_query = {}
+    if start is not None:
+        month_query.setdefault('start_date', {})['$gte'] = start
+    if end is not None:
+        month_query.setdefault('start_date', {})['$lt'] = end
+
+    return [
+        {'$match': listing_query or {}},
+        {'$project': {key: 1 for key in group_by}},
+        {'$lookup': {
+            'from': AirbnbListingCalendarMonth._collection_name,
+            'localField': ID_KEY,
+            'foreignField': 'listing_id',
+            'pipeline': [
+                {'$match': month_query},
+                {'$project': {key: 1 for key in MONTH_KEYS}},
+            ],
+            'as': 'months',
+        }},
+        {'$unwind': '$months'},
+        {'$group': {
+            ID_KEY: {key: f'${key}' for key in group_by},
+            'listing_ids': {'$addToSet': f'${ID_KEY}'},
+            'months': {'$sum': 1},
+            'total_days': {'$sum': '$months.total_days'},
+            'booked_days': {'$sum': '$months.booked_days'},
+            'blocked_days': {'$sum': '$months.blocked_days'},
+            'revenue': {'$sum': '$months.partial_revenue'},
+            'future_revenue': {'$sum': '$months.future_revenue'},
+            'prices': {'$push': '$months.average_price'},
+        }},
+    ]
+
+
+def percentile(values, p):
+    """Returns the nearest-rank percentile of sorted values."""
+    if not bool(values):
+        return None
+    rank = math.ceil(p / 100.0 * len(values))
+    return values[min(len(values), max(1, rank)) - 1]
+
+
+def summarize_group(group, group_by):
+    """Returns a report row for a group of the pipeline."""
+    row = {key: group[ID_KEY].get(key) for key in group_by}
+    available_days = group['total_days'] - group['blocked_days']
+    prices = sorted(x for x in group['prices'] if x is not None)
+
+    row['listings'] = len(group['listing_ids'])
+    row['months'] = group['months']
+    row['total_days'] = group['total_days']
+    row['booked_days'] = group['booked_days']
+    row['occupancy'] = round(group['booked_days'] / available_days, 4) if available_days > 0 else None
+    row['revenue'] = group['revenue']
+    row['future_revenue'] = group['future_revenue']
+    row['revenue_per_listing'] = group['revenue'] / row['listings'] if row['listings'] > 0 else None
+    row['average_price'] = round(sum(prices) / len(prices), 2) if bool(prices) else None
+    for p in PRICE_PERCENTILES:
+        row[f'price_p{p}'] = percentile(prices, p)
+    return row
+
+
+def occupancy_report(group_by=DEFAULT_GROUP_KEYS, city=None, start=None, end=None, listing_query=None,
+                     refresh=False):
+    """
+    Computes occupancy, revenue and price distribution per
+    group of listing fields, over the months starting in
+    `[start, end)`.
+
+    Occupancy is the share of booked days among the days
+    which are not blocked. Months saved before day counts
+    were stored need `scrapy recompute_months`.
+
+    Args:
+        city: Only include listings with this `localized_city`.
+        listing_query: Additional query on listings.
+        refresh: Recompute even if a cached result is fresh.
+
+    Returns:
+        A list of row dictionaries, sorted by group.
+    """
+    group_by = list(group_by)
+    start = parse_month(start)
+    end = parse_month(end)
+    listing_query = dict(listing_query or {})
+    if bool(city):
+        listing_query['localized_city'] = city
+
+    parameters = {
+        'group_by': group_by,
+        'listing_query': listing_query,
+        'start': start,
+        'end': end,
+    }
+    summary_id = AirbnbSummary.create_id(report='occupancy', parameters=parameters)
+    summary = AirbnbSummary.load(summary_id)
+    if summary is not None and not refresh and not summary.is_stale:
+        return summary['rows']
+
+    pipeline = occupancy_pipeline(group_by=group_by, listing_query=listing_query, start=start, end=end)
+    groups = AirbnbListing.get_storage().aggregate(AirbnbListing._collection_name, pipeline)
+    rows = [summarize_group(group, group_by) for group in groups]
+    rows.sort(key=lambda row: tuple((row[key] is not None, row[key]) for key in group_by))
+
+    if summary is None:
+        summary = AirbnbSummary.create(report='occupancy', parameters=parameters)
+        summary.update_id()
+    summary['update_date'] = arrow.get()
+    summary['rows'] = rows
+    summary.save()
+    return rows
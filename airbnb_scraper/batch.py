@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized booking inference and month aggregation.
+
+`DayBatch` holds the days of many months as NumPy arrays and
+computes the same values as `AirbnbCalendarDayMixin.update_inferred()`
+and `AirbnbListingCalendarMonth.update_with_days()`, for recomputing
+metrics over stored history. Dates are compared as integer
+microseconds since the epoch.
+
+Requires NumPy, which is not needed for crawling.
+"""
+
+import arrow
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from airbnb_scraper.items import to_date_value, past_threshold
+
+# Integer date value of a missing date
+MISSING = np.iinfo(np.int64).min
+MICROS_PER_SECOND = 1000000
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(x):
+    """Converts a date value to microseconds since the epoch, or `MISSING`."""
+    if not bool(x):
+        return MISSING
+    if isinstance(x, arrow.Arrow):
+        x = x.datetime
+    if x.tzinfo is not None:
+        x = x.astimezone(timezone.utc).replace(tzinfo=None)
+    return (x - _EPOCH) // _MICROSECOND
+
+
+class DayBatch:
+    """
+    Days of many months as parallel arrays. The days of
+    each month are contiguous and in the order which would
+    be passed to `update_with_days()`.
+
+    Days can be day items, day records, embedded days or
+    raw day documents.
+    """
+
+    # Date keys stored as integer arrays
+    date_keys = [
+        'update_date',
+        'last_available_seen_date',
+        'first_unavailable_seen_date',
+        'booking_date',
+        'cancellation_date',
+    ]
+
+    def __init__(self, months):
+        """
+        Args:
+            months: A list of `(time_zone, days)` pairs.
+        """
+        self.month_count = len(months)
+        self.days = []
+        group = []
+        dates = {key: [] for key in self.date_keys}
+        available = []
+        blocked = []
+        prices = []
+        cancellations = []
+        thresholds = []
+        threshold_cache = {}
+
+        for i, (time_zone, days) in enumerate(months):
+            for day in days:
+                self.days.append(day)
+                group.append(i)
+                for key in self.date_keys:
+                    dates[key].append(to_micros(day.get(key)))
+                available.append(bool(day.get('available')))
+                blocked_value = day.get('blocked')
+                blocked.append(-1 if blocked_value is None else int(bool(blocked_value)))
+                price = day.get('price', 0.0)
+                prices.append(float(price) if bool(price) else np.nan)
+                cancellations.append(day.get('cancellations'))
+
+                cache_key = (to_date_value(day.get('date')).naive, day.get('time_zone') or time_zone)
+                threshold = threshold_cache.get(cache_key)
+                if threshold is None:
+                    # Same as `AirbnbCalendarDayMixin.is_past`
+                    threshold = to_micros(past_threshold(*cache_key))
+                    threshold_cache[cache_key] = threshold
+                thresholds.append(threshold)
+
+        self.group = np.array(group, dtype=np.int64)
+        for key in self.date_keys:
+            setattr(self, key, np.array(dates[key], dtype=np.int64))
+        self.available = np.array(available, dtype=bool)
+        # 1 if blocked, 0 if not and -1 if unknown
+        self.blocked = np.array(blocked, dtype=np.int8)
+        self.price = np.array(prices, dtype=np.float64)
+        self.cancellations = np.array([x or 0 for x in cancellations], dtype=np.int64)
+        self.past_threshold = np.array(thresholds, dtype=np.int64)
+        assert not bool(np.any(self.update_date == MISSING)), 'Day is missing an update date'
+        self._original = self.copy_arrays()
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_months(cls, months_and_days):
+        """Returns a batch for a list of `(month, days)` pairs."""
+        return cls([(month.get('time_zone'), days) for month, days in months_and_days])
+
+    def copy_arrays(self):
+        return {
+            key: getattr(self, key).copy()
+            for key in self.date_keys + ['blocked', 'cancellations']
+        }
+
+    @property
+    def is_past(self):
+        return self.update_date > self.past_threshold
+
+    @property
+    def is_blocked(self):
+        return self.blocked == 1
+
+    @property
+    def is_booked(self):
+        has_booking = self.booking_date != MISSING
+        has_cancellation = self.cancellation_date != MISSING
+        past_booked = has_booking & (~has_cancellation | (self.booking_date > self.cancellation_date))
+        return ~self.is_blocked & np.where(self.is_past, past_booked, ~self.available)
+
+    @property
+    def is_cancelled(self):
+        has_booking = self.booking_date != MISSING
+        has_cancellation = self.cancellation_date != MISSING
+        return ~self.is_blocked & has_cancellation & (
+            ~has_booking | (self.cancellation_date > self.booking_date)
+        )
+
+    @property
+    def is_data_complete(self):
+        return ~self.is_past | (self.last_available_seen_date != MISSING)
+
+    def update_inferred(self):
+        """Same as `AirbnbCalendarDayMixin.update_inferred()` for all days."""
+        now = self.update_date
+        is_past = self.is_past
+
+        self.last_available_seen_date = np.where(self.available, now, self.last_available_seen_date)
+        self.blocked = np.where(self.available, 0, self.blocked).astype(np.int8)
+        set_unavailable = ~self.available & ~is_past & (self.first_unavailable_seen_date == MISSING)
+        self.first_unavailable_seen_date = np.where(set_unavailable, now, self.first_unavailable_seen_date)
+
+        av_date = self.last_available_seen_date
+        unav_date = self.first_unavailable_seen_date
+        both = (av_date != MISSING) & (unav_date != MISSING)
+        # Whole seconds, as with `Arrow.timestamp`, rounded half to even
+        seconds_sum = np.where(both, av_date // MICROS_PER_SECOND + unav_date // MICROS_PER_SECOND, 0)
+        mid_date = np.rint(seconds_sum / 2.0).astype(np.int64) * MICROS_PER_SECOND
+
+        booked = both & (av_date < unav_date) & ~is_past
+        self.booking_date = np.where(booked, mid_date, self.booking_date)
+        cancelled = both & (av_date >= unav_date) & (self.cancellation_date != mid_date)
+        self.cancellation_date = np.where(cancelled, mid_date, self.cancellation_date)
+        self.cancellations = np.where(cancelled, self.cancellations + 1, self.cancellations)
+
+    def aggregate(self):
+        """
+        Computes the values set by `update_with_days()`
+        for each month.
+
+        Returns:
+            A dictionary of arrays with one entry per month.
+        """
+        n = self.month_count
+        group = self.group
+        is_past = self.is_past
+        is_booked = self.is_booked
+        is_cancelled = self.is_cancelled
+        has_price = ~np.isnan(self.price)
+
+        def count(mask):
+            return np.bincount(group[mask], minlength=n)
+
+        total_days = np.bincount(group, minlength=n)
+        assert not bool(np.any(total_days > 31)), 'Too many days'
+        future_days = count(~is_past)
+        available_future_days = count(~is_past & self.available)
+        cancelled_days = count(is_cancelled)
+        booked_days = count(is_booked)
+        booked_or_cancelled_days = count(is_booked | is_cancelled)
+        blocked_days = count(self.is_blocked)
+        incomplete_days = count(~self.is_data_complete)
+        missing_prices = count(~has_price)
+
+        # Sums are accumulated in day order, as in the scalar code
+        revenue = np.zeros(n)
+        future_revenue = np.zeros(n)
+        past_booked = is_booked & is_past & has_price
+        future_booked = is_booked & ~is_past & has_price
+        np.add.at(revenue, group[past_booked], self.price[past_booked])
+        np.add.at(future_revenue, group[future_booked], self.price[future_booked])
+
+        # Prices sorted within each month. Months with
+        # missing prices get no price values.
+        order = np.lexsort((self.price, group))
+        sorted_prices = np.append(self.price[order], np.nan)
+        starts = np.searchsorted(group[order], np.arange(n))
+        last_index = len(self)
+        price_sums = np.zeros(n)
+        np.add.at(price_sums, group[order], np.nan_to_num(sorted_prices[:-1]))
+
+        first_complete = np.full(n, len(self), dtype=np.int64)
+        complete_indexes = np.flatnonzero(self.is_data_complete)
+        np.minimum.at(first_complete, group[complete_indexes], complete_indexes)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            availability = np.where(
+                future_days > 0,
+                np.rint(available_future_days / future_days * 100.0) / 100.0,
+                0.0
+            )
+            cancellation_rate = np.where(
+                booked_or_cancelled_days > 0,
+                np.rint(cancelled_days / booked_or_cancelled_days * 100.0) / 100.0,
+                0.0
+            )
+            block_rate = np.rint(blocked_days / total_days * 100.0) / 100.0
+            average_price = np.rint(price_sums / total_days * 100.0) / 100.0
+
+        def price_at(indexes):
+            return sorted_prices[np.where(total_days > 0, indexes, last_index)]
+
+        return {
+            'total_days': total_days,
+            'is_data_complete': incomplete_days == 0,
+            'has_errors': missing_prices > 0,
+            'first_complete_index': np.where(first_complete < len(self), first_complete, -1),
+            'availability': availability,
+            'cancellation_rate': cancellation_rate,
+            'block_rate': block_rate,
+            'booked_days': booked_days,
+            'blocked_days': blocked_days,
+            'revenue': revenue,
+            'future_revenue': future_revenue,
+            'average_price': average_price,
+            'median_price': price_at(starts + total_days // 2),
+            'lowest_price': price_at(starts),
+            'highest_price': price_at(starts + total_days - 1),
+        }
+
+    def write_days(self):
+        """
+        Sets inferred values which changed on the day objects.
+
+        Returns:
+            The number of days changed.
+        """
+        changed_indexes = set()
+        for key, original in self._original.items():
+            values = getattr(self, key)
+            for i in np.flatnonzero(values != original).tolist():
+                day = self.days[i]
+                if key in ('last_available_seen_date', 'first_unavailable_seen_date'):
+                    # Seen at the update date of the day
+                    day[key] = arrow.get(day.get('update_date'))
+                elif key in ('booking_date', 'cancellation_date'):
+                    day[key] = arrow.get(int(values[i]) // MICROS_PER_SECOND)
+                elif key == 'blocked':
+                    day[key] = bool(values[i] == 1)
+                else:
+                    day[key] = int(values[i])
+                changed_indexes.add(i)
+        self._original = self.copy_arrays()
+        return len(changed_indexes)
+
+    def write_months(self, months, metrics=None):
+        """
+        Sets the values computed by `aggregate()` on the months,
+        in the order they were passed to the batch. Months
+        without days are skipped.
+        """
+        metrics = metrics if metrics is not None else self.aggregate()
+        for i, month in enumerate(months):
+            if metrics['total_days'][i] == 0:
+                continue
+            first_complete_index = int(metrics['first_complete_index'][i])
+            if first_complete_index >= 0:
+                month['data_start_date'] = arrow.get(self.days[first_complete_index].get('date'))
+            month['availability'] = float(metrics['availability'][i])
+            month['cancellation_rate'] = float(metrics['cancellation_rate'][i])
+            month['block_rate'] = float(metrics['block_rate'][i])
+            month['total_days'] = int(metrics['total_days'][i])
+            month['booked_days'] = int(metrics['booked_days'][i])
+            month['blocked_days'] = int(metrics['blocked_days'][i])
+
+            errors = []
+            if metrics['has_errors'][i]:
+                start = int(np.searchsorted(self.group, i))
+                for j in range(start, start + int(metrics['total_days'][i])):
+                    if np.isnan(self.price[j]):
+                        date = arrow.get(self.days[j].get('date'))
+                        errors.append(f'Price missing at {date.format("YYYY-MM-DD")}')
+
+            if not bool(errors):
+                revenue = float(metrics['revenue'][i])
+                month['revenue'] = revenue if metrics['is_data_complete'][i] else None
+                month['partial_revenue'] = revenue
+                month['future_revenue'] = float(metrics['future_revenue'][i])
+                month['average_price'] = float(metrics['average_price'][i])
+                month['median_price'] = float(metrics['median_price'][i])
+                month['lowest_price'] = float(metrics['lowest_price'][i])
+                month['highest_price'] = float(metrics['highest_price'][i])
+            else:
+                for key in ['revenue', 'partial_revenue', 'future_revenue', 'average_price',
+                            'median_price', 'lowest_price', 'highest_price']:
+                    month[key] = None
+            month['errors'] = errors
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the calendar data path, run against the
+recorded responses in `tests/res`.
+
+Usage:
+
+    python -m airbnb_scraper.benchmark days --listings 100
+    python -m airbnb_scraper.benchmark flags --listings 100
+    python -m airbnb_scraper.benchmark batch --listings 100
+    python -m airbnb_scraper.benchmark writes --listings 100
+    python -m airbnb_scraper.benchmark find --listings 100
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+import tracemalloc
+from datetime import timedelta
+import arrow
+import bson
+from airbnb_scraper.db import AirbnbMemoryDB, update_operators
+from airbnb_scraper.items import AirbnbListingCalendarMonth, AirbnbListingCalendarDay, AirbnbCalendarDayRecord, ID_KEY, past_threshold
+from airbnb_scraper.replay import ReplayDownloader, FIXTURES_DIR, replay
+
+
+def create_calendars(listings, months, fixtures_dir=FIXTURES_DIR):
+    """Returns a list of calendar month lists, one per listing."""
+    downloader = ReplayDownloader(fixtures_dir=fixtures_dir)
+    start = arrow.utcnow().floor('month')
+    month_infos = downloader.create_calendar(year=start.year, month=start.month, count=months)['calendar_months']
+    return [month_infos] * listings
+
+
+def build_days(day_cls, month_infos, listing_id, time_zone='UTC', currency='USD', now=None):
+    """
+    Creates and infers the days of one calendar response
+    the way `AirbnbSpider.parse_calendar()` does.
+    """
+    now = now or arrow.get()
+    days = []
+    for month_info in month_infos:
+        for day_info in month_info['days']:
+            day = day_cls.create(creation_date=now)
+            day['update_date'] = now
+            day['listing_id'] = listing_id
+            day['currency'] = currency
+            day['time_zone'] = time_zone
+            day['date'] = arrow.get(day_info['date']).replace(tzinfo=time_zone)
+            day['available'] = day_info.get('available')
+            price_strings = re.findall(r'\d+', day_info['price'].get('local_price_formatted') or '')
+            if len(price_strings) == 1:
+                day['price'] = float(price_strings[0])
+            day.update_id()
+            days.append(day)
+    day_cls.update_group(days)
+    for day in days:
+        day.update_inferred()
+    return days
+
+
+def run_days(day_cls, calendars, trace_memory):
+    """
+    Builds the days of every calendar, then serializes
+    them one at a time as the pipeline would.
+
+    Returns:
+        A dictionary of totals over all calendars.
+    """
+    result = {'days': 0, 'held_bytes': 0, 'held_blocks': 0, 'peak_bytes': 0, 'cpu_time': 0.0}
+    if trace_memory:
+        tracemalloc.start()
+    for i, month_infos in enumerate(calendars):
+        cpu_start = time.process_time()
+        blocks_before = sys.getallocatedblocks()
+        if trace_memory:
+            tracemalloc.reset_peak()
+            bytes_before = tracemalloc.get_traced_memory()[0]
+
+        days = build_days(day_cls, month_infos, listing_id=str(i + 1))
+
+        result['held_blocks'] += sys.getallocatedblocks() - blocks_before
+        if trace_memory:
+            result['held_bytes'] += tracemalloc.get_traced_memory()[0] - bytes_before
+        for day in days:
+            item = day.to_item() if isinstance(day, AirbnbCalendarDayRecord) else day
+            item.serialize()
+        if trace_memory:
+            result['peak_bytes'] += tracemalloc.get_traced_memory()[1] - bytes_before
+        result['cpu_time'] += time.process_time() - cpu_start
+        result['days'] += len(days)
+        del days
+    if trace_memory:
+        tracemalloc.stop()
+    return result
+
+
+def benchmark_days(args):
+    calendars = create_calendars(args.listings, args.months, fixtures_dir=args.fixtures)
+    listings = len(calendars)
+    columns = [('item', AirbnbListingCalendarDay), ('record', AirbnbCalendarDayRecord)]
+    memory = {name: run_days(day_cls, calendars, trace_memory=True) for name, day_cls in columns}
+    # CPU time is measured separately, as tracing slows down allocations
+    timing = {name: run_days(day_cls, calendars, trace_memory=False) for name, day_cls in columns}
+
+    rows = [
+        ('Held KiB/listing', lambda name: memory[name]['held_bytes'] / 1024 / listings),
+        ('Held blocks/listing', lambda name: memory[name]['held_blocks'] / listings),
+        ('Peak KiB/listing', lambda name: memory[name]['peak_bytes'] / 1024 / listings),
+        ('CPU ms/listing', lambda name: timing[name]['cpu_time'] * 1000.0 / listings),
+    ]
+    print(f'{listings} listings, {memory["item"]["days"] // listings} days/listing')
+    print(f'{"":<22}' + ''.join(f'{name:>12}' for name, _ in columns))
+    for label, value in rows:
+        print(f'{label:<22}' + ''.join(f'{value(name):>12.1f}' for name, _ in columns))
+
+
+# Day flags read by `update_with_days()`
+DAY_FLAGS = ['is_past', 'is_available', 'is_booked', 'is_cancelled', 'is_blocked', 'is_data_complete']
+
+
+def read_flags(days, invalidate):
+    cpu_start = time.process_time()
+    for day in days:
+        for flag in DAY_FLAGS:
+            if invalidate:
+                day._flags = None
+                past_threshold.cache_clear()
+            getattr(day, flag)
+    return time.process_time() - cpu_start
+
+
+def benchmark_flags(args):
+    calendars = create_calendars(args.listings, args.months, fixtures_dir=args.fixtures)
+    histories = simulate_history(calendars, crawls=3, seed=0)
+    months_and_days = group_months(histories)
+    days = [day for _, days in months_and_days for day in days]
+
+    uncached_time = read_flags(days, invalidate=True)
+    cold_time = read_flags(days, invalidate=False)
+    cached_time = read_flags(days, invalidate=False)
+
+    for day in days:
+        day._flags = None
+    cpu_start = time.process_time()
+    for month, days_in_month in months_and_days:
+        month.update_with_days(days_in_month)
+    update_time = time.process_time() - cpu_start
+
+    print(f'{len(days)} days, {len(DAY_FLAGS)} flags per day')
+    for label, value in [
+        ('Flags, no caching', uncached_time),
+        ('Flags, first read', cold_time),
+        ('Flags, cached', cached_time),
+        ('update_with_days', update_time),
+    ]:
+        print(f'{label:<22}{value * 1000000.0 / len(days):>10.1f} us/day')
+
+
+# Time zones of simulated listings
+SIMULATED_TIME_ZONES = ['UTC', 'America/New_York', 'Europe/Berlin', 'Asia/Kolkata', 'Pacific/Auckland']
+# Fields compared between the scalar and batch engines
+BATCH_DAY_KEYS = [
+    'last_available_seen_date',
+    'first_unavailable_seen_date',
+    'booking_date',
+    'cancellation_date',
+    'cancellations',
+    'blocked',
+]
+BATCH_MONTH_KEYS = [
+    'data_start_date',
+    'availability',
+    'cancellation_rate',
+    'block_rate',
+    'total_days',
+    'booked_days',
+    'blocked_days',
+    'revenue',
+    'partial_revenue',
+    'future_revenue',
+    'average_price',
+    'median_price',
+    'lowest_price',
+    'highest_price',
+    'errors',
+]
+
+
+def simulate_history(calendars, crawls, seed=0):
+    """
+    Crawls each calendar repeatedly, a few days apart, with
+    random availability changes, so that days accumulate
+    bookings, cancellations and blocked periods.
+
+    Returns:
+        A list of `(time_zone, days)` pairs, one per listing,
+        with days as records before the last crawl is inferred.
+    """
+    rng = random.Random(seed)
+    start = arrow.utcnow().floor('month')
+    histories = []
+    for i, month_infos in enumerate(calendars):
+        time_zone = SIMULATED_TIME_ZONES[i % len(SIMULATED_TIME_ZONES)]
+        now = start.shift(days=-7)
+        days = build_days(AirbnbCalendarDayRecord, month_infos, listing_id=str(i + 1), time_zone=time_zone, now=now)
+        for crawl in range(crawls):
+            now = now.shift(days=rng.randint(1, 5), seconds=rng.randint(0, 86399), microseconds=rng.randint(0, 999999))
+            for day in days:
+                day['update_date'] = now
+                if rng.random() < 0.2:
+                    day['available'] = not day['available']
+                if rng.random() < 0.002:
+                    day['price'] = None
+            if crawl < crawls - 1:
+                AirbnbCalendarDayRecord.update_group(days)
+                for day in days:
+                    day.update_inferred()
+        histories.append((time_zone, days))
+    return histories
+
+
+def copy_record(day):
+    values = {key: day.get(key) for key in day._keys if hasattr(day, key)}
+    return AirbnbCalendarDayRecord(**values)
+
+
+def group_months(histories):
+    """Returns a list of `(month, days)` pairs for the histories."""
+    months_and_days = []
+    for time_zone, days in histories:
+        month_days = {}
+        for day in days:
+            month_id = AirbnbListingCalendarMonth.create_id(
+                listing_id=day['listing_id'],
+                date=day.get_date_value('date'),
+                tzinfo=time_zone
+            )
+            month_days.setdefault(month_id, []).append(day)
+        for month_id, days_in_month in month_days.items():
+            month = AirbnbListingCalendarMonth.create()
+            month[ID_KEY] = month_id
+            month['listing_id'] = days_in_month[0]['listing_id']
+            month['time_zone'] = time_zone
+            month['update_date'] = days_in_month[0]['update_date']
+            months_and_days.append((month, days_in_month))
+    return months_and_days
+
+
+def benchmark_batch(args):
+    from airbnb_scraper.batch import DayBatch, to_micros
+
+    calendars = create_calendars(args.listings, args.months, fixtures_dir=args.fixtures)
+    histories = simulate_history(calendars, args.crawls, seed=args.seed)
+    scalar = group_months([(tz, [copy_record(day) for day in days]) for tz, days in histories])
+    vector = group_months([(tz, [copy_record(day) for day in days]) for tz, days in histories])
+    day_count = sum(len(days) for _, days in scalar)
+
+    cpu_start = time.process_time()
+    for _, days in scalar:
+        for day in days:
+            day.update_inferred()
+    for month, days in scalar:
+        month.update_with_days(days)
+    scalar_time = time.process_time() - cpu_start
+
+    cpu_start = time.process_time()
+    batch = DayBatch.from_months(vector)
+    build_time = time.process_time() - cpu_start
+    batch.update_inferred()
+    metrics = batch.aggregate()
+    compute_time = time.process_time() - cpu_start - build_time
+    batch.write_days()
+    batch.write_months([month for month, _ in vector], metrics=metrics)
+    batch_time = time.process_time() - cpu_start
+
+    def normalize(value):
+        return to_micros(value) if isinstance(value, arrow.Arrow) else value
+
+    mismatches = []
+    for (scalar_month, scalar_days), (vector_month, vector_days) in zip(scalar, vector):
+        for key in BATCH_MONTH_KEYS:
+            a, b = normalize(scalar_month.get(key)), normalize(vector_month.get(key))
+            if a != b:
+                mismatches.append(f'{scalar_month.get_id()} {key}: {a!r} != {b!r}')
+        for scalar_day, vector_day in zip(scalar_days, vector_days):
+            for key in BATCH_DAY_KEYS:
+                a, b = normalize(scalar_day.get(key)), normalize(vector_day.get(key))
+                if a != b:
+                    mismatches.append(f'{scalar_day.get_id()} {key}: {a!r} != {b!r}')
+
+    print(f'{len(scalar)} months, {day_count} days, {args.crawls} crawls')
+    print(f'Scalar: {scalar_time:.3f} s ({day_count / scalar_time:.0f} days/s)')
+    print(
+        f'Batch: {batch_time:.3f} s ({day_count / batch_time:.0f} days/s), '
+        f'of which {build_time:.3f} s loading arrays and {compute_time:.3f} s computing'
+    )
+    for mismatch in mismatches[:20]:
+        print(f'Mismatch: {mismatch}')
+    print(f'Parity: {"OK" if not bool(mismatches) else f"{len(mismatches)} mismatches"}')
+    return 1 if bool(mismatches) else 0
+
+
+class WriteCountingDB(AirbnbMemoryDB):
+    """
+    In-memory storage which counts the BSON bytes of the
+    updates it receives, and of a `$set` of the whole
+    document for the same writes, which is what was sent
+    before saves were limited to changed fields.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.writes = 0
+        self.update_bytes = 0
+        self.document_bytes = 0
+
+    def upsert(self, collection_name, id, doc, insert_doc=None):
+        super().upsert(collection_name, id, doc, insert_doc)
+        self.count(collection_name, id, doc, insert_doc)
+
+    def upsert_many(self, collection_name, updates):
+        super().upsert_many(collection_name, updates)
+        for id, doc, insert_doc in updates:
+            self.count(collection_name, id, doc, insert_doc)
+
+    def update_many(self, collection_name, ids, doc):
+        super().update_many(collection_name, ids, doc)
+        docs = self.get_collection(collection_name).docs
+        self.writes += 1
+        self.update_bytes += len(bson.encode({'q': {ID_KEY: {'$in': list(ids)}}, 'u': {'$set': doc}}))
+        for id in ids:
+            full_doc = {key: value for key, value in docs[id].items() if key != ID_KEY}
+            self.document_bytes += len(bson.encode({'q': {ID_KEY: id}, 'u': {'$set': full_doc}}))
+
+    def count(self, collection_name, id, doc, insert_doc):
+        stored = self.get_collection(collection_name).docs[id]
+        full_doc = {key: value for key, value in stored.items() if key != ID_KEY}
+        self.writes += 1
+        self.update_bytes += len(bson.encode({'q': {ID_KEY: id}, 'u': update_operators(doc, insert_doc)}))
+        self.document_bytes += len(bson.encode({'q': {ID_KEY: id}, 'u': {'$set': full_doc}}))
+
+    def age(self, seconds):
+        """Moves the update dates of all documents back in time."""
+        for collection in self.collections.values():
+            for doc in collection.docs.values():
+                if doc.get('update_date') is not None:
+                    doc['update_date'] -= timedelta(seconds=seconds)
+
+
+def benchmark_writes(args):
+    storage = WriteCountingDB()
+    settings_overrides = {
+        'CALENDAR_EMBEDDED_DAYS': args.embedded,
+        'MONGO_COALESCE_TOUCHES': args.coalesce_touches,
+    }
+    print(f'{args.listings} listings, {args.months} months, {"embedded" if args.embedded else "day"} documents')
+    for crawl in range(args.crawls):
+        if crawl > 0:
+            # Make months stale, so that calendars are fetched again
+            storage.age(AirbnbListingCalendarMonth._stale_interval + 1)
+        storage.reset_counts()
+        replay(
+            listings=args.listings,
+            pipeline=args.pipeline,
+            fixtures_dir=args.fixtures,
+            spider_kwargs={'months': str(args.months)},
+            settings_overrides=settings_overrides,
+            storage=storage
+        )
+        change = storage.update_bytes / storage.document_bytes - 1.0 if storage.document_bytes > 0 else 0.0
+        print(
+            f'Crawl {crawl + 1}: {storage.writes} writes, '
+            f'{storage.update_bytes / 1024:.0f} KiB changed fields, '
+            f'{storage.document_bytes / 1024:.0f} KiB whole documents ({change * 100.0:+.0f}%)'
+        )
+    return 0
+
+
+# Keys read by the projected queries of the find benchmark
+FIND_KEYS = ['date', 'price', 'available']
+
+
+def benchmark_find(args):
+    storage = AirbnbMemoryDB()
+    replay(
+        listings=args.listings,
+        fixtures_dir=args.fixtures,
+        spider_kwargs={'months': str(args.months)},
+        storage=storage
+    )
+    modes = [
+        ('items', lambda: AirbnbListingCalendarDay.find()),
+        ('projected items', lambda: AirbnbListingCalendarDay.find(projection=FIND_KEYS)),
+        ('records', lambda: AirbnbCalendarDayRecord.find()),
+        ('raw', lambda: AirbnbListingCalendarDay.find(raw=True)),
+        ('projected raw', lambda: AirbnbListingCalendarDay.find(projection=FIND_KEYS, raw=True)),
+    ]
+    print(f'{len(storage.get_collection(AirbnbListingCalendarDay._collection_name).docs)} days')
+    def read_days(days):
+        # Read a value like a report would, without keeping the results
+        count = 0
+        total = 0.0
+        for day in days:
+            count += 1
+            total += day.get('price') or 0.0
+        return count
+
+    for name, find in modes:
+        cpu_start = time.process_time()
+        count = read_days(find())
+        cpu_time = time.process_time() - cpu_start
+
+        tracemalloc.start()
+        read_days(find())
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{name}: {cpu_time:.3f} s ({count / cpu_time:.0f} days/s), peak {peak_memory / 1024:.0f} KiB')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the calendar data path on recorded responses.')
+    parser.add_argument('--fixtures', default=str(FIXTURES_DIR), help='Directory of recorded responses')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    days_parser = subparsers.add_parser('days', help='Memory and CPU of day items and day records per listing')
+    days_parser.add_argument('--listings', type=int, default=100, help='Number of calendars to parse')
+    days_parser.add_argument('--months', type=int, default=6, help='Months per calendar')
+    days_parser.set_defaults(func=benchmark_days)
+
+    flags_parser = subparsers.add_parser('flags', help='Cost per day of the derived day flags')
+    flags_parser.add_argument('--listings', type=int, default=100, help='Number of simulated listings')
+    flags_parser.add_argument('--months', type=int, default=6, help='Months per calendar')
+    flags_parser.set_defaults(func=benchmark_flags)
+
+    batch_parser = subparsers.add_parser('batch', help='Parity and speed of the NumPy batch engine (requires NumPy)')
+    batch_parser.add_argument('--listings', type=int, default=100, help='Number of simulated listings')
+    batch_parser.add_argument('--months', type=int, default=6, help='Months per calendar')
+    batch_parser.add_argument('--crawls', type=int, default=10, help='Simulated crawls per listing')
+    batch_parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    batch_parser.set_defaults(func=benchmark_batch)
+
+    writes_parser = subparsers.add_parser('writes', help='Bytes sent to the database per crawl')
+    writes_parser.add_argument('--listings', type=int, default=100, help='Number of listings to crawl')
+    writes_parser.add_argument('--months', type=int, default=3, help='Months per calendar')
+    writes_parser.add_argument('--crawls', type=int, default=3, help='Crawls on the same data')
+    writes_parser.add_argument('--embedded', action='store_true', help='Enable CALENDAR_EMBEDDED_DAYS')
+    writes_parser.add_argument('--coalesce-touches', action='store_true',
+                               help='Enable MONGO_COALESCE_TOUCHES (needs the bulk pipeline)')
+    writes_parser.add_argument('--pipeline', default='airbnb_scraper.pipelines.AirbnbMongoPipeline',
+                               help='Item pipeline class path')
+    writes_parser.set_defaults(func=benchmark_writes)
+
+    find_parser = subparsers.add_parser('find', help='Iterating over stored days with the query modes of find()')
+    find_parser.add_argument('--listings', type=int, default=100, help='Number of listings to crawl')
+    find_parser.add_argument('--months', type=int, default=6, help='Months per calendar')
+    find_parser.set_defaults(func=benchmark_find)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3 @@
+# This package contains custom scrapy commands for the project.
+#
+# See: https://docs.scrapy.org/en/latest/topics/commands.html#custom-project-commands
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from pymongo import ASCENDING
+from scrapy.commands import ScrapyCommand
+from scrapy.utils.misc import load_object
+from airbnb_scraper.db import AirbnbStorage
+from airbnb_scraper.items import AirbnbListingCalendarMonth, AirbnbListingCalendarDay
+
+# Number of months whose days are fetched and written together
+BATCH_SIZE = 200
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def short_desc(self):
+        return 'Copy day documents into the per-day arrays of their months'
+
+    def run(self, args, opts):
+        storage_cls = load_object(self.settings.get('STORAGE_CLASS'))
+        client = storage_cls(
+            mongo_uri=self.settings.get('MONGO_URI'),
+            mongo_db=self.settings.get('MONGO_DATABASE')
+        )
+        AirbnbStorage.set_shared(client)
+        client.open()
+        try:
+            months_count, days_count = self.embed_days()
+        finally:
+            client.close()
+
+        print(f'Embedded {days_count} days into {months_count} months.')
+        print('Enable CALENDAR_EMBEDDED_DAYS, and drop the days collection once the months are verified.')
+
+    def embed_days(self):
+        months_count = 0
+        days_count = 0
+        months = []
+        for month in AirbnbListingCalendarMonth.find():
+            months.append(month)
+            if len(months) >= BATCH_SIZE:
+                counts = self.embed_page(months)
+                months_count += counts[0]
+                days_count += counts[1]
+                months = []
+        counts = self.embed_page(months)
+        return months_count + counts[0], days_count + counts[1]
+
+    def embed_page(self, months):
+        """
+        Embeds the days of a page of months, fetched with one
+        query, and saves the months with one bulk write.
+
+        Returns:
+            The number of months and days embedded.
+        """
+        if not bool(months):
+            return 0, 0
+        days_by_month = {}
+        days = AirbnbListingCalendarDay.find(
+            {'month_id': {'$in': [month.get_id() for month in months]}},
+            sort=[('date', ASCENDING)]
+        )
+        for day in days:
+            days_by_month.setdefault(day['month_id'], []).append(day)
+
+        embedded = []
+        days_count = 0
+        for month in months:
+            month_days = days_by_month.get(month.get_id())
+            if not bool(month_days):
+                continue
+            month.embed_days(month_days)
+            embedded.append(month)
+            days_count += len(month_days)
+        AirbnbListingCalendarMonth.save_many(embedded)
+        return len(embedded), days_count
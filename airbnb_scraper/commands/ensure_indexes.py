@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from scrapy.commands import ScrapyCommand
+from scrapy.utils.misc import load_object
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def short_desc(self):
+        return 'Build MongoDB indexes for all item collections in the background'
+
+    def run(self, args, opts):
+        storage_cls = load_object(self.settings.get('STORAGE_CLASS'))
+        client = storage_cls(
+            mongo_uri=self.settings.get('MONGO_URI'),
+            mongo_db=self.settings.get('MONGO_DATABASE')
+        )
+        client.open()
+        try:
+            indexes = client.ensure_indexes(background=True)
+        finally:
+            client.close()
+
+        for collection_name, index_names in indexes.items():
+            print(f'{collection_name}: {", ".join(index_names)}')
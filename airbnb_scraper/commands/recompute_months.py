@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from pymongo import ASCENDING
+from scrapy.commands import ScrapyCommand
+from scrapy.utils.misc import load_object
+from airbnb_scraper.db import AirbnbStorage
+from airbnb_scraper.items import AirbnbListingCalendarMonth, AirbnbListingCalendarDay, AirbnbCalendarDayRecord
+
+# Number of months computed together
+BATCH_SIZE = 1000
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def short_desc(self):
+        return 'Recompute booking inference and month metrics from stored days (requires NumPy)'
+
+    def run(self, args, opts):
+        storage_cls = load_object(self.settings.get('STORAGE_CLASS'))
+        client = storage_cls(
+            mongo_uri=self.settings.get('MONGO_URI'),
+            mongo_db=self.settings.get('MONGO_DATABASE')
+        )
+        AirbnbStorage.set_shared(client)
+        embed_days = self.settings.getbool('CALENDAR_EMBEDDED_DAYS')
+        client.open()
+        try:
+            totals = [0, 0, 0]
+            months = []
+            for month in AirbnbListingCalendarMonth.find():
+                months.append(month)
+                if len(months) >= BATCH_SIZE:
+                    totals = [a + b for a, b in zip(totals, self.recompute(months, embed_days))]
+                    months = []
+            totals = [a + b for a, b in zip(totals, self.recompute(months, embed_days))]
+        finally:
+            client.close()
+
+        print(f'Recomputed {totals[0]} days, changed {totals[1]} days and {totals[2]} months.')
+
+    def recompute(self, months, embed_days):
+        """
+        Runs the batch engine on the days of the months
+        and saves the changes. The day group pass
+        (`update_group()`) depends on the days seen in a
+        crawl and is not repeated.
+
+        Returns:
+            The number of days, changed days and saved months.
+        """
+        from airbnb_scraper.batch import DayBatch
+
+        if embed_days:
+            months_and_days = [(month, month.get_embedded_days()) for month in months]
+        else:
+            days_by_month = {}
+            days = AirbnbCalendarDayRecord.find(
+                {'month_id': {'$in': [month.get_id() for month in months]}},
+                sort=[('date', ASCENDING)]
+            )
+            for day in days:
+                days_by_month.setdefault(day['month_id'], []).append(day)
+            months_and_days = [(month, days_by_month.get(month.get_id(), [])) for month in months]
+        months_and_days = [(month, days) for month, days in months_and_days if bool(days)]
+
+        batch = DayBatch.from_months(months_and_days)
+        batch.update_inferred()
+        changed_days = batch.write_days()
+        batch.write_months([month for month, _ in months_and_days])
+
+        if not embed_days and changed_days > 0:
+            AirbnbListingCalendarDay.save_many([day.to_item() for _, days in months_and_days for day in days])
+        saved_months, _ = AirbnbListingCalendarMonth.save_many([month for month, _ in months_and_days])
+        return len(batch), changed_days, saved_months
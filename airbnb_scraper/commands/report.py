@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.misc import load_object
+from airbnb_scraper.db import AirbnbStorage
+from airbnb_scraper import analytics
+
+# Report columns after the group keys
+REPORT_COLUMNS = ['listings', 'months', 'occupancy', 'revenue', 'revenue_per_listing', 'average_price', 'price_p50']
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Print occupancy, revenue and prices per neighbourhood and room type'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_argument('-c', '--city', dest='city', help='Only include listings in this localized city')
+        # `-s` is the global `--set` option
+        parser.add_argument('--start', dest='start', help='First month, e.g. 2020-01')
+        parser.add_argument('--end', dest='end', help='Month after the last month, e.g. 2021-01')
+        parser.add_argument('-g', '--group-by', dest='group_by', default=','.join(analytics.DEFAULT_GROUP_KEYS),
+                            help='Comma separated listing fields to group by')
+        parser.add_argument('-r', '--refresh', dest='refresh', action='store_true', help='Ignore cached results')
+
+    def run(self, args, opts):
+        group_by = [key.strip() for key in opts.group_by.split(',') if bool(key.strip())]
+        if not bool(group_by):
+            raise UsageError('Expected at least one group key')
+
+        storage_cls = load_object(self.settings.get('STORAGE_CLASS'))
+        client = storage_cls(
+            mongo_uri=self.settings.get('MONGO_URI'),
+            mongo_db=self.settings.get('MONGO_DATABASE')
+        )
+        AirbnbStorage.set_shared(client)
+        client.open()
+        try:
+            rows = analytics.occupancy_report(
+                group_by=group_by,
+                city=opts.city,
+                start=opts.start,
+                end=opts.end,
+                refresh=opts.refresh
+            )
+        finally:
+            client.close()
+
+        print('\t'.join(group_by + REPORT_COLUMNS))
+        for row in rows:
+            print('\t'.join(format_value(row[key]) for key in group_by + REPORT_COLUMNS))
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    return str(value)
@@ -5,45 +5,589 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import itertools
+import time
 import pymongo
-from airbnb_scraper.settings import MONGO_URI, MONGO_DATABASE
+from datetime import datetime, timezone
+from scrapy.utils.misc import load_object
+from airbnb_scraper.settings import MONGO_URI, MONGO_DATABASE, MONGO_ENSURE_INDEXES, STORAGE_CLASS
+
+ID_KEY = '_id'
+# Document operations reported by `AirbnbStorage.observe()`
+OBSERVED_OPERATIONS = ('load', 'load_many', 'find', 'aggregate', 'upsert', 'upsert_many', 'update_many')
 
 _shared = None
 
-class AirbnbMongoDB:
+
+class AirbnbStorage:
+    """
+    Storage backend for items. Documents are dictionaries
+    keyed by field name, with an `_id` key, and are grouped
+    into named collections.
+
+    Subclasses implement the document operations. The
+    backend used by the items is set with `STORAGE_CLASS`.
+    """
 
     @classmethod
     def shared(cls):
         global _shared
         if _shared is None:
-            _shared = cls(
+            storage_cls = load_object(STORAGE_CLASS)
+            _shared = storage_cls(
                 mongo_uri=MONGO_URI,
-                mongo_db=MONGO_DATABASE
+                mongo_db=MONGO_DATABASE,
+                ensure_indexes=MONGO_ENSURE_INDEXES
             )
         return _shared
 
-    def __init__(self, mongo_uri='', mongo_db=''):
+    @classmethod
+    def set_shared(cls, client):
+        global _shared
+        _shared = client
+
+    def __init__(self, mongo_uri='', mongo_db='', ensure_indexes=False):
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
-        self._reset()
-    
+        self.should_ensure_indexes = ensure_indexes
+        self._open_depth = 0
+
     def open(self):
         self._open_depth += 1
         if self._open_depth > 1:
             return
-        self.client = pymongo.MongoClient(self.mongo_uri)
-        self.db = self.client[self.mongo_db]
+        self.connect()
+        if self.should_ensure_indexes:
+            self.ensure_indexes(background=True)
 
     def close(self):
         self._open_depth -= 1
         if self._open_depth > 0:
             return
         elif self._open_depth < 0:
-            raise Exception('Mismatched MongoDB open and close calls')
-        self.client.close()
-        self._reset()
+            raise Exception('Mismatched storage open and close calls')
+        self.disconnect()
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def ensure_indexes(self, background=False):
+        """
+        Creates missing indexes for all item collections.
+
+        Returns:
+            A dictionary of index names keyed by collection name.
+        """
+        from airbnb_scraper.items import ITEM_CLASSES
+        indexes = {}
+        for item_cls in ITEM_CLASSES:
+            indexes[item_cls._collection_name] = item_cls.ensure_indexes(self, background=background)
+        return indexes
+
+    def create_index(self, collection_name, keys, background=False):
+        """
+        Creates an index on a list of `(key, direction)` pairs
+        if it does not exist.
+
+        Returns:
+            The index name.
+        """
+        raise NotImplementedError()
+
+    def load(self, collection_name, id):
+        """Returns the document with the given ID, or `None`."""
+        raise NotImplementedError()
+
+    def load_many(self, collection_name, ids):
+        """Returns a list of the documents with the given IDs which exist."""
+        raise NotImplementedError()
+
+    def find(self, collection_name, query=None, sort=None, projection=None, limit=0, batch_size=0):
+        """
+        Returns an iterable of documents matching a MongoDB
+        style query, optionally sorted by a list of
+        `(key, direction)` pairs.
+
+        Args:
+            projection: A list of keys to return, or a MongoDB
+                style projection dictionary. `_id` is always
+                returned unless excluded.
+            limit: The maximum number of documents, or 0 for all.
+            batch_size: The number of documents fetched per
+                round trip, or 0 for the backend default.
+        """
+        raise NotImplementedError()
+
+    def aggregate(self, collection_name, pipeline):
+        """
+        Runs a MongoDB aggregation pipeline.
+
+        Returns:
+            An iterable of result documents.
+        """
+        raise NotImplementedError()
+
+    def upsert(self, collection_name, id, doc, insert_doc=None):
+        """
+        Sets the fields in `doc` on the document with the
+        given ID, creating the document if needed. The
+        fields in `insert_doc` are only set when the
+        document is created. Keys can be dotted paths into
+        nested documents.
+        """
+        raise NotImplementedError()
+
+    def upsert_many(self, collection_name, updates):
+        """
+        Same as `upsert()` for a list of `(id, doc, insert_doc)`
+        tuples. The order of writes is not guaranteed.
+        """
+        raise NotImplementedError()
+
+    def update_many(self, collection_name, ids, doc):
+        """
+        Sets the fields in `doc` on the existing documents
+        with the given IDs, with a single update.
+        """
+        raise NotImplementedError()
 
-    def _reset(self):
+    def observe(self, observer):
+        """
+        Calls `observer(operation, collection_name, seconds)` after
+        each document operation of this storage, on the thread which
+        ran it. The results of `find()` and `aggregate()` are timed
+        until they are consumed or discarded. An observer of `None`
+        stops observing.
+        """
+        for operation in OBSERVED_OPERATIONS:
+            self.__dict__.pop(operation, None)
+            if observer is not None:
+                method = getattr(self, operation)
+                setattr(self, operation, _observed(method, operation, observer))
+
+
+def _observed(method, operation, observer):
+    iterates = operation in ('find', 'aggregate')
+
+    def observed(collection_name, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(collection_name, *args, **kwargs)
+        except Exception:
+            observer(operation, collection_name, time.perf_counter() - start)
+            raise
+        seconds = time.perf_counter() - start
+        if iterates:
+            return _observed_results(result, operation, collection_name, observer, seconds)
+        observer(operation, collection_name, seconds)
+        return result
+
+    return observed
+
+
+def _observed_results(results, operation, collection_name, observer, seconds):
+    iterator = iter(results)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                doc = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - start
+            yield doc
+    finally:
+        observer(operation, collection_name, seconds)
+
+
+def update_operators(doc, insert_doc=None):
+    """Returns a MongoDB update document for `upsert()`."""
+    update = {}
+    # Empty operators are rejected by older servers
+    if bool(doc):
+        update['$set'] = doc
+    if bool(insert_doc):
+        update['$setOnInsert'] = insert_doc
+    return update
+
+
+class AirbnbMongoDB(AirbnbStorage):
+
+    def __init__(self, mongo_uri='', mongo_db='', ensure_indexes=False):
+        super().__init__(mongo_uri=mongo_uri, mongo_db=mongo_db, ensure_indexes=ensure_indexes)
         self.client = None
         self.db = None
-        self._open_depth = 0
+
+    def connect(self):
+        self.client = pymongo.MongoClient(self.mongo_uri)
+        self.db = self.client[self.mongo_db]
+
+    def disconnect(self):
+        self.client.close()
+        self.client = None
+        self.db = None
+
+    def create_index(self, collection_name, keys, background=False):
+        return self.db[collection_name].create_index(keys, background=background)
+
+    def load(self, collection_name, id):
+        return self.db[collection_name].find_one({ID_KEY: id})
+
+    def load_many(self, collection_name, ids):
+        return list(self.db[collection_name].find({ID_KEY: {'$in': list(ids)}}))
+
+    def find(self, collection_name, query=None, sort=None, projection=None, limit=0, batch_size=0):
+        docs = self.db[collection_name].find(query or {}, projection=projection, limit=limit)
+        if sort:
+            docs = docs.sort(sort)
+        if batch_size > 0:
+            docs = docs.batch_size(batch_size)
+        return docs
+
+    def aggregate(self, collection_name, pipeline):
+        return self.db[collection_name].aggregate(pipeline, allowDiskUse=True)
+
+    def upsert(self, collection_name, id, doc, insert_doc=None):
+        self.db[collection_name].update_one(
+            {ID_KEY: id},
+            update_operators(doc, insert_doc),
+            upsert=True
+        )
+
+    def upsert_many(self, collection_name, updates):
+        requests = [
+            pymongo.UpdateOne({ID_KEY: id}, update_operators(doc, insert_doc), upsert=True)
+            for id, doc, insert_doc in updates
+        ]
+        if bool(requests):
+            self.db[collection_name].bulk_write(requests, ordered=False)
+
+    def update_many(self, collection_name, ids, doc):
+        self.db[collection_name].update_many({ID_KEY: {'$in': list(ids)}}, {'$set': doc})
+
+
+class AirbnbMemoryDB(AirbnbStorage):
+    """
+    In-process storage which keeps collections in
+    dictionaries, for tests, benchmarks and offline runs.
+
+    Each declared index gets a hash index on its leading
+    key, which is used by queries with an equality or `$in`
+    condition on that key. Values are normalized the way
+    BSON stores them, so items see the same data as with
+    MongoDB. Data survives `close()`.
+    """
+
+    def __init__(self, mongo_uri='', mongo_db='', ensure_indexes=False):
+        super().__init__(mongo_uri=mongo_uri, mongo_db=mongo_db, ensure_indexes=ensure_indexes)
+        self.collections = {}
+
+    def get_collection(self, collection_name):
+        if collection_name not in self.collections:
+            self.collections[collection_name] = MemoryCollection()
+        return self.collections[collection_name]
+
+    def create_index(self, collection_name, keys, background=False):
+        self.get_collection(collection_name).create_index(keys[0][0])
+        return '_'.join(f'{key}_{direction}' for key, direction in keys)
+
+    def load(self, collection_name, id):
+        doc = self.get_collection(collection_name).docs.get(id)
+        return dict(doc) if doc is not None else None
+
+    def load_many(self, collection_name, ids):
+        docs = self.get_collection(collection_name).docs
+        return [dict(docs[id]) for id in ids if id in docs]
+
+    def find(self, collection_name, query=None, sort=None, projection=None, limit=0, batch_size=0):
+        docs = self.get_collection(collection_name).find(query or {})
+        if bool(sort):
+            docs = list(docs)
+        for key, direction in reversed(sort or []):
+            docs.sort(
+                key=lambda doc: (doc.get(key) is not None, doc.get(key)),
+                reverse=direction == pymongo.DESCENDING
+            )
+        if limit > 0:
+            docs = itertools.islice(docs, limit)
+        # Copy documents as they are consumed
+        return (_project(doc, projection) for doc in docs)
+
+    def aggregate(self, collection_name, pipeline):
+        """
+        Supports the `$match`, `$lookup`, `$unwind`, `$project`,
+        `$group`, `$sort` and `$limit` stages, with field paths
+        as expressions. A leading `$match` uses the indexes.
+        """
+        stages = list(pipeline)
+        if bool(stages) and '$match' in stages[0]:
+            docs = self.get_collection(collection_name).find(stages.pop(0)['$match'])
+        else:
+            docs = self.get_collection(collection_name).find({})
+        return self.run_stages([dict(doc) for doc in docs], stages)
+
+    def run_stages(self, docs, stages):
+        for stage in stages:
+            (name, arg), = stage.items()
+            if name == '$match':
+                docs = [doc for doc in docs if _matches(doc, arg)]
+            elif name == '$lookup':
+                foreign = self.get_collection(arg['from'])
+                for doc in docs:
+                    matches = foreign.find({arg['foreignField']: _get_path(doc, arg['localField'])})
+                    doc[arg['as']] = self.run_stages([dict(x) for x in matches], arg.get('pipeline', []))
+            elif name == '$unwind':
+                path = (arg['path'] if isinstance(arg, dict) else arg)[1:]
+                docs = [
+                    {**doc, path: value}
+                    for doc in docs
+                    for value in (_get_path(doc, path) or [])
+                ]
+            elif name == '$project':
+                docs = [_project(doc, arg) for doc in docs]
+            elif name == '$group':
+                docs = _group(docs, arg)
+            elif name == '$sort':
+                for key, direction in reversed(list(arg.items())):
+                    docs.sort(
+                        key=lambda doc: (_get_path(doc, key) is not None, _get_path(doc, key)),
+                        reverse=direction == pymongo.DESCENDING
+                    )
+            elif name == '$limit':
+                docs = docs[:arg]
+            else:
+                raise NotImplementedError(f'Unsupported aggregation stage: {name}')
+        return docs
+
+    def upsert(self, collection_name, id, doc, insert_doc=None):
+        self.get_collection(collection_name).upsert(id, doc, insert_doc)
+
+    def upsert_many(self, collection_name, updates):
+        collection = self.get_collection(collection_name)
+        for id, doc, insert_doc in updates:
+            collection.upsert(id, doc, insert_doc)
+
+    def update_many(self, collection_name, ids, doc):
+        collection = self.get_collection(collection_name)
+        for id in ids:
+            if id in collection.docs:
+                collection.upsert(id, doc)
+
+
+class MemoryCollection:
+
+    def __init__(self):
+        self.docs = {}
+        # Maps an indexed key to {value: set of IDs}
+        self.indexes = {}
+
+    def create_index(self, key):
+        if key in self.indexes:
+            return
+        index = {}
+        for id, doc in self.docs.items():
+            index.setdefault(_index_value(doc.get(key)), set()).add(id)
+        self.indexes[key] = index
+
+    def upsert(self, id, doc, insert_doc=None):
+        old_doc = self.docs.get(id)
+        new_doc = dict(old_doc) if old_doc is not None else {ID_KEY: id}
+        if old_doc is None and insert_doc is not None:
+            doc = {**insert_doc, **doc}
+        for key, value in doc.items():
+            _set_path(new_doc, key, _to_stored_value(value))
+        for key, index in self.indexes.items():
+            old_value = _index_value(old_doc.get(key)) if old_doc is not None else None
+            new_value = _index_value(new_doc.get(key))
+            if old_doc is not None and old_value == new_value:
+                continue
+            if old_doc is not None:
+                index.get(old_value, set()).discard(id)
+            index.setdefault(new_value, set()).add(id)
+        self.docs[id] = new_doc
+
+    def find(self, query):
+        ids = self.candidate_ids(query)
+        if ids is None:
+            # Documents can be added while the results are consumed
+            candidates = list(self.docs.values())
+        else:
+            candidates = (self.docs[id] for id in ids if id in self.docs)
+        return (doc for doc in candidates if _matches(doc, query))
+
+    def candidate_ids(self, query):
+        """
+        Returns the IDs of documents which may match the
+        query, or `None` if all documents must be scanned.
+        """
+        for key, condition in query.items():
+            if isinstance(condition, dict):
+                if '$in' not in condition:
+                    continue
+                values = condition['$in']
+            else:
+                values = [condition]
+            values = [_index_value(_to_stored_value(x)) for x in values]
+            if key == ID_KEY:
+                return values
+            if key in self.indexes:
+                index = self.indexes[key]
+                ids = []
+                for value in values:
+                    ids.extend(index.get(value, ()))
+                return ids
+        return None
+
+
+_QUERY_OPERATORS = {
+    '$in': lambda value, arg: value in arg,
+    '$nin': lambda value, arg: value not in arg,
+    '$ne': lambda value, arg: value != arg,
+    '$gt': lambda value, arg: value is not None and value > arg,
+    '$gte': lambda value, arg: value is not None and value >= arg,
+    '$lt': lambda value, arg: value is not None and value < arg,
+    '$lte': lambda value, arg: value is not None and value <= arg,
+}
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        value = _get_path(doc, key)
+        if isinstance(condition, dict):
+            for op, arg in condition.items():
+                if op not in _QUERY_OPERATORS:
+                    raise NotImplementedError(f'Unsupported query operator: {op}')
+                if not _QUERY_OPERATORS[op](value, _to_stored_value(arg)):
+                    return False
+        elif value != _to_stored_value(condition):
+            return False
+    return True
+
+
+def _get_path(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _evaluate(doc, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _get_path(doc, expression[1:])
+    if isinstance(expression, dict):
+        return {key: _evaluate(doc, value) for key, value in expression.items()}
+    return expression
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _push(values, x):
+    values.append(x)
+    return values
+
+
+def _add_to_set(values, x):
+    values.setdefault(_index_value(x), x)
+    return values
+
+
+# Accumulators of `$group` as (initial value, add, result) functions
+_ACCUMULATORS = {
+    '$sum': (lambda: 0, lambda acc, x: acc + x if _is_number(x) else acc, lambda acc: acc),
+    '$avg': (
+        lambda: (0.0, 0),
+        lambda acc, x: (acc[0] + x, acc[1] + 1) if _is_number(x) else acc,
+        lambda acc: acc[0] / acc[1] if acc[1] > 0 else None
+    ),
+    '$min': (lambda: None, lambda acc, x: x if x is not None and (acc is None or x < acc) else acc, lambda acc: acc),
+    '$max': (lambda: None, lambda acc, x: x if x is not None and (acc is None or x > acc) else acc, lambda acc: acc),
+    '$push': (list, _push, lambda acc: acc),
+    '$addToSet': (dict, _add_to_set, lambda acc: list(acc.values())),
+}
+
+
+def _group(docs, spec):
+    groups = {}
+    for doc in docs:
+        group_id = _evaluate(doc, spec[ID_KEY])
+        key = _index_value(tuple(sorted(group_id.items())) if isinstance(group_id, dict) else group_id)
+        group = groups.get(key)
+        if group is None:
+            group = {ID_KEY: group_id}
+            for name, accumulator in spec.items():
+                if name != ID_KEY:
+                    (op, _), = accumulator.items()
+                    group[name] = _ACCUMULATORS[op][0]()
+            groups[key] = group
+        for name, accumulator in spec.items():
+            if name == ID_KEY:
+                continue
+            (op, expression), = accumulator.items()
+            if op not in _ACCUMULATORS:
+                raise NotImplementedError(f'Unsupported group accumulator: {op}')
+            group[name] = _ACCUMULATORS[op][1](group[name], _evaluate(doc, expression))
+    results = []
+    for group in groups.values():
+        for name, accumulator in spec.items():
+            if name != ID_KEY:
+                (op, _), = accumulator.items()
+                group[name] = _ACCUMULATORS[op][2](group[name])
+        results.append(group)
+    return results
+
+
+def _project(doc, projection):
+    if projection is None:
+        return dict(doc)
+    if not isinstance(projection, dict):
+        projection = {key: 1 for key in projection}
+    include_id = bool(projection.get(ID_KEY, 1))
+    included = [key for key, value in projection.items() if bool(value) and key != ID_KEY]
+    if bool(included):
+        result = {key: doc[key] for key in included if key in doc}
+    else:
+        excluded = set(key for key, value in projection.items() if not bool(value))
+        result = {key: value for key, value in doc.items() if key not in excluded}
+    if include_id and ID_KEY in doc:
+        result[ID_KEY] = doc[ID_KEY]
+    else:
+        result.pop(ID_KEY, None)
+    return result
+
+
+def _set_path(doc, key, value):
+    # Nested documents are copied, as they may be
+    # shared with documents returned by queries
+    path = key.split('.')
+    for part in path[:-1]:
+        nested = doc.get(part)
+        nested = dict(nested) if isinstance(nested, dict) else {}
+        doc[part] = nested
+        doc = nested
+    doc[path[-1]] = value
+
+
+def _index_value(value):
+    # Lists are not hashable
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _to_stored_value(value):
+    # Mimic BSON, which stores naive UTC datetimes
+    # with millisecond precision
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, (list, tuple)):
+        return [_to_stored_value(x) for x in value]
+    if isinstance(value, dict):
+        return {k: _to_stored_value(v) for k, v in value.items()}
+    return value
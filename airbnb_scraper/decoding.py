@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+JSON decoding of API response bodies.
+
+Bodies are decoded from bytes, with any text around the outermost
+object ignored. orjson is used when installed, otherwise the standard
+library decoder.
+
+`load_paths()` can decode only the sub-trees which are used. With
+`stream=True` and ijson installed, the body is parsed as a stream of
+events and objects are only built for the selected sub-trees, which
+lowers peak memory for large responses at some CPU cost. Otherwise the
+whole body is decoded.
+
+A path is a tuple of object keys and array indexes, where `'*'` matches
+any key or index, for example `('explore_tabs', 0, 'sections', '*')`.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+WILDCARD = '*'
+# Bytes parsed per batch of stream events
+STREAM_BUFFER_SIZE = 4096
+# Path match results
+_FULL = 2
+_PARTIAL = 1
+_START_EVENTS = ('start_map', 'start_array')
+_END_EVENTS = ('end_map', 'end_array')
+
+
+def trim_json(body):
+    """Returns the bytes from the first `{` to the last `}`."""
+    start = body.find(b'{')
+    end = body.rfind(b'}')
+    if start < 0 or end < start:
+        return body
+    if start == 0 and end == len(body) - 1:
+        return body
+    return body[start:end + 1]
+
+
+def loads(body):
+    """Decodes the JSON object in a response body."""
+    body = trim_json(body)
+    try:
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
+    except ValueError:
+        # Data after the object
+        data, _ = json.JSONDecoder().raw_decode(body.decode('utf-8'))
+        return data
+
+
+def load_paths(body, paths, stream=False):
+    """
+    Decodes a response body for reading the values at
+    the given paths.
+
+    Returns:
+        When streaming, an object with the structure of
+        the body which contains only the values at the
+        paths and the containers leading to them.
+        Otherwise the whole decoded body.
+    """
+    if stream and ijson is not None:
+        return _stream_paths(trim_json(body), paths)
+    return loads(body)
+
+
+def _match(location, paths):
+    result = None
+    for path in paths:
+        if len(location) > len(path):
+            continue
+        if all(p == WILDCARD or p == x for p, x in zip(path, location)):
+            if len(location) == len(path):
+                return _FULL
+            result = _PARTIAL
+    return result
+
+
+def _add(container, key, value):
+    if isinstance(container, list):
+        container.append(value)
+    else:
+        container[key] = value
+
+
+class _Frame:
+
+    __slots__ = ('container', 'location', 'key', 'count')
+
+    def __init__(self, container, location):
+        self.container = container
+        self.location = location
+        self.key = None
+        self.count = 0
+
+
+def _stream_paths(body, paths):
+    root = None
+    stack = []
+    skip_depth = 0
+    builder = None
+    builder_depth = 0
+    builder_key = None
+
+    try:
+        for _, event, value in ijson.parse(body, use_float=True, buf_size=STREAM_BUFFER_SIZE):
+            if skip_depth > 0:
+                if event in _START_EVENTS:
+                    skip_depth += 1
+                elif event in _END_EVENTS:
+                    skip_depth -= 1
+                continue
+
+            if builder is not None:
+                builder.event(event, value)
+                if event in _START_EVENTS:
+                    builder_depth += 1
+                elif event in _END_EVENTS:
+                    builder_depth -= 1
+                if builder_depth == 0:
+                    _add(stack[-1].container, builder_key, builder.value)
+                    builder = None
+                continue
+
+            if event == 'map_key':
+                stack[-1].key = value
+                continue
+            if event in _END_EVENTS:
+                stack.pop()
+                continue
+
+            # Start of a value
+            if bool(stack):
+                parent = stack[-1]
+                if isinstance(parent.container, list):
+                    key = parent.count
+                    parent.count += 1
+                else:
+                    key = parent.key
+                location = parent.location + (key,)
+            else:
+                key = None
+                location = ()
+            match = _match(location, paths)
+            is_container = event in _START_EVENTS
+
+            if match == _FULL:
+                if not is_container:
+                    if bool(stack):
+                        _add(stack[-1].container, key, value)
+                    else:
+                        root = value
+                    continue
+                if not bool(stack):
+                    # The whole body is selected
+                    return loads(body)
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                builder_depth = 1
+                builder_key = key
+            elif match == _PARTIAL and is_container:
+                container = {} if event == 'start_map' else []
+                if bool(stack):
+                    _add(stack[-1].container, key, container)
+                else:
+                    root = container
+                stack.append(_Frame(container, location))
+            elif is_container:
+                skip_depth = 1
+    except ijson.JSONError:
+        # Data after the object
+        if root is None or bool(stack):
+            raise
+    return root
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+URLs of the Airbnb endpoints, shared by the spider and the
+middlewares which handle its requests.
+"""
+
+EXPLORE_BASE_URL = 'https://www.airbnb.com/api/v2/explore_tabs'
+LISTING_BASE_URL = 'https://www.airbnb.com/rooms/'
+CALENDAR_BASE_URL = 'https://www.airbnb.com/api/v2/homes_pdp_availability_calendar'
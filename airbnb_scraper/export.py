@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned file export of items, used by `AirbnbExportPipeline`.
+
+Rows are written under `<collection>/city=<city>/year=<year>/month=<month>/`,
+the partition layout read by pyarrow, Spark and DuckDB. Listings are
+partitioned by the month of the crawl, months and days by their own
+month. Days embedded in months are exported as day rows. Partition
+keys are only stored in the directory names, so the `year` and `month`
+of months are read back from the partitions.
+
+Each partition buffers at most `row_group_size` rows before they are
+written, and a new file is started every `file_rows` rows. Files are
+written under a hidden name and renamed when complete, so readers
+never see partial files.
+
+Parquet files require pyarrow. Date fields and the fields in
+`FIELD_TYPES` have fixed Arrow types, so that a file in which they
+are always null has the same schema as the others. The types of other
+fields are inferred from the rows and widened as new values are seen.
+A file is rotated when its schema has to change.
+
+Dates are exported as naive UTC datetimes, as in MongoDB.
+"""
+
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+from airbnb_scraper.items import AirbnbListingCalendarMonth, AirbnbListingCalendarDay, ID_KEY, ITEM_CLASSES, naive_utc_datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('parquet', 'jsonl')
+PARTITION_KEYS = ('city', 'year', 'month')
+# Keys of month documents copied to their embedded day rows
+EMBEDDED_DAY_ROW_KEYS = ['listing_id', 'time_zone', 'currency']
+# Arrow type names of fields which can be null in a whole row group
+FIELD_TYPES = {
+    'float64': [
+        'price', 'rate', 'rate_with_service_fee', 'lat', 'lng', 'bathrooms', 'star_rating', 'avg_rating',
+        'weekly_price_factor', 'monthly_price_factor', 'availability', 'cancellation_rate', 'block_rate',
+        'revenue', 'partial_revenue', 'future_revenue', 'average_price', 'median_price', 'lowest_price',
+        'highest_price',
+    ],
+    'int64': [
+        'host_id', 'bedrooms', 'beds', 'person_capacity', 'picture_count', 'reviews_count', 'min_nights',
+        'max_nights', 'property_type_id', 'cancellations',
+    ],
+    'bool': ['available', 'blocked', 'is_superhost', 'is_new_listing', 'is_business_travel_ready'],
+    'string': ['listing_id', 'month_id', 'time_zone', 'currency', 'source_hash'],
+}
+
+
+def partition_name(value):
+    """Returns a value as a lowercase partition directory name."""
+    name = re.sub(r'[^a-z0-9]+', '-', str(value or '').lower()).strip('-')
+    return name or 'all'
+
+
+def to_row(doc):
+    row = {}
+    for key, value in doc.items():
+        if isinstance(value, datetime):
+            value = naive_utc_datetime(value)
+        row[key] = value
+    return row
+
+
+def item_rows(item):
+    """
+    Returns the export rows of an item, as a list of
+    `(collection_name, date, row)` tuples.
+    """
+    doc = item.serialize()
+    if isinstance(item, AirbnbListingCalendarMonth):
+        days = doc.pop('days', None)
+        rows = [(item._collection_name, datetime(doc['year'], doc['month'], 1), to_row(doc))]
+        if bool(days):
+            rows.extend(
+                (AirbnbListingCalendarDay._collection_name, row['date'], row)
+                for row in embedded_day_rows(doc, days)
+            )
+        return rows
+    if isinstance(item, AirbnbListingCalendarDay):
+        return [(item._collection_name, naive_utc_datetime(doc['date']), to_row(doc))]
+    return [(item._collection_name, naive_utc_datetime(doc.get('update_date')), to_row(doc))]
+
+
+def embedded_day_rows(month_doc, days):
+    """Returns rows for the serialized embedded days of a month document."""
+    rows = []
+    for i, date in enumerate(days['date']):
+        row = {
+            ID_KEY: f'{month_doc["listing_id"]}/{AirbnbListingCalendarDay._item_type}/{date.strftime("%Y-%m-%d")}',
+            'item_type': AirbnbListingCalendarDay._item_type,
+            'version': month_doc.get('version'),
+            'month_id': month_doc[ID_KEY],
+        }
+        for key in EMBEDDED_DAY_ROW_KEYS:
+            row[key] = month_doc.get(key)
+        for key, values in days.items():
+            row[key] = values[i]
+        rows.append(to_row(row))
+    return rows
+
+
+class PartitionWriter:
+    """
+    Buffers the rows of one partition and writes them
+    to a sequence of files.
+    """
+
+    extension = ''
+
+    def __init__(self, directory, file_prefix, row_group_size=10000, file_rows=1000000):
+        self.directory = Path(directory)
+        self.file_prefix = file_prefix
+        self.row_group_size = row_group_size
+        self.file_rows = file_rows
+        self.rows = []
+        self.file_count = 0
+        self.file_row_count = 0
+        self.path = None
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows.
+
+        Returns:
+            The number of rows written.
+        """
+        rows = self.rows
+        if not bool(rows):
+            return 0
+        self.rows = []
+        if self.path is not None and self.file_row_count >= self.file_rows:
+            self.close_file()
+        self.write(rows)
+        self.file_row_count += len(rows)
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        self.close_file()
+
+    def temp_path(self):
+        return self.path.with_name('.' + self.path.name)
+
+    def open_file(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f'{self.file_prefix}-{self.file_count:05d}{self.extension}'
+        self.file_count += 1
+        self.file_row_count = 0
+
+    def close_file(self):
+        if self.path is None:
+            return
+        self.temp_path().replace(self.path)
+        self.path = None
+
+    def write(self, rows):
+        raise NotImplementedError()
+
+
+class JsonLinesPartitionWriter(PartitionWriter):
+
+    extension = '.jsonl'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file = None
+
+    def write(self, rows):
+        if self.path is None:
+            self.open_file()
+            self.file = self.temp_path().open('w', encoding='utf-8')
+        for row in rows:
+            self.file.write(json.dumps(row, default=json_default, ensure_ascii=False))
+            self.file.write('\n')
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        super().close_file()
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Value is not JSON serializable: {type(value).__name__}')
+
+
+class ParquetPartitionWriter(PartitionWriter):
+    """
+    Writes each flush as a Parquet row group. `schemas` is
+    shared by the writers of an item type, and holds its
+    current Arrow schema.
+    """
+
+    extension = '.parquet'
+
+    def __init__(self, *args, schemas=None, schema_key=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.schemas = schemas if schemas is not None else {}
+        self.schema_key = schema_key
+        self.writer = None
+
+    def write(self, rows):
+        # Rows can have different keys, while `from_pylist()`
+        # takes the columns from the first row
+        keys = dict.fromkeys(key for row in rows for key in row)
+        table = pyarrow.Table.from_pydict({key: [row.get(key) for row in rows] for key in keys})
+        known_schema = self.schemas.get(self.schema_key)
+        schema = table.schema if known_schema is None else unify_schemas(known_schema, table.schema)
+        self.schemas[self.schema_key] = schema
+        table = conform_table(table, schema)
+
+        if self.writer is not None and not self.writer.schema.equals(schema):
+            self.close_file()
+        if self.path is None:
+            self.open_file()
+            self.writer = pyarrow.parquet.ParquetWriter(str(self.temp_path()), schema)
+        self.writer.write_table(table)
+
+    def close_file(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        super().close_file()
+
+
+def unify_schemas(a, b):
+    """Returns a schema with the columns of both schemas, widening types."""
+    return pyarrow.unify_schemas([a, b], promote_options='permissive')
+
+
+def declared_schema(item_cls):
+    """Returns the Arrow schema of the fields of an item with fixed types."""
+    types = {}
+    for type_name, keys in FIELD_TYPES.items():
+        for key in keys:
+            types[key] = pyarrow.type_for_alias(type_name)
+    for key in item_cls.get_date_keys():
+        types[key] = pyarrow.timestamp('us')
+    types['errors'] = pyarrow.list_(pyarrow.string())
+    return pyarrow.schema([
+        (key, types[key]) for key in item_cls.fields
+        if key in types and key not in PARTITION_KEYS
+    ])
+
+
+def conform_table(table, schema):
+    """Returns a table with the columns and types of a schema."""
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pyarrow.nulls(table.num_rows, type=field.type))
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+
+class PartitionedExporter:
+    """
+    Routes item rows to partition writers. Writers are
+    kept open until `close()`.
+    """
+
+    def __init__(self, base_dir, city='', file_format='parquet', row_group_size=10000, file_rows=1000000,
+                 file_prefix='part'):
+        if file_format not in FORMATS:
+            raise ValueError(f'Unknown export format: {file_format}')
+        if file_format == 'parquet' and pyarrow is None:
+            raise ImportError('Parquet export requires pyarrow')
+        self.base_dir = Path(base_dir)
+        self.city = partition_name(city)
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.file_rows = file_rows
+        self.file_prefix = file_prefix
+        self.writers = {}
+        self.schemas = {}
+
+    def export_item(self, item):
+        """
+        Adds the rows of an item.
+
+        Returns:
+            The number of rows added.
+        """
+        rows = item_rows(item)
+        for collection_name, date, row in rows:
+            for key in PARTITION_KEYS:
+                row.pop(key, None)
+            self.get_writer(collection_name, date).add(row)
+        return len(rows)
+
+    def get_writer(self, collection_name, date):
+        key = (collection_name, date.year, date.month)
+        writer = self.writers.get(key)
+        if writer is None:
+            directory = (
+                self.base_dir / collection_name / f'city={self.city}' /
+                f'year={date.year:04d}' / f'month={date.month:02d}'
+            )
+            kwargs = dict(row_group_size=self.row_group_size, file_rows=self.file_rows)
+            if self.file_format == 'parquet':
+                if collection_name not in self.schemas:
+                    item_cls = next(cls for cls in ITEM_CLASSES if cls._collection_name == collection_name)
+                    self.schemas[collection_name] = declared_schema(item_cls)
+                writer = ParquetPartitionWriter(
+                    directory, self.file_prefix, schemas=self.schemas, schema_key=collection_name, **kwargs
+                )
+            else:
+                writer = JsonLinesPartitionWriter(directory, self.file_prefix, **kwargs)
+            self.writers[key] = writer
+        return writer
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+Crawl instrumentation and profiling extensions.
+
+Instrumentation is enabled with `INSTRUMENTATION_ENABLED`.
+
+`AirbnbInstrumentation` records:
+
+- Wall and CPU time of the spider callbacks in
+  `INSTRUMENTATION_CALLBACKS`. Callbacks are generators, so their
+  time is the time spent producing each output, and includes the
+  storage calls they make. CPU time is the time of the reactor thread.
+- Calls and latency of the item storage operations, per operation and
+  collection (see `AirbnbStorage.observe()`), including writes made by
+  pipelines on other threads.
+- Download latency per callback.
+- Items scraped and items per second per item type.
+- Pipeline and scheduler queue depth, sampled every
+  `INSTRUMENTATION_INTERVAL` seconds.
+
+Totals are written to the crawl stats under `airbnb/callback/`,
+`airbnb/storage/`, `airbnb/download/`, `airbnb/items/` and `airbnb/queue/`.
+With `INSTRUMENTATION_PORT`, the metrics and the numeric crawl stats
+are served in the Prometheus text format on
+`http://<INSTRUMENTATION_HOST>:<port>/metrics` while the crawl runs.
+
+`AirbnbProfiling` profiles crawls run with `-a profile=cpu` or
+`-a profile=mem` (see `airbnb_scraper.profiling`).
+"""
+
+import arrow
+import bisect
+import inspect
+import threading
+import time
+import types
+from pathlib import Path
+from twisted.internet import error, reactor, task
+from twisted.web import resource, server
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from airbnb_scraper import profiling
+from airbnb_scraper.db import AirbnbStorage
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Counts of observed values per bucket, as in Prometheus."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative_counts(self):
+        """Returns `(upper_bound, count)` pairs, ending with `+Inf`."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class CallbackTiming:
+
+    def __init__(self):
+        self.wall = Histogram()
+        self.cpu_seconds = 0.0
+
+
+class CrawlMetrics:
+    """
+    Metrics of a crawl. Storage operations are recorded from
+    pipeline threads, so all access holds `lock`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.storage = {}
+        self.downloads = {}
+        self.items = {}
+        self.item_rates = {}
+        self.queues = {}
+
+    def add_callback(self, name, wall_seconds, cpu_seconds):
+        with self.lock:
+            timing = self.callbacks.get(name)
+            if timing is None:
+                timing = self.callbacks[name] = CallbackTiming()
+            timing.wall.observe(wall_seconds)
+            timing.cpu_seconds += cpu_seconds
+
+    def add_storage_operation(self, operation, collection_name, seconds):
+        with self.lock:
+            self.storage.setdefault((operation, collection_name), Histogram()).observe(seconds)
+
+    def add_download(self, callback, seconds):
+        with self.lock:
+            self.downloads.setdefault(callback, Histogram()).observe(seconds)
+
+    def add_item(self, item_type):
+        with self.lock:
+            self.items[item_type] = self.items.get(item_type, 0) + 1
+
+    def stats(self):
+        """Returns the totals as a dictionary of crawl stats."""
+        values = {}
+        with self.lock:
+            for name, timing in self.callbacks.items():
+                values[f'airbnb/callback/{name}/calls'] = timing.wall.count
+                values[f'airbnb/callback/{name}/wall_seconds'] = round(timing.wall.sum, 6)
+                values[f'airbnb/callback/{name}/cpu_seconds'] = round(timing.cpu_seconds, 6)
+                values[f'airbnb/callback/{name}/wall_seconds_max'] = round(timing.wall.max, 6)
+            operations = {}
+            for (operation, _), histogram in self.storage.items():
+                calls, seconds, max_seconds = operations.get(operation, (0, 0.0, 0.0))
+                operations[operation] = (
+                    calls + histogram.count, seconds + histogram.sum, max(max_seconds, histogram.max)
+                )
+            for operation, (calls, seconds, max_seconds) in operations.items():
+                values[f'airbnb/storage/{operation}/calls'] = calls
+                values[f'airbnb/storage/{operation}/seconds'] = round(seconds, 6)
+                values[f'airbnb/storage/{operation}/seconds_max'] = round(max_seconds, 6)
+            for callback, histogram in self.downloads.items():
+                values[f'airbnb/download/{callback}/responses'] = histogram.count
+                values[f'airbnb/download/{callback}/seconds'] = round(histogram.sum, 6)
+            for item_type, count in self.items.items():
+                values[f'airbnb/items/{item_type}/scraped'] = count
+        return values
+
+    def to_prometheus(self, crawl_stats=None):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+
+        def header(name, metric_type, description):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        def histogram_lines(name, labels, histogram):
+            for bound, count in histogram.cumulative_counts():
+                lines.append(sample_line(f'{name}_bucket', dict(labels, le=format_value(bound)), count))
+            lines.append(sample_line(f'{name}_sum', labels, histogram.sum))
+            lines.append(sample_line(f'{name}_count', labels, histogram.count))
+
+        with self.lock:
+            header('airbnb_callback_seconds', 'histogram', 'Wall time of spider callbacks.')
+            for name, timing in sorted(self.callbacks.items()):
+                histogram_lines('airbnb_callback_seconds', {'callback': name}, timing.wall)
+            header('airbnb_callback_cpu_seconds_total', 'counter', 'CPU time of spider callbacks.')
+            for name, timing in sorted(self.callbacks.items()):
+                lines.append(sample_line('airbnb_callback_cpu_seconds_total', {'callback': name}, timing.cpu_seconds))
+
+            header('airbnb_storage_operation_seconds', 'histogram', 'Latency of item storage operations.')
+            for (operation, collection_name), histogram in sorted(self.storage.items()):
+                labels = {'operation': operation, 'collection': collection_name}
+                histogram_lines('airbnb_storage_operation_seconds', labels, histogram)
+
+            header('airbnb_download_seconds', 'histogram', 'Download latency per callback.')
+            for callback, histogram in sorted(self.downloads.items()):
+                histogram_lines('airbnb_download_seconds', {'callback': callback}, histogram)
+
+            header('airbnb_items_scraped_total', 'counter', 'Items scraped per item type.')
+            for item_type, count in sorted(self.items.items()):
+                lines.append(sample_line('airbnb_items_scraped_total', {'item_type': item_type}, count))
+            header('airbnb_items_per_second', 'gauge', 'Items scraped per second in the last interval.')
+            for item_type, rate in sorted(self.item_rates.items()):
+                lines.append(sample_line('airbnb_items_per_second', {'item_type': item_type}, rate))
+
+            header('airbnb_queue_size', 'gauge', 'Sampled size of crawl queues.')
+            for queue, size in sorted(self.queues.items()):
+                lines.append(sample_line('airbnb_queue_size', {'queue': queue}, size))
+
+        if bool(crawl_stats):
+            header('scrapy_stat', 'gauge', 'Numeric crawl stats.')
+            for key, value in sorted(crawl_stats.items()):
+                if isinstance(value, (int, float)):
+                    lines.append(sample_line('scrapy_stat', {'name': key}, value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def sample_line(name, labels, value):
+    label_text = ','.join(f'{key}="{escape_label(x)}"' for key, x in labels.items())
+    return f'{name}{{{label_text}}} {format_value(value)}'
+
+
+class MetricsResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, instrumentation):
+        super().__init__()
+        self.instrumentation = instrumentation
+
+    def render_GET(self, request):
+        if request.path != b'/metrics':
+            request.setResponseCode(404)
+            return b'Not found\n'
+        request.setHeader(b'Content-Type', CONTENT_TYPE.encode('ascii'))
+        return self.instrumentation.render_metrics().encode('utf-8')
+
+
+class AirbnbInstrumentation:
+    """
+    Extension recording crawl performance metrics into
+    the crawl stats and serving them to Prometheus.
+    """
+
+    def __init__(self, crawler, callbacks=('parse_explore', 'parse_calendar'), interval=5.0, host='127.0.0.1',
+                 port=0):
+        self.crawler = crawler
+        self.callbacks = list(callbacks)
+        self.interval = interval
+        self.host = host
+        self.port = port
+        self.metrics = CrawlMetrics()
+        self.storage = None
+        self.listening_port = None
+        self.sample_loop = None
+        self.open_date = None
+        self.last_sample = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('INSTRUMENTATION_ENABLED'):
+            raise NotConfigured()
+        extension = cls(
+            crawler,
+            callbacks=settings.getlist('INSTRUMENTATION_CALLBACKS', ['parse_explore', 'parse_calendar']),
+            interval=settings.getfloat('INSTRUMENTATION_INTERVAL', 5.0),
+            host=settings.get('INSTRUMENTATION_HOST', '127.0.0.1'),
+            port=settings.getint('INSTRUMENTATION_PORT', 0)
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        return extension
+
+    def spider_opened(self, spider):
+        # Requests are created by the spider after it is opened,
+        # so they reference the timed callbacks
+        for name in self.callbacks:
+            method = getattr(spider, name, None)
+            if method is not None:
+                setattr(spider, name, self.timed_callback(spider, name, method))
+
+        self.storage = AirbnbStorage.shared()
+        self.storage.observe(self.metrics.add_storage_operation)
+
+        self.open_date = time.monotonic()
+        self.last_sample = (self.open_date, {})
+        if self.interval > 0:
+            self.sample_loop = task.LoopingCall(self.sample, spider)
+            self.sample_loop.start(self.interval, now=False)
+
+        if self.port > 0:
+            try:
+                self.listening_port = reactor.listenTCP(
+                    self.port, server.Site(MetricsResource(self)), interface=self.host
+                )
+            except error.CannotListenError as e:
+                spider.logger.warning(f'Cannot serve crawl metrics: {e}')
+            else:
+                spider.logger.info(f'Serving crawl metrics on http://{self.host}:{self.port}/metrics')
+
+    def spider_closed(self, spider):
+        if self.sample_loop is not None and self.sample_loop.running:
+            self.sample_loop.stop()
+        self.sample_loop = None
+        self.sample(spider)
+
+        seconds = time.monotonic() - self.open_date
+        if seconds > 0:
+            for item_type, count in self.metrics.items.items():
+                self.crawler.stats.set_value(
+                    f'airbnb/items/{item_type}/per_second', round(count / seconds, 3), spider=spider
+                )
+
+        if self.storage is not None:
+            self.storage.observe(None)
+            self.storage = None
+        for name in self.callbacks:
+            spider.__dict__.pop(name, None)
+        if self.listening_port is not None:
+            self.listening_port.stopListening()
+            self.listening_port = None
+
+    def item_scraped(self, item, spider):
+        item_type = getattr(item, '_item_type', None) or type(item).__name__
+        self.metrics.add_item(item_type)
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is None:
+            return
+        callback = getattr(request.callback, '__name__', None) or 'parse'
+        self.metrics.add_download(callback, latency)
+
+    def timed_callback(self, spider, name, method):
+        """
+        Returns a method of the spider which times a callback.
+        It has the name of the callback, so that requests which
+        reference it can still be serialized.
+        """
+        metrics = self.metrics
+
+        def timed_results(results, wall_seconds, cpu_seconds):
+            try:
+                while True:
+                    wall_start = time.perf_counter()
+                    cpu_start = time.thread_time()
+                    try:
+                        result = next(results)
+                    except StopIteration:
+                        return
+                    finally:
+                        wall_seconds += time.perf_counter() - wall_start
+                        cpu_seconds += time.thread_time() - cpu_start
+                    yield result
+            finally:
+                metrics.add_callback(name, wall_seconds, cpu_seconds)
+
+        def callback(spider, *args, **kwargs):
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            results = method(*args, **kwargs)
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.thread_time() - cpu_start
+            if inspect.isgenerator(results):
+                return timed_results(results, wall_seconds, cpu_seconds)
+            metrics.add_callback(name, wall_seconds, cpu_seconds)
+            return results
+
+        callback.__name__ = name
+        return types.MethodType(callback, spider)
+
+    def sample(self, spider):
+        """Samples queue sizes and item rates, and updates the crawl stats."""
+        now = time.monotonic()
+        queues = self.queue_sizes()
+        last_date, last_items = self.last_sample
+        with self.metrics.lock:
+            items = dict(self.metrics.items)
+            self.metrics.queues = queues
+            if now > last_date:
+                self.metrics.item_rates = {
+                    item_type: round((count - last_items.get(item_type, 0)) / (now - last_date), 3)
+                    for item_type, count in items.items()
+                }
+            item_rates = dict(self.metrics.item_rates)
+        self.last_sample = (now, items)
+
+        stats = self.crawler.stats
+        for key, value in self.metrics.stats().items():
+            stats.set_value(key, value, spider=spider)
+        for queue, size in queues.items():
+            stats.max_value(f'airbnb/queue/{queue}_max', size, spider=spider)
+        for item_type, rate in item_rates.items():
+            stats.max_value(f'airbnb/items/{item_type}/per_second_max', rate, spider=spider)
+
+    def queue_sizes(self):
+        """Returns the sizes of the engine queues which can be read."""
+        sizes = {}
+        engine = self.crawler.engine
+        if engine is None:
+            return sizes
+        scraper_slot = getattr(engine.scraper, 'slot', None)
+        if scraper_slot is not None:
+            # Items in the pipelines, and responses waiting for callbacks
+            sizes['pipeline_items'] = scraper_slot.itemproc_size
+            sizes['scraper_responses'] = len(scraper_slot.queue) + len(scraper_slot.active)
+        sizes['downloader_active'] = len(engine.downloader.active)
+        engine_slot = getattr(engine, 'slot', None)
+        if engine_slot is not None and engine_slot.scheduler is not None:
+            sizes['scheduler_requests'] = len(engine_slot.scheduler)
+        return sizes
+
+    def render_metrics(self):
+        return self.metrics.to_prometheus(crawl_stats=self.crawler.stats.get_stats())
+
+
+class AirbnbProfiling:
+    """
+    Extension profiling crawls run with `-a profile=cpu` or
+    `-a profile=mem` (see `airbnb_scraper.profiling`).
+
+    The callbacks in `PROFILE_CALLBACKS` are profiled by name,
+    and all item pipelines together as `process_item`. Profiles
+    are written at spider close to a directory per crawl under
+    `PROFILE_DIR`.
+    """
+
+    def __init__(self, crawler, profile_dir=None, callbacks=('parse_explore', 'parse_calendar'), top=25,
+                 snapshot_interval=100):
+        from airbnb_scraper.pipelines import TEMP_DIR
+
+        self.crawler = crawler
+        self.profile_dir = Path(profile_dir or TEMP_DIR / 'profiles')
+        self.callbacks = list(callbacks)
+        self.top = top
+        self.snapshot_interval = snapshot_interval
+        self.profiler = None
+        self.item_processor = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        extension = cls(
+            crawler,
+            profile_dir=settings.get('PROFILE_DIR'),
+            callbacks=settings.getlist('PROFILE_CALLBACKS', ['parse_explore', 'parse_calendar']),
+            top=settings.getint('PROFILE_TOP', 25),
+            snapshot_interval=settings.getint('PROFILE_SNAPSHOT_INTERVAL', 100)
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        # Spider arguments are only known once the spider is created
+        mode = getattr(spider, 'profile', '')
+        if not bool(mode):
+            return
+        request_date = getattr(spider, 'request_date', None) or arrow.get()
+        directory = self.profile_dir / f'{spider.name}-{request_date.format("YYYYMMDDTHHmmss")}-{mode}'
+        self.profiler = profiling.create_profiler(
+            mode, directory, top=self.top, snapshot_interval=self.snapshot_interval
+        )
+        self.profiler.open()
+
+        for name in self.callbacks:
+            method = getattr(spider, name, None)
+            if method is not None:
+                setattr(spider, name, self.profiler.wrap_callback(spider, name, method))
+
+        # Pipelines are called through the item processor of the scraper
+        scraper = getattr(self.crawler.engine, 'scraper', None)
+        self.item_processor = getattr(scraper, 'itemproc', None)
+        if self.item_processor is not None:
+            self.item_processor.process_item = self.profiler.wrap_function(
+                'process_item', self.item_processor.process_item
+            )
+        spider.logger.info(f'Profiling {mode} to {directory}')
+
+    def spider_closed(self, spider):
+        if self.profiler is None:
+            return
+        if self.item_processor is not None:
+            self.item_processor.__dict__.pop('process_item', None)
+            self.item_processor = None
+        for name in self.callbacks:
+            spider.__dict__.pop(name, None)
+
+        paths = self.profiler.close()
+        for name, calls in self.profiler.calls.items():
+            self.crawler.stats.set_value(f'airbnb/profile/{name}/calls', calls, spider=spider)
+        spider.logger.info(f'Wrote profiles: {", ".join(str(x) for x in paths)}')
+        self.profiler = None
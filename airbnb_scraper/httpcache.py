@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP cache of the explore and calendar API responses.
+
+`AirbnbCachePolicy` caches successful GET responses of the endpoints
+in `ENDPOINT_ITEM_CLASSES`. Other requests are never cached.
+`AirbnbCacheStorage` keys responses on the endpoint and its sorted
+query parameters, without those in `IGNORED_PARAMS`, and keeps them
+for the `_stale_interval` of the items built from the endpoint. A
+cached response is used as long as a crawl would consider its items
+fresh.
+
+Each response is stored in one compressed file, under
+`<HTTPCACHE_DIR>/<spider>/<endpoint>/`. Files are written under a
+hidden name and renamed when complete, so aborted crawls leave no
+partial entries. Expired entries are deleted when a spider opens.
+
+Responses are cached before `HttpCompressionMiddleware`, so they
+are stored with their original content encoding.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import time
+import urllib.parse
+from pathlib import Path
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+from airbnb_scraper.items import AirbnbListing, AirbnbListingCalendarMonth
+from airbnb_scraper.endpoints import EXPLORE_BASE_URL, CALENDAR_BASE_URL
+
+# Items built from the responses of each endpoint, whose stale
+# interval is the time to live of the cached responses
+ENDPOINT_ITEM_CLASSES = {
+    EXPLORE_BASE_URL: AirbnbListing,
+    CALENDAR_BASE_URL: AirbnbListingCalendarMonth,
+}
+# Query parameters which do not change the response
+IGNORED_PARAMS = {'key'}
+FILE_EXTENSION = '.json.gz'
+
+
+def endpoint_of(url):
+    """Returns the cached endpoint of a URL, or `None`."""
+    base_url = url.split('?', 1)[0]
+    return base_url if base_url in ENDPOINT_ITEM_CLASSES else None
+
+
+def endpoint_name(endpoint):
+    return endpoint.rstrip('/').rsplit('/', 1)[-1]
+
+
+def endpoint_ttl(endpoint):
+    """Returns the seconds for which responses of an endpoint are fresh."""
+    return ENDPOINT_ITEM_CLASSES[endpoint]._stale_interval
+
+
+def cache_key(url):
+    """
+    Returns the cache key of an endpoint URL: a digest
+    of its sorted query parameters, without those in
+    `IGNORED_PARAMS`.
+    """
+    base_url, _, query = url.partition('?')
+    params = sorted(
+        (key, value) for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True)
+        if key not in IGNORED_PARAMS
+    )
+    canonical = base_url + '?' + urllib.parse.urlencode(params)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class AirbnbCachePolicy:
+    """
+    Caches successful GET responses of the API endpoints.
+    Freshness is checked by `AirbnbCacheStorage`, which
+    only returns fresh responses.
+    """
+
+    def __init__(self, settings):
+        pass
+
+    def should_cache_request(self, request):
+        return request.method == 'GET' and endpoint_of(request.url) is not None
+
+    def should_cache_response(self, response, request):
+        return response.status == 200 and bool(response.body)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        return True
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        return True
+
+
+class AirbnbCacheStorage:
+    """
+    Stores responses in compressed files which expire
+    after the stale interval of their endpoint.
+    """
+
+    def __init__(self, settings):
+        self.cache_dir = Path(data_path(settings.get('HTTPCACHE_DIR', 'httpcache')))
+        self.compress_level = settings.getint('HTTPCACHE_COMPRESS_LEVEL', 6)
+        self.spider_dir = None
+
+    def open_spider(self, spider):
+        self.spider_dir = self.cache_dir / spider.name
+        removed = self.remove_expired()
+        spider.logger.debug(f'Using HTTP cache in {self.spider_dir}, removed {removed} expired responses')
+
+    def close_spider(self, spider):
+        pass
+
+    def get_path(self, endpoint, url):
+        key = cache_key(url)
+        return self.spider_dir / endpoint_name(endpoint) / key[:2] / (key + FILE_EXTENSION)
+
+    def retrieve_response(self, spider, request):
+        """Returns the cached response of a request if it is fresh, or `None`."""
+        endpoint = endpoint_of(request.url)
+        if endpoint is None:
+            return None
+        path = self.get_path(endpoint, request.url)
+        try:
+            if time.time() - path.stat().st_mtime > endpoint_ttl(endpoint):
+                return None
+            data = gzip.decompress(path.read_bytes())
+        except (OSError, EOFError):
+            return None
+
+        meta, _, body = data.partition(b'\n')
+        metadata = json.loads(meta)
+        url = metadata['url']
+        headers = Headers(headers_raw_to_dict(metadata['headers'].encode('latin-1')))
+        response_cls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return response_cls(url=url, headers=headers, status=metadata['status'], body=body)
+
+    def store_response(self, spider, request, response):
+        endpoint = endpoint_of(request.url)
+        if endpoint is None:
+            return
+        path = self.get_path(endpoint, request.url)
+        metadata = {
+            'url': response.url,
+            'request_url': request.url,
+            'status': response.status,
+            'headers': headers_dict_to_raw(response.headers).decode('latin-1'),
+        }
+        data = json.dumps(metadata).encode('utf-8') + b'\n' + response.body
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name('.' + path.name)
+        temp_path.write_bytes(gzip.compress(data, compresslevel=self.compress_level))
+        temp_path.replace(path)
+
+    def remove_expired(self):
+        """
+        Deletes the cached responses which are no longer fresh.
+
+        Returns:
+            The number of responses deleted.
+        """
+        removed = 0
+        now = time.time()
+        for endpoint in ENDPOINT_ITEM_CLASSES:
+            directory = self.spider_dir / endpoint_name(endpoint)
+            if not directory.is_dir():
+                continue
+            ttl = endpoint_ttl(endpoint)
+            for path in directory.glob('*/*' + FILE_EXTENSION):
+                try:
+                    if now - path.stat().st_mtime > ttl:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
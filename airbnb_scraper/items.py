@@ -9,14 +9,44 @@ import json
 import arrow
 import math
 import scrapy
+from bisect import bisect_left
+from functools import lru_cache
+from pymongo import ASCENDING
 from scrapy.loader.processors import MapCompose, TakeFirst, Join
 from scrapy.exporters import BaseItemExporter
 from airbnb_scraper.settings import PROJECT_VERSION
-from datetime import datetime
+from airbnb_scraper import util
+from datetime import datetime, timezone
 
 ID_KEY = '_id'
 MISSING_VALUE_SENTINEL = object()
 BLOCKED_DAYS_FAR_THRESHOLD = 30
+# Per-day keys stored as parallel arrays in a month's `days`
+EMBEDDED_DAY_KEYS = [
+    'date',
+    'creation_date',
+    'update_date',
+    'price',
+    'available',
+    'blocked',
+    'last_available_seen_date',
+    'first_unavailable_seen_date',
+    'booking_date',
+    'cancellation_date',
+    'cancellations',
+]
+# Keys of embedded days which are stored once on the month
+EMBEDDED_DAY_MONTH_KEYS = ['listing_id', 'time_zone', 'currency']
+# Day keys set by booking inference
+INFERRED_DAY_KEYS = [
+    'month_id',
+    'blocked',
+    'last_available_seen_date',
+    'first_unavailable_seen_date',
+    'booking_date',
+    'cancellation_date',
+    'cancellations',
+]
 
 
 def date_serializer(x):
@@ -25,6 +55,78 @@ def date_serializer(x):
 def naive_date_serializer(x):
     return arrow.get(x).replace(tzinfo='UTC').datetime if bool(x) else None
 
+# Serializers of fields which hold dates
+DATE_SERIALIZERS = (date_serializer, naive_date_serializer)
+
+def to_date_value(x, default=None):
+    """Returns a date value as an `Arrow` object."""
+    if not bool(x):
+        return default
+    if isinstance(x, arrow.Arrow):
+        return x
+    return arrow.get(x)
+
+@lru_cache(maxsize=16384)
+def past_threshold(date, time_zone):
+    """
+    Returns the time after which a local date (as a naive
+    datetime) is considered to be in the past.
+    """
+    local_date = arrow.get(date).replace(tzinfo=time_zone)
+    return local_date.ceil('day').shift(hours=-2)
+
+def cached_flag(func):
+    """
+    Property which caches a derived day flag until one
+    of the keys in `_flag_keys` is set.
+    """
+    name = func.__name__
+
+    def getter(self):
+        flags = self._flags
+        if flags is None:
+            flags = {}
+            self._flags = flags
+        elif name in flags:
+            return flags[name]
+        value = func(self)
+        flags[name] = value
+        return value
+
+    getter.__doc__ = func.__doc__
+    return property(getter)
+
+def embedded_days_serializer(days):
+    # Nested values are not compared as dates when
+    # detecting changes, so store them as naive UTC
+    # datetimes, which is how they are loaded
+    doc = {}
+    for key, values in days.items():
+        serializer = AirbnbListingCalendarDay.fields[key].get('serializer')
+        if serializer is not None:
+            values = [naive_utc_datetime(serializer(x)) for x in values]
+        doc[key] = list(values)
+    return doc
+
+def naive_utc_datetime(x):
+    if isinstance(x, datetime) and x.tzinfo is not None:
+        return x.astimezone(timezone.utc).replace(tzinfo=None)
+    return x
+
+def get_changed_values(key, old, new):
+    """
+    Returns the values to set for a changed key. Changed
+    keys of a nested document are set with dotted keys,
+    so that unchanged nested values are not sent.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict) or not set(old).issubset(new):
+        return {key: new}
+    return {
+        f'{key}.{sub_key}': value
+        for sub_key, value in new.items()
+        if sub_key not in old or old[sub_key] != value
+    }
+
 def remove_unicode(value):
     return value.replace(u"\u201c", '').replace(u"\u201d", '').replace(u"\2764", '').replace(u"\ufe0f")
 
@@ -34,6 +136,8 @@ class AirbnbItem(scrapy.Item):
     _item_type = ''
     _collection_name = ''
     _stale_interval = math.inf
+    # Secondary indexes as lists of (key, direction) pairs
+    _indexes = []
 
     _id = scrapy.Field()
     item_type = scrapy.Field()
@@ -49,12 +153,31 @@ class AirbnbItem(scrapy.Item):
         self['version'] = PROJECT_VERSION
         # self['hash_value'] = ''
         self._persisted_values = _persisted_values or {}
+        self._embedded_date_strs = None
 
     def __repr__(self):
         type_str = type(self)._item_type or type(self).__name__
         id_str = self.get(ID_KEY)
         return f'{type_str}[{id_str}]'
 
+    def __setitem__(self, key, value):
+        # Parse dates once, when they are set
+        if bool(value) and not isinstance(value, arrow.Arrow) and key in type(self).get_date_keys():
+            value = arrow.get(value)
+        super().__setitem__(key, value)
+
+    @classmethod
+    def get_date_keys(cls):
+        """Returns the keys of fields which hold dates."""
+        date_keys = cls.__dict__.get('_date_keys')
+        if date_keys is None:
+            date_keys = frozenset(
+                key for key, field in cls.fields.items()
+                if field.get('serializer') in DATE_SERIALIZERS
+            )
+            cls._date_keys = date_keys
+        return date_keys
+
     @property
     def is_stale(self):
         now = arrow.get()
@@ -72,6 +195,12 @@ class AirbnbItem(scrapy.Item):
             item['update_date'] = now
         return item
 
+    @classmethod
+    def get_storage(cls):
+        """Returns the shared storage backend."""
+        from airbnb_scraper.db import AirbnbStorage
+        return AirbnbStorage.shared()
+
     @classmethod
     def get_collection(cls):
         """
@@ -79,20 +208,46 @@ class AirbnbItem(scrapy.Item):
         objects returned by this collection are
         not instances of the item. Use `with_db_entry()`
         to instantiate.
+
+        Only available with the MongoDB storage backend.
+        """
+        return cls.get_storage().db[cls._collection_name]
+
+    @classmethod
+    def ensure_indexes(cls, storage, background=False):
+        """
+        Creates the indexes declared in `_indexes`.
+        Existing indexes are left untouched.
+
+        Returns:
+            A list of index names.
         """
-        from airbnb_scraper.db import AirbnbMongoDB
-        client = AirbnbMongoDB.shared()
-        return client.db[cls._collection_name]
+        return [
+            storage.create_index(cls._collection_name, keys, background=background)
+            for keys in cls._indexes
+        ]
 
     @classmethod
     def load(cls, id):
-        matches = list(cls.get_collection().find({ID_KEY: id}))
-        if len(matches) == 0:
+        doc = cls.get_storage().load(cls._collection_name, id)
+        if doc is None:
             return None
-        elif len(matches) == 1:
-            return cls.with_db_entry(matches[0])
-        else:
-            raise Exception(f'Multiple objects found for id {id}')
+        return cls.with_db_entry(doc)
+
+    @classmethod
+    def load_many(cls, ids):
+        """
+        Loads items with the given IDs in a single query.
+
+        Returns:
+            A dictionary of items keyed by ID. IDs
+            without a database entry are omitted.
+        """
+        ids = list(ids)
+        if not bool(ids):
+            return {}
+        docs = cls.get_storage().load_many(cls._collection_name, ids)
+        return {doc[ID_KEY]: cls.with_db_entry(doc) for doc in docs}
 
     @classmethod
     def with_db_entry(cls, data):
@@ -109,24 +264,102 @@ class AirbnbItem(scrapy.Item):
         return cls(_persisted_values=data, **values)
     
     @classmethod
-    def save_many(cls,  items):
-        # TODO: optimise with bulk insert
-        # https://api.mongodb.com/python/current/tutorial.html#bulk-inserts
+    def save_many(cls, items, force=False, validate=True, touch_key=None, touched_ids=None):
+        """
+        Saves items with a single unordered bulk write.
+        Items without changes are skipped.
+
+        With `touch_key`, loaded items whose only change is
+        that key are written with a single update instead,
+        which sets the latest of their values on all of them.
+        `touched_ids` maps the IDs of other stored items to
+        serialized values of `touch_key`, and adds them to
+        the same update.
+
+        Returns:
+            The numbers of items written and of those which
+            were only touched.
+        """
+        if bool(touched_ids) and touch_key is None:
+            raise ValueError('Touched IDs need a touch key')
+        saved = []
+        touched = []
         for item in items:
-            item.save()
+            prepared = item.prepare_save(force=force, validate=validate)
+            if prepared is None:
+                continue
+            doc, values, insert_values = prepared
+            if touch_key is not None and bool(item._persisted_values) and list(values) == [touch_key]:
+                touched.append((item, doc))
+            else:
+                saved.append((item, prepared))
+
+        storage = cls.get_storage()
+        if bool(saved):
+            storage.upsert_many(
+                cls._collection_name,
+                [(item[ID_KEY], values, insert_values) for item, (_, values, insert_values) in saved]
+            )
+            for item, (doc, _, _) in saved:
+                item._persisted_values = doc
+
+        # Items in the batch are written with their own values
+        touch_values = dict(touched_ids or {})
+        for item, _ in saved + touched:
+            touch_values.pop(item[ID_KEY], None)
+
+        if bool(touched) or bool(touch_values):
+            touch_value = max([doc[touch_key] for _, doc in touched] + list(touch_values.values()))
+            storage.update_many(
+                cls._collection_name,
+                [item[ID_KEY] for item, _ in touched] + list(touch_values),
+                {touch_key: touch_value}
+            )
+            for item, doc in touched:
+                item[touch_key] = touch_value
+                doc[touch_key] = touch_value
+                item._persisted_values = doc
+        touched_count = len(touched) + len(touch_values)
+        return len(saved) + touched_count, touched_count
+
+    @classmethod
+    def touch_many(cls, ids, update_date):
+        """Sets the update date of stored items with a single update."""
+        ids = list(ids)
+        if not bool(ids):
+            return
+        cls.get_storage().update_many(cls._collection_name, ids, {'update_date': date_serializer(update_date)})
     
     @classmethod
-    def find(cls, *query, sort=None):
+    def find(cls, *query, sort=None, projection=None, limit=0, batch_size=0, raw=False):
+        """
+        Lazily iterates over the items matching a query.
+        Documents are fetched in batches as the result is
+        consumed (see `AirbnbStorage.find()`).
+
+        Items of a projection only have the projected
+        fields. With `raw`, the documents are returned as
+        stored, without creating items or parsing dates.
+
+        Returns:
+            An iterator of items, or of documents with `raw`.
+        """
         if bool(query):
             query = query[0]
         else:
             query = {}
-        col = cls.get_collection()
-        docs = col.find(query)
-        if sort:
-            if isinstance(sort, dict):
-                sort = [(k, v) for k, v in sort.items()]
-            docs = docs.sort(sort)
+        if sort and isinstance(sort, dict):
+            sort = [(k, v) for k, v in sort.items()]
+        docs = cls.get_storage().find(
+            cls._collection_name,
+            query,
+            sort=sort,
+            projection=projection,
+            limit=limit,
+            batch_size=batch_size
+        )
+        if raw:
+            return iter(docs)
         return map(cls.with_db_entry, docs)
 
     @classmethod
@@ -137,10 +370,7 @@ class AirbnbItem(scrapy.Item):
         return self.get(ID_KEY)
 
     def get_date_value(self, key, default=None):
-        x = self.get(key)
-        if not bool(x):
-            return default
-        return arrow.get(x)
+        return to_date_value(self.get(key), default)
 
     def validate(self):
         pass
@@ -154,31 +384,60 @@ class AirbnbItem(scrapy.Item):
         #     doc[key] = value
         # return doc
 
-    def save(self, force=False, validate=True):
+    def prepare_save(self, force=False, validate=True):
+        """
+        Validates the item and checks it for changes.
+
+        Only changed values are written. Immutable values
+        are written only when the document is created,
+        unless they are missing from a loaded document.
+
+        Returns:
+            A `(doc, values, insert_values)` tuple of the
+            serialized document, the values to set and the
+            values to set only on insert, or `None` if there
+            is nothing to save.
+        """
         if validate:
             self.validate()
 
         doc = self.serialize()
 
-        changes = {}
+        changes = None
         if not force or validate:
             changes = self.get_changes(_serialized_values=doc)
             if not bool(changes):
-                return
+                return None
 
+        immutable_keys = type(self).get_immutable_keys()
         if validate:
             assert bool(changes)
-            immutable_keys = type(self).get_immutable_keys()
             for key, change in changes.items():
                 if key in immutable_keys and change['old'] is not None:
                     raise AttributeError(f'Key is read-only: {key}')
 
-        collection = type(self).get_collection()
-        collection.update_one(
-            {ID_KEY: self[ID_KEY]},
-            {'$set': doc},
-            upsert=True
-        )
+        # Documents which were not loaded are written whole
+        olds = self._persisted_values
+        values = {}
+        insert_values = {}
+        for key in (changes if bool(olds) and changes is not None else doc):
+            if key == ID_KEY or key not in doc:
+                continue
+            if key in immutable_keys and not bool(olds):
+                insert_values[key] = doc[key]
+            elif not bool(olds) or changes is None:
+                values[key] = doc[key]
+            else:
+                values.update(get_changed_values(key, olds.get(key), doc[key]))
+        return doc, values, insert_values
+
+    def save(self, force=False, validate=True):
+        prepared = self.prepare_save(force=force, validate=validate)
+        if prepared is None:
+            return
+
+        doc, values, insert_values = prepared
+        type(self).get_storage().upsert(type(self)._collection_name, self[ID_KEY], values, insert_values)
         self._persisted_values = doc
 
     def get_changes(self, _serialized_values=None):
@@ -216,8 +475,13 @@ class AirbnbListing(AirbnbItem):
     _item_type = 'listing'
     _collection_name = 'listings'
     _stale_interval = 86400.0
+    _indexes = [
+        [('localized_city', ASCENDING), ('localized_neighborhood', ASCENDING)],
+        [('host_id', ASCENDING)],
+    ]
 
-    # source_hash = scrapy.Field()
+    # Fingerprint of the API data the item was built from
+    source_hash = scrapy.Field()
 
     # Host Fields
     is_superhost = scrapy.Field()
@@ -305,6 +569,12 @@ class AirbnbListingCalendarMonth(AirbnbItem):
     _item_type = 'month'
     _collection_name = 'months'
     _stale_interval = 3600.0
+    _indexes = [
+        [('listing_id', ASCENDING), ('year', ASCENDING), ('month', ASCENDING)],
+        [('year', ASCENDING), ('month', ASCENDING)],
+        # Date ranges of the listing months joined by analytics
+        [('listing_id', ASCENDING), ('start_date', ASCENDING)],
+    ]
 
     # source_hash = scrapy.Field()
 
@@ -319,6 +589,10 @@ class AirbnbListingCalendarMonth(AirbnbItem):
     availability = scrapy.Field()
     cancellation_rate = scrapy.Field()
     block_rate = scrapy.Field()
+    # Day counts, for occupancy across months
+    total_days = scrapy.Field()
+    booked_days = scrapy.Field()
+    blocked_days = scrapy.Field()
     revenue = scrapy.Field()
     partial_revenue = scrapy.Field()
     future_revenue = scrapy.Field()
@@ -327,6 +601,24 @@ class AirbnbListingCalendarMonth(AirbnbItem):
     lowest_price = scrapy.Field()
     highest_price = scrapy.Field()
     errors = scrapy.Field(serializer=lambda a: [str(x) for x in list(a)])
+    # Per-day arrays when days are embedded (see `CALENDAR_EMBEDDED_DAYS`)
+    days = scrapy.Field(serializer=embedded_days_serializer)
+
+    @classmethod
+    def with_db_entry(cls, data):
+        item = super().with_db_entry(data)
+        if 'days' in item:
+            # Copy arrays, which are modified in place,
+            # and parse dates once
+            date_keys = AirbnbListingCalendarDay.get_date_keys()
+            item['days'] = {
+                key: [
+                    arrow.get(x, tzinfo='UTC') if key in date_keys and isinstance(x, datetime) else x
+                    for x in values
+                ]
+                for key, values in item['days'].items()
+            }
+        return item
 
     @classmethod
     def create_id(cls, listing_id='', date='', tzinfo='UTC'):
@@ -343,6 +635,59 @@ class AirbnbListingCalendarMonth(AirbnbItem):
             tzinfo=self.get('time_zone')
         )
 
+    def validate(self):
+        for day in self.get_embedded_days():
+            day.validate()
+
+    def get_embedded_days(self):
+        """Returns views of the embedded days, in date order."""
+        days = self.get('days')
+        if not bool(days):
+            return []
+        return [AirbnbEmbeddedDay(self, i) for i in range(len(days['date']))]
+
+    def get_or_create_embedded_day(self, date, creation_date=None):
+        """
+        Returns a view of the embedded day at a local date,
+        inserting it in date order if it does not exist.
+
+        Inserting a day moves the days after it, so days
+        should be requested in date order while earlier
+        views are in use.
+        """
+        days = self.get('days')
+        if not bool(days):
+            days = {key: [] for key in EMBEDDED_DAY_KEYS}
+            self['days'] = days
+        for key in EMBEDDED_DAY_KEYS:
+            if key not in days:
+                days[key] = [None] * len(days['date'])
+
+        date_strs = self._embedded_date_strs
+        if date_strs is None or len(date_strs) != len(days['date']):
+            date_strs = [arrow.get(x).format('YYYY-MM-DD') for x in days['date']]
+            self._embedded_date_strs = date_strs
+
+        date = arrow.get(date)
+        date_str = date.format('YYYY-MM-DD')
+        index = bisect_left(date_strs, date_str)
+        if index < len(date_strs) and date_strs[index] == date_str:
+            return AirbnbEmbeddedDay(self, index)
+
+        for key in EMBEDDED_DAY_KEYS:
+            days[key].insert(index, None)
+        date_strs.insert(index, date_str)
+        days['date'][index] = date
+        days['creation_date'][index] = creation_date
+        return AirbnbEmbeddedDay(self, index)
+
+    def embed_days(self, days):
+        """Copies day items into the embedded day arrays."""
+        for day in sorted(days, key=lambda x: x.get_date_value('date')):
+            embedded_day = self.get_or_create_embedded_day(day.get_date_value('date'))
+            for key in EMBEDDED_DAY_KEYS:
+                embedded_day[key] = day.get(key)
+
     def update_with_days(self, days):
         time_zone = self['time_zone']
         now = self.get_date_value('update_date')
@@ -352,6 +697,7 @@ class AirbnbListingCalendarMonth(AirbnbItem):
         data_start_date = None
 
         booked_or_cancelled_days = 0
+        booked_days = 0
         available_future_days = 0
         future_days = 0
         total_days = 0
@@ -390,7 +736,7 @@ class AirbnbListingCalendarMonth(AirbnbItem):
                         future_revenue += price
             else:
                 # Handle missing price
-                errors.append(f'Price missing at {day.date.format("YYYY-MM-DD")}')
+                errors.append(f'Price missing at {day.get_date_value("date").format("YYYY-MM-DD")}')
 
             total_days += 1
             assert total_days <= 31, 'Too many days'
@@ -399,6 +745,8 @@ class AirbnbListingCalendarMonth(AirbnbItem):
                 if is_available:
                     available_future_days += 1
 
+            if is_booked:
+                booked_days += 1
             if is_cancelled:
                 cancelled_days += 1
             if is_booked or is_cancelled:
@@ -419,6 +767,9 @@ class AirbnbListingCalendarMonth(AirbnbItem):
         self['cancellation_rate'] = cancellation_rate
 
         self['block_rate'] = round(float(blocked_days) / float(total_days) * 100.0) / 100.0
+        self['total_days'] = total_days
+        self['booked_days'] = booked_days
+        self['blocked_days'] = blocked_days
 
         if not bool(errors):
             prices.sort()
@@ -446,41 +797,33 @@ class AirbnbListingCalendarMonth(AirbnbItem):
         self['errors'] = errors
 
 
-class AirbnbListingCalendarDay(AirbnbItem):
-
-    _item_type = 'day'
-    _collection_name = 'days'
-    _stale_interval = 3600.0
-
-    # source_hash = scrapy.Field()
-
-    listing_id = scrapy.Field()
-    month_id = scrapy.Field()
-    time_zone = scrapy.Field()
-    price = scrapy.Field()
-    currency = scrapy.Field()
-    date = scrapy.Field(serializer=naive_date_serializer)
-    last_available_seen_date = scrapy.Field(serializer=date_serializer)
-    first_unavailable_seen_date = scrapy.Field(serializer=date_serializer)
-    available = scrapy.Field()
-    booking_date = scrapy.Field(serializer=date_serializer)
-    blocked = scrapy.Field()
-    cancellations = scrapy.Field()
-    cancellation_date = scrapy.Field(serializer=date_serializer)
-
-    @classmethod
-    def create_id(cls, listing_id='', date='', tzinfo='UTC'):
-        if not bool(listing_id) or not bool(date):
-            raise ValueError('Missing ID parameter')
-        subid = arrow.get(date, tzinfo=tzinfo).format('YYYY-MM-DD')
-        return f'{listing_id}/{cls._item_type}/{subid}'
-
-    def update_id(self):
-        self[ID_KEY] = type(self).create_id(
-            listing_id=self['listing_id'],
-            date=self.get_date_value('date'),
-            tzinfo=self['time_zone']
-        )
+class AirbnbCalendarDayMixin:
+    """
+    Booking inference for a calendar day. Used by
+    `AirbnbListingCalendarDay` items and by days
+    embedded in a month (see `AirbnbEmbeddedDay`).
+
+    Requires `get()`, `__getitem__()`, `__setitem__()`
+    and `get_date_value()`, and a `_flags` attribute for
+    cached flags. Setters must call `invalidate_flags()`.
+    """
+
+    __slots__ = ()
+    # Keys which the cached flags depend on
+    _flag_keys = frozenset([
+        'date',
+        'time_zone',
+        'update_date',
+        'available',
+        'blocked',
+        'last_available_seen_date',
+        'booking_date',
+        'cancellation_date',
+    ])
+
+    def invalidate_flags(self, key):
+        if key in self._flag_keys:
+            self._flags = None
 
     @property
     def is_blocked(self):
@@ -490,7 +833,7 @@ class AirbnbListingCalendarDay(AirbnbItem):
     def is_available(self):
         return bool(self.get('available'))
 
-    @property
+    @cached_flag
     def is_booked(self):
         if self.is_blocked:
             return False
@@ -505,7 +848,7 @@ class AirbnbListingCalendarDay(AirbnbItem):
         else:
             return not self.is_available
 
-    @property
+    @cached_flag
     def is_cancelled(self):
         if self.is_blocked:
             return False
@@ -517,7 +860,7 @@ class AirbnbListingCalendarDay(AirbnbItem):
             return True
         return cancellation_date > booking_date
 
-    @property
+    @cached_flag
     def is_data_complete(self):
         if not self.is_past:
             return True
@@ -529,9 +872,9 @@ class AirbnbListingCalendarDay(AirbnbItem):
     def local_date(self):
         return arrow.get(self.get_date_value('date'), tzinfo=self['time_zone']).replace(tzinfo=self['time_zone'])
 
-    @property
+    @cached_flag
     def is_past(self):
-        return arrow.get(self.get_date_value('update_date')) > self.local_date.ceil('day').shift(hours=-2)
+        return self.get_date_value('update_date') > past_threshold(self.get_date_value('date').naive, self['time_zone'])
 
     def validate(self):
         creation_date = self.get_date_value('creation_date')
@@ -552,12 +895,6 @@ class AirbnbListingCalendarDay(AirbnbItem):
         now = self.get_date_value('update_date')
         is_past = self.is_past
 
-        self['month_id'] = AirbnbListingCalendarMonth.create_id(
-            listing_id=self.get('listing_id'),
-            date=self.get_date_value('date'),
-            tzinfo=self.get('time_zone')
-        )
-
         if self.is_available:
             self['last_available_seen_date'] = now
             self['blocked'] = False
@@ -606,6 +943,316 @@ class AirbnbListingCalendarDay(AirbnbItem):
         return unavailable_tail_days
 
 
+class AirbnbListingCalendarDay(AirbnbCalendarDayMixin, AirbnbItem):
+
+    _item_type = 'day'
+    _collection_name = 'days'
+    _stale_interval = 3600.0
+    _indexes = [
+        [('listing_id', ASCENDING), ('date', ASCENDING)],
+        [('month_id', ASCENDING)],
+        [('date', ASCENDING)],
+    ]
+
+    # Fingerprint of the API data the item was built from
+    source_hash = scrapy.Field()
+
+    listing_id = scrapy.Field()
+    month_id = scrapy.Field()
+    time_zone = scrapy.Field()
+    price = scrapy.Field()
+    currency = scrapy.Field()
+    date = scrapy.Field(serializer=naive_date_serializer)
+    last_available_seen_date = scrapy.Field(serializer=date_serializer)
+    first_unavailable_seen_date = scrapy.Field(serializer=date_serializer)
+    available = scrapy.Field()
+    booking_date = scrapy.Field(serializer=date_serializer)
+    blocked = scrapy.Field()
+    cancellations = scrapy.Field()
+    cancellation_date = scrapy.Field(serializer=date_serializer)
+
+    def __init__(self, *args, **kwargs):
+        self._flags = None
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.invalidate_flags(key)
+
+    @classmethod
+    def create_id(cls, listing_id='', date='', tzinfo='UTC'):
+        if not bool(listing_id) or not bool(date):
+            raise ValueError('Missing ID parameter')
+        subid = arrow.get(date, tzinfo=tzinfo).format('YYYY-MM-DD')
+        return f'{listing_id}/{cls._item_type}/{subid}'
+
+    def update_id(self):
+        self[ID_KEY] = type(self).create_id(
+            listing_id=self['listing_id'],
+            date=self.get_date_value('date'),
+            tzinfo=self['time_zone']
+        )
+
+    def update_inferred(self):
+        """Updates dependent properties."""
+        self['month_id'] = AirbnbListingCalendarMonth.create_id(
+            listing_id=self.get('listing_id'),
+            date=self.get_date_value('date'),
+            tzinfo=self.get('time_zone')
+        )
+        super().update_inferred()
+
+
+class AirbnbCalendarDayRecord(AirbnbCalendarDayMixin):
+    """
+    Compact stand-in for `AirbnbListingCalendarDay` used
+    while parsing calendars. Values are kept in slots
+    instead of an item dictionary, and the item is only
+    created by `to_item()` when the day leaves the spider.
+    """
+
+    _keys = tuple(key for key in AirbnbListingCalendarDay.fields if key not in ('item_type', 'version'))
+    __slots__ = _keys + ('persisted_values', '_flags')
+
+    def __init__(self, persisted_values=None, **values):
+        self.persisted_values = persisted_values
+        self._flags = None
+        for key, value in values.items():
+            self[key] = value
+
+    def __repr__(self):
+        return f'day[{self.get(ID_KEY)}]'
+
+    @classmethod
+    def create(cls, creation_date=None):
+        now = arrow.get()
+        return cls(creation_date=creation_date or now, update_date=now)
+
+    @classmethod
+    def with_db_entry(cls, data):
+        values = {}
+        for key in cls._keys:
+            if key in data:
+                v = data[key]
+                if isinstance(v, datetime):
+                    v = arrow.get(v, tzinfo='UTC')
+                values[key] = v
+        assert bool(values[ID_KEY]), 'Database entry is missing an ID'
+        return cls(persisted_values=data, **values)
+
+    @classmethod
+    def load_many(cls, ids):
+        """
+        Loads day records with the given IDs in a single query.
+
+        Returns:
+            A dictionary of records keyed by ID.
+        """
+        ids = list(ids)
+        if not bool(ids):
+            return {}
+        docs = AirbnbListingCalendarDay.get_storage().load_many(AirbnbListingCalendarDay._collection_name, ids)
+        return {doc[ID_KEY]: cls.with_db_entry(doc) for doc in docs}
+
+    @classmethod
+    def find(cls, *query, **kwargs):
+        """
+        Same as `AirbnbItem.find()` for day documents, but
+        returns day records, which are cheaper to create than
+        items. Use `to_item()` to save a changed record.
+        """
+        docs = AirbnbListingCalendarDay.find(*query, raw=True, **kwargs)
+        return map(cls.with_db_entry, docs)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            raise KeyError(f'{type(self).__name__} does not support field: {key}')
+        if bool(value) and not isinstance(value, arrow.Arrow) and key in AirbnbListingCalendarDay.get_date_keys():
+            value = arrow.get(value)
+        setattr(self, key, value)
+        self.invalidate_flags(key)
+
+    def get_id(self):
+        return self.get(ID_KEY)
+
+    def get_date_value(self, key, default=None):
+        return to_date_value(self.get(key), default)
+
+    def update_id(self):
+        self[ID_KEY] = AirbnbListingCalendarDay.create_id(
+            listing_id=self['listing_id'],
+            date=self.get_date_value('date'),
+            tzinfo=self['time_zone']
+        )
+
+    def update_inferred(self):
+        """Updates dependent properties."""
+        self['month_id'] = AirbnbListingCalendarMonth.create_id(
+            listing_id=self.get('listing_id'),
+            date=self.get_date_value('date'),
+            tzinfo=self.get('time_zone')
+        )
+        super().update_inferred()
+
+    def to_item(self):
+        """Returns the record as an `AirbnbListingCalendarDay`."""
+        values = {}
+        for key in self._keys:
+            value = getattr(self, key, MISSING_VALUE_SENTINEL)
+            if value is not MISSING_VALUE_SENTINEL:
+                values[key] = value
+        return AirbnbListingCalendarDay(_persisted_values=self.persisted_values, **values)
+
+
+class AirbnbEmbeddedDay(AirbnbCalendarDayMixin):
+    """
+    A day stored in the per-day arrays of a month
+    (see `AirbnbListingCalendarMonth.days`). Values are
+    read from and written to the arrays directly.
+
+    Cached flags only see writes made through the same
+    view, so a day should be modified through one view
+    at a time.
+    """
+
+    __slots__ = ('month', 'index', '_flags')
+
+    def __init__(self, month, index):
+        self.month = month
+        self.index = index
+        self._flags = None
+
+    def __repr__(self):
+        return f'day[{self.month.get_id()}#{self.index}]'
+
+    def get(self, key, default=None):
+        if key in EMBEDDED_DAY_MONTH_KEYS:
+            value = self.month.get(key)
+        elif key == 'month_id':
+            value = self.month.get_id()
+        else:
+            value = self.month['days'][key][self.index]
+            if isinstance(value, datetime):
+                value = arrow.get(value, tzinfo='UTC')
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        if key not in EMBEDDED_DAY_KEYS:
+            raise KeyError(f'{key} is not stored per day')
+        if bool(value) and not isinstance(value, arrow.Arrow) and key in AirbnbListingCalendarDay.get_date_keys():
+            value = arrow.get(value)
+        self.month['days'][key][self.index] = value
+        self.invalidate_flags(key)
+
+    def get_date_value(self, key, default=None):
+        return to_date_value(self.get(key), default)
+
+
+class AirbnbExploreTiling(AirbnbItem):
+    """
+    Leaf tiles of the quad-tree which splits an
+    explore query into searches small enough to be
+    paged through. Each tile is a
+    `[sw_lat, sw_lng, ne_lat, ne_lng]` list.
+    """
+
+    _item_type = 'tiling'
+    _collection_name = 'tilings'
+
+    query = scrapy.Field()
+    tiles = scrapy.Field()
+
+    @classmethod
+    def create_id(cls, query=''):
+        if not bool(query):
+            raise ValueError('Missing ID parameter')
+        return f'{query}/{cls._item_type}'
+
+    def update_id(self):
+        self[ID_KEY] = type(self).create_id(query=self['query'])
+
+
+class AirbnbSummary(AirbnbItem):
+    """
+    Cached result of an analytics report (see
+    `airbnb_scraper.analytics`), keyed by a fingerprint
+    of the report parameters.
+    """
+
+    _item_type = 'summary'
+    _collection_name = 'summaries'
+    _stale_interval = 21600.0
+
+    report = scrapy.Field()
+    parameters = scrapy.Field()
+    rows = scrapy.Field()
+
+    @classmethod
+    def create_id(cls, report='', parameters=None):
+        if not bool(report):
+            raise ValueError('Missing ID parameter')
+        return f'{report}/{util.hash_str(parameters or {})}'
+
+    def update_id(self):
+        self[ID_KEY] = type(self).create_id(report=self['report'], parameters=self['parameters'])
+
+
+ITEM_CLASSES = [
+    AirbnbListing,
+    AirbnbListingCalendarMonth,
+    AirbnbListingCalendarDay,
+    AirbnbExploreTiling,
+    AirbnbSummary,
+]
+
+
+class AirbnbTouch(scrapy.Item):
+    """
+    Update date of stored items whose source data is
+    unchanged. The spider yields it instead of the items,
+    so that they are not serialized and compared, and
+    pipelines only refresh their update date.
+    """
+
+    _item_type = 'touch'
+
+    item_type = scrapy.Field()
+    touched_type = scrapy.Field()
+    ids = scrapy.Field()
+    update_date = scrapy.Field(serializer=date_serializer)
+
+    def __repr__(self):
+        return f'{self._item_type}[{self.get("touched_type")}: {len(self.get("ids") or [])}]'
+
+    @classmethod
+    def create(cls, item_cls, ids, update_date=None):
+        return cls(
+            item_type=cls._item_type,
+            touched_type=item_cls._item_type,
+            ids=list(ids),
+            update_date=update_date or arrow.get()
+        )
+
+    def get_item_class(self):
+        """Returns the class of the touched items."""
+        return next(cls for cls in ITEM_CLASSES if cls._item_type == self['touched_type'])
+
+    def save(self):
+        self.get_item_class().touch_many(self['ids'], self['update_date'])
+
+
 class MongoDBItemExporter(BaseItemExporter):
 
     def export_item(self, item):
@@ -6,11 +6,16 @@
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 import os
+import time
+import arrow
 from pathlib import Path
-from scrapy.exporters import JsonItemExporter
-from scrapy.exceptions import DropItem
-from airbnb_scraper.db import AirbnbMongoDB
-from airbnb_scraper.items import AirbnbItem, ID_KEY
+from twisted.internet import defer, task, threads
+from twisted.python.threadpool import ThreadPool
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.misc import load_object
+from scrapy.utils.log import failure_to_exc_info
+from airbnb_scraper.db import AirbnbStorage
+from airbnb_scraper.items import AirbnbItem, AirbnbExploreTiling, AirbnbTouch, ID_KEY, date_serializer
 
 TEMP_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / 'temp'
 
@@ -18,24 +23,31 @@ TEMP_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / 'temp'
 class AirbnbMongoPipeline(object):
 
     def __init__(self, client=None):
-        self.client = client or AirbnbMongoDB.shared()
+        self.client = client or AirbnbStorage.shared()
 
     @classmethod
     def from_crawler(cls, crawler):
         # Prefer shared database
-        shared_client = AirbnbMongoDB.shared()
+        shared_client = AirbnbStorage.shared()
+        storage_path = crawler.settings.get('STORAGE_CLASS')
+        storage_cls = load_object(storage_path) if bool(storage_path) else type(shared_client)
         mongo_uri = crawler.settings.get('MONGO_URI') or shared_client.mongo_uri
         mongo_db = crawler.settings.get('MONGO_DATABASE') or shared_client.mongo_db
 
-        if mongo_uri == shared_client.mongo_uri and mongo_db == shared_client.mongo_db:
+        if isinstance(shared_client, storage_cls) and mongo_uri == shared_client.mongo_uri and mongo_db == shared_client.mongo_db:
             client = shared_client
         else:
-            client = AirbnbMongoDB(
+            client = storage_cls(
                 mongo_uri=mongo_uri,
-                mongo_db=mongo_db
+                mongo_db=mongo_db,
+                ensure_indexes=crawler.settings.getbool('MONGO_ENSURE_INDEXES')
             )
+            # Items and the spider use the shared database, which
+            # is created from the project settings module, so
+            # share the backend of the crawler settings instead
+            AirbnbStorage.set_shared(client)
 
-        return AirbnbMongoPipeline(client=client)
+        return cls(client=client)
 
     def open_spider(self, spider):
         spider.logger.debug(f'Pipeline opening MongoDB connection')
@@ -47,63 +59,321 @@ class AirbnbMongoPipeline(object):
 
     def process_item(self, item, spider):
         spider.logger.debug(f'Pipeline saving item {item} to MongoDB')
-        if not isinstance(item, AirbnbItem):
+        if not isinstance(item, (AirbnbItem, AirbnbTouch)):
             raise TypeError(f'Unknown item type: {type(item).__name__}')
         item.save()
         return item
 
 
-# class AirbnbJsonPipeline(object):
-
-#     listings_path = None
-#     calendars_path = None
-#     listings_file = None
-#     calendars_file = None
-
-#     def __init__(self, raw_path):
-#         if '/' in raw_path:
-#             path = Path(os.path.normpath(raw_path))
-#         else:
-#             path = TEMP_DIR / raw_path
-
-#         base_dir = path.parent
-#         base_name = path.stem
-#         ext = path.suffix
-
-#         listings_file_str = f'{base_name}_listings.{ext}'
-#         self.listings_path = base_dir / listings_file_str
-
-#         calendars_file_str = f'{base_name}_calendars.{ext}'
-#         self.calendars_path = base_dir / calendars_file_str
-
-#     @classmethod
-#     def from_crawler(cls, crawler):
-#         return cls(
-#             mongo_uri=crawler.settings.get('MONGO_URI'),
-#             mongo_db=crawler.settings.get('MONGO_DATABASE', 'items')
-#         )
-
-#     def open_spider(self, spider):
-#         self.listings_file = self.listings_path.open('w')
-#         self.listings_exporter = JsonItemExporter(self.listings_file)
-#         self.listings_exporter.start_exporting()
-        
-#         self.calendars_file = self.calendars_path.open('w')
-#         self.calendars_exporter = JsonItemExporter(self.calendars_file)
-#         self.calendars_exporter.start_exporting()
-
-#     def close_spider(self, spider):
-#         self.listings_exporter.finish_exporting()
-#         self.listings_file.close()
-
-#         self.calendars_exporter.finish_exporting()
-#         self.calendars_file.close()
-
-#     def process_item(self, item, spider):
-#         if isinstance(item, AirbnbListing):
-#             self.listings_exporter.export_item(item)
-#         elif isinstance(item, AirbnbListingCalendar):
-#             self.calendars_exporter.export_item(item)
-#         else:
-#             raise TypeError(f'Unknown item type: {type(item).__name__}')
-#         return item
+class AirbnbMongoBulkPipeline(AirbnbMongoPipeline):
+    """
+    Buffers items per collection and writes them with
+    unordered bulk upserts (see `AirbnbItem.save_many()`).
+
+    A buffer is flushed when it holds `MONGO_BULK_SIZE` items,
+    when its oldest item is older than `MONGO_BULK_INTERVAL`
+    seconds and when the spider closes. Repeated saves of the
+    same item within a buffer are coalesced.
+
+    Touches of unchanged items are buffered with the items
+    of their collection, and their IDs are written with one
+    update per flush. With `MONGO_COALESCE_TOUCHES`, items
+    whose only change is `update_date` are added to the same
+    update. Touched items get the latest update date in the
+    flush.
+
+    If a bulk write fails, the items of the buffer are saved
+    one at a time. Items which still fail are logged and
+    counted in the crawl stats under `airbnb/mongo/`.
+
+    Note that buffered items are not visible to database
+    queries until they are flushed.
+    """
+
+    def __init__(self, client=None, bulk_size=500, bulk_interval=10.0, coalesce_touches=False, stats=None):
+        super().__init__(client=client)
+        self.bulk_size = bulk_size
+        self.bulk_interval = bulk_interval
+        self.coalesce_touches = coalesce_touches
+        self.stats = stats
+        self.buffers = {}
+        self.touches = {}
+        self.buffer_dates = {}
+        self.flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.bulk_size = crawler.settings.getint('MONGO_BULK_SIZE', pipeline.bulk_size)
+        pipeline.bulk_interval = crawler.settings.getfloat('MONGO_BULK_INTERVAL', pipeline.bulk_interval)
+        pipeline.coalesce_touches = crawler.settings.getbool('MONGO_COALESCE_TOUCHES', pipeline.coalesce_touches)
+        pipeline.stats = crawler.stats
+        return pipeline
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        if self.bulk_interval > 0:
+            self.flush_loop = task.LoopingCall(self.flush_expired, spider)
+            d = self.flush_loop.start(self.bulk_interval, now=False)
+            d.addErrback(self.flush_loop_failed, spider)
+
+    def flush_loop_failed(self, failure, spider):
+        spider.logger.error(
+            'Pipeline stopped flushing expired buffers, they are flushed when full or when the spider closes',
+            exc_info=failure_to_exc_info(failure)
+        )
+
+    def close_spider(self, spider):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush_loop = None
+        self.flush(spider)
+        super().close_spider(spider)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, (AirbnbItem, AirbnbTouch)):
+            raise TypeError(f'Unknown item type: {type(item).__name__}')
+        if isinstance(item, AirbnbTouch):
+            item_cls = item.get_item_class()
+            touches = self.touches.setdefault(item_cls, {})
+            update_date = date_serializer(item['update_date'])
+            for id in item['ids']:
+                touches[id] = max(touches.get(id, update_date), update_date)
+        else:
+            item_cls = type(item)
+            self.buffers.setdefault(item_cls, {})[item.get_id()] = item
+        self.buffer_dates.setdefault(item_cls, time.monotonic())
+
+        if len(self.buffers.get(item_cls, {})) + len(self.touches.get(item_cls, {})) >= self.bulk_size:
+            self.flush_buffer(item_cls, spider)
+        else:
+            self.flush_expired(spider)
+        return item
+
+    def flush_expired(self, spider):
+        now = time.monotonic()
+        for item_cls, buffer_date in list(self.buffer_dates.items()):
+            if now - buffer_date >= self.bulk_interval:
+                self.flush_buffer(item_cls, spider)
+
+    def flush(self, spider):
+        for item_cls in list(self.buffer_dates.keys()):
+            self.flush_buffer(item_cls, spider)
+
+    def flush_buffer(self, item_cls, spider):
+        items = list(self.buffers.pop(item_cls, {}).values())
+        touches = self.touches.pop(item_cls, {})
+        self.buffer_dates.pop(item_cls, None)
+        if not bool(items) and not bool(touches):
+            return
+        spider.logger.debug(
+            f'Pipeline saving {len(items)} {item_cls.__name__} items and {len(touches)} touches to MongoDB'
+        )
+        failed_ids = []
+        try:
+            written, touched = self.save_buffer(item_cls, items, touches)
+        except Exception as e:
+            # An invalid item or a failed document fails the whole
+            # bulk write, so retry the items one at a time
+            spider.logger.warning(
+                f'Pipeline bulk write of {item_cls.__name__} items failed, saving them one at a time: {e!r}'
+            )
+            written, touched, failed_ids = self.save_each(item_cls, items, touches, spider)
+        if self.stats is not None:
+            self.stats.inc_value('airbnb/mongo/bulk_writes', spider=spider)
+            self.stats.inc_value('airbnb/mongo/bulk_items_written', written, spider=spider)
+            self.stats.inc_value('airbnb/mongo/bulk_items_touched', touched, spider=spider)
+            self.stats.inc_value(
+                'airbnb/mongo/bulk_items_unchanged', len(items) + len(touches) - written - len(failed_ids),
+                spider=spider
+            )
+            if bool(failed_ids):
+                self.stats.inc_value('airbnb/mongo/bulk_write_errors', spider=spider)
+                self.stats.inc_value('airbnb/mongo/bulk_items_failed', len(failed_ids), spider=spider)
+
+    def save_buffer(self, item_cls, items, touches):
+        if self.coalesce_touches:
+            return item_cls.save_many(items, touch_key='update_date', touched_ids=touches)
+        written, touched = item_cls.save_many(items)
+        if bool(touches):
+            touch_counts = item_cls.save_many([], touch_key='update_date', touched_ids=touches)
+            written += touch_counts[0]
+            touched += touch_counts[1]
+        return written, touched
+
+    def save_each(self, item_cls, items, touches, spider):
+        """
+        Saves buffered items one at a time, so that a failed
+        item does not prevent the others from being saved.
+
+        Returns:
+            The numbers of items written and touched, and
+            the IDs of the items which failed.
+        """
+        written = 0
+        touched = 0
+        failed_ids = []
+        for item in items:
+            try:
+                counts = self.save_buffer(item_cls, [item], {})
+            except Exception as e:
+                spider.logger.error(f'Pipeline failed to save item {item}: {e!r}')
+                failed_ids.append(item.get_id())
+                continue
+            written += counts[0]
+            touched += counts[1]
+        if bool(touches):
+            try:
+                counts = self.save_buffer(item_cls, [], touches)
+            except Exception as e:
+                spider.logger.error(f'Pipeline failed to touch {len(touches)} {item_cls.__name__} items: {e!r}')
+                failed_ids.extend(touches)
+            else:
+                written += counts[0]
+                touched += counts[1]
+        return written, touched, failed_ids
+
+
+class AirbnbMongoAsyncPipeline(AirbnbMongoPipeline):
+    """
+    Saves items on a dedicated thread pool, so that MongoDB
+    latency does not stall the reactor.
+
+    At most `MONGO_MAX_PENDING_WRITES` saves are in flight.
+    Beyond that, `process_item()` returns a Deferred which waits
+    for a free slot. The response which produced the item stays
+    active in the scraper until then, so Scrapy backs off from
+    downloading more instead of buffering items without limit.
+    """
+
+    def __init__(self, client=None, write_threads=4, max_pending_writes=100, stats=None):
+        super().__init__(client=client)
+        self.write_threads = write_threads
+        self.max_pending_writes = max_pending_writes
+        self.stats = stats
+        self.thread_pool = None
+        self.semaphore = None
+        self.pending = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.write_threads = crawler.settings.getint('MONGO_WRITE_THREADS', pipeline.write_threads)
+        pipeline.max_pending_writes = crawler.settings.getint('MONGO_MAX_PENDING_WRITES', pipeline.max_pending_writes)
+        pipeline.stats = crawler.stats
+        return pipeline
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self.semaphore = defer.DeferredSemaphore(self.max_pending_writes)
+        self.thread_pool = ThreadPool(
+            minthreads=1,
+            maxthreads=self.write_threads,
+            name=type(self).__name__
+        )
+        self.thread_pool.start()
+
+    def close_spider(self, spider):
+        # Wait for in-flight writes before closing the connection
+        spider.logger.debug(f'Pipeline waiting for {len(self.pending)} MongoDB writes')
+        d = defer.DeferredList(list(self.pending), consumeErrors=True)
+        d.addBoth(lambda _: self.stop(spider))
+        return d
+
+    def stop(self, spider):
+        if self.thread_pool is not None:
+            self.thread_pool.stop()
+            self.thread_pool = None
+        super().close_spider(spider)
+
+    def process_item(self, item, spider):
+        from twisted.internet import reactor
+
+        spider.logger.debug(f'Pipeline queueing item {item} for MongoDB')
+        if not isinstance(item, (AirbnbItem, AirbnbTouch)):
+            raise TypeError(f'Unknown item type: {type(item).__name__}')
+
+        d = self.semaphore.run(
+            threads.deferToThreadPool,
+            reactor,
+            self.thread_pool,
+            item.save
+        )
+        self.pending.add(d)
+        if self.stats is not None:
+            self.stats.max_value('airbnb/mongo/queued_writes_max', len(self.pending), spider=spider)
+
+        def finished(result):
+            self.pending.discard(d)
+            return result
+
+        d.addBoth(finished)
+        d.addCallback(lambda _: item)
+        return d
+
+
+class AirbnbExportPipeline(object):
+    """
+    Streams listings, months and days to partitioned
+    Parquet or newline-delimited JSON files (see
+    `airbnb_scraper.export`), alongside or instead of the
+    MongoDB pipelines.
+
+    Files are written to `EXPORT_DIR` in `EXPORT_FORMAT`.
+    Each partition buffers `EXPORT_ROW_GROUP_SIZE` rows and
+    starts a new file every `EXPORT_FILE_ROWS` rows.
+    """
+
+    def __init__(self, export_dir=TEMP_DIR / 'export', file_format='parquet', row_group_size=10000,
+                 file_rows=1000000, stats=None):
+        self.export_dir = Path(export_dir)
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.file_rows = file_rows
+        self.stats = stats
+        self.exporter = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        from airbnb_scraper import export
+
+        settings = crawler.settings
+        file_format = settings.get('EXPORT_FORMAT', 'parquet')
+        if file_format == 'parquet' and export.pyarrow is None:
+            raise NotConfigured('Parquet export requires pyarrow')
+        export_dir = settings.get('EXPORT_DIR') or TEMP_DIR / 'export'
+        return cls(
+            export_dir=export_dir,
+            file_format=file_format,
+            row_group_size=settings.getint('EXPORT_ROW_GROUP_SIZE', 10000),
+            file_rows=settings.getint('EXPORT_FILE_ROWS', 1000000),
+            stats=crawler.stats
+        )
+
+    def open_spider(self, spider):
+        from airbnb_scraper.export import PartitionedExporter
+
+        # Files of separate crawls do not overwrite each other
+        request_date = getattr(spider, 'request_date', None) or arrow.get()
+        self.exporter = PartitionedExporter(
+            self.export_dir,
+            city=getattr(spider, 'city', ''),
+            file_format=self.file_format,
+            row_group_size=self.row_group_size,
+            file_rows=self.file_rows,
+            file_prefix=f'part-{request_date.format("YYYYMMDDTHHmmss")}'
+        )
+
+    def close_spider(self, spider):
+        spider.logger.debug(f'Pipeline closing export files in {self.export_dir}')
+        self.exporter.close()
+
+    def process_item(self, item, spider):
+        if not isinstance(item, AirbnbItem):
+            raise TypeError(f'Unknown item type: {type(item).__name__}')
+        if isinstance(item, AirbnbExploreTiling):
+            return item
+        rows = self.exporter.export_item(item)
+        if self.stats is not None:
+            self.stats.inc_value('airbnb/export/rows', rows, spider=spider)
+        return item
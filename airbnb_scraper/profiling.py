@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Profilers for crawls run with `-a profile=cpu` or `-a profile=mem`,
+used by the `AirbnbProfiling` extension.
+
+Profilers wrap spider callbacks and item pipelines and aggregate
+their measurements per name. Callbacks are generators, so each
+step of the generator is measured, and the time between steps,
+in which Scrapy handles the outputs, is not. Nested calls are
+attributed to the outermost name.
+
+`CpuProfiler` runs a deterministic cProfile profiler per name and
+writes `<name>.pstats` and `<name>.txt` files, plus `all.pstats`
+combining them. Stats files can be read with `pstats`, snakeviz,
+or converted to flame graphs with flameprof.
+
+`MemoryProfiler` traces allocations with tracemalloc. Every
+`snapshot_interval` responses it takes a snapshot and writes the
+top allocation growth sites since the previous snapshot to
+`memory.txt`. When closed it writes the growth since the start,
+the net bytes allocated per name, and dumps the last snapshot
+to `memory.snapshot` (read with `tracemalloc.Snapshot.load()`).
+"""
+
+import cProfile
+import inspect
+import io
+import pstats
+import tracemalloc
+import types
+from pathlib import Path
+
+MODES = ('cpu', 'mem')
+# Traces of the profiler itself
+_IGNORED_TRACES = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+]
+
+
+def create_profiler(mode, directory, top=25, snapshot_interval=100):
+    """Returns a profiler for a profile mode."""
+    if mode == 'cpu':
+        return CpuProfiler(directory, top=top)
+    if mode == 'mem':
+        return MemoryProfiler(directory, top=top, snapshot_interval=snapshot_interval)
+    raise ValueError(f'Unknown profile mode: {mode}, expected one of {", ".join(MODES)}')
+
+
+class Profiler:
+    """
+    Base class of the profilers. Subclasses implement
+    `start()`, `stop()` and `write()`.
+    """
+
+    def __init__(self, directory, top=25):
+        self.directory = Path(directory)
+        self.top = top
+        self.calls = {}
+        self.active = False
+
+    def open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def close(self):
+        """
+        Writes the profiles.
+
+        Returns:
+            A list of the paths written.
+        """
+        return self.write()
+
+    def start(self, name):
+        raise NotImplementedError()
+
+    def stop(self, name, state):
+        raise NotImplementedError()
+
+    def write(self):
+        raise NotImplementedError()
+
+    def run(self, name, func, *args, **kwargs):
+        """Calls a function, profiled under a name."""
+        if self.active:
+            return func(*args, **kwargs)
+        self.active = True
+        state = self.start(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop(name, state)
+            self.active = False
+
+    def wrap_function(self, name, func):
+        """Returns a function which profiles another under a name."""
+        def profiled(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return self.run(name, func, *args, **kwargs)
+
+        profiled.__name__ = name
+        return profiled
+
+    def wrap_callback(self, spider, name, method):
+        """
+        Returns a method of the spider which profiles a
+        callback and the generator it returns. It has the
+        name of the callback, so that requests which
+        reference it can still be serialized.
+        """
+        profiler = self
+
+        def profiled_results(results):
+            while True:
+                try:
+                    result = profiler.run(name, next, results)
+                except StopIteration:
+                    return
+                yield result
+
+        def callback(spider, *args, **kwargs):
+            profiler.calls[name] = profiler.calls.get(name, 0) + 1
+            results = profiler.run(name, method, *args, **kwargs)
+            if inspect.isgenerator(results):
+                return profiled_results(results)
+            return results
+
+        callback.__name__ = name
+        return types.MethodType(callback, spider)
+
+
+class CpuProfiler(Profiler):
+
+    def __init__(self, directory, top=25):
+        super().__init__(directory, top=top)
+        self.profiles = {}
+
+    def start(self, name):
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, name, state):
+        state.disable()
+
+    def write(self):
+        paths = []
+        stats_paths = []
+        for name, profile in sorted(self.profiles.items()):
+            stats_path = self.directory / f'{name}.pstats'
+            profile.dump_stats(str(stats_path))
+            stats_paths.append(str(stats_path))
+            text_path = self.directory / f'{name}.txt'
+            text_path.write_text(format_stats(profile, self.top), encoding='utf-8')
+            paths.extend([stats_path, text_path])
+        if bool(stats_paths):
+            all_path = self.directory / 'all.pstats'
+            pstats.Stats(*stats_paths).dump_stats(str(all_path))
+            paths.append(all_path)
+        return paths
+
+
+def format_stats(profile, top):
+    """Returns the top functions of a profile by cumulative time."""
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats('cumulative').print_stats(top)
+    return output.getvalue()
+
+
+class MemoryProfiler(Profiler):
+
+    def __init__(self, directory, top=25, snapshot_interval=100, traceback_frames=1):
+        super().__init__(directory, top=top)
+        self.snapshot_interval = snapshot_interval
+        self.traceback_frames = traceback_frames
+        self.allocated = {}
+        self.responses = 0
+        self.started_tracing = False
+        self.first_snapshot = None
+        self.last_snapshot = None
+        self.report = None
+
+    def open(self):
+        super().open()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceback_frames)
+            self.started_tracing = True
+        self.report = (self.directory / 'memory.txt').open('w', encoding='utf-8')
+        self.first_snapshot = self.last_snapshot = self.take_snapshot()
+
+    def close(self):
+        try:
+            return super().close()
+        finally:
+            self.report.close()
+            if self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(_IGNORED_TRACES)
+
+    def wrap_callback(self, spider, name, method):
+        profiled = super().wrap_callback(spider, name, method)
+
+        def callback(spider, *args, **kwargs):
+            self.responses += 1
+            if self.snapshot_interval > 0 and self.responses % self.snapshot_interval == 0:
+                self.write_growth(f'After {self.responses} responses', self.last_snapshot)
+            return profiled(*args, **kwargs)
+
+        callback.__name__ = name
+        return types.MethodType(callback, spider)
+
+    def start(self, name):
+        return tracemalloc.get_traced_memory()[0]
+
+    def stop(self, name, state):
+        self.allocated[name] = self.allocated.get(name, 0) + tracemalloc.get_traced_memory()[0] - state
+
+    def write_growth(self, title, previous):
+        """Takes a snapshot and reports the top growth sites since a previous one."""
+        snapshot = self.take_snapshot()
+        differences = [x for x in snapshot.compare_to(previous, 'lineno') if x.size_diff > 0]
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'{title}: traced {current / 1024 / 1024:.1f} MiB (peak {peak / 1024 / 1024:.1f} MiB)']
+        lines.extend(f'  {x}' for x in differences[:self.top])
+        self.report.write('\n'.join(lines) + '\n\n')
+        self.report.flush()
+        self.last_snapshot = snapshot
+        return snapshot
+
+    def write(self):
+        snapshot = self.write_growth('Growth since start', self.first_snapshot)
+        lines = ['Net allocated bytes per name:']
+        for name, size in sorted(self.allocated.items(), key=lambda x: -x[1]):
+            lines.append(f'  {name}: {size / 1024:.1f} KiB in {self.calls.get(name, 0)} calls')
+        self.report.write('\n'.join(lines) + '\n')
+        snapshot_path = self.directory / 'memory.snapshot'
+        snapshot.dump(str(snapshot_path))
+        return [self.directory / 'memory.txt', snapshot_path]
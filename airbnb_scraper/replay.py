@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Offline replay of recorded Airbnb API responses.
+
+Serves the responses in `tests/res` through a fake downloader and
+runs the spider callbacks and an item pipeline against the in-memory
+storage backend. Reports listings/s, days/s, CPU time per callback and
+peak memory, so that parser and item changes can be measured without
+network access.
+
+The recorded explore page can be scaled up synthetically to any
+number of listings, and calendars are shifted to the requested months.
+
+Usage:
+
+    python -m airbnb_scraper.replay --listings 1000
+"""
+
+import argparse
+import calendar
+import json
+import resource
+import sys
+import time
+import tracemalloc
+import urllib
+from collections import OrderedDict, deque
+from pathlib import Path
+import scrapy
+from scrapy.crawler import Crawler
+from scrapy.exceptions import CloseSpider
+from scrapy.http import TextResponse
+from scrapy.settings import Settings
+from scrapy.utils.misc import load_object
+from airbnb_scraper.db import AirbnbStorage, AirbnbMemoryDB
+from airbnb_scraper.items import AirbnbItem, AirbnbTouch
+from airbnb_scraper.spiders.airbnb import AirbnbSpider, EXPLORE_BASE_URL, CALENDAR_BASE_URL
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / 'tests' / 'res'
+DEFAULT_PIPELINE = 'airbnb_scraper.pipelines.AirbnbMongoPipeline'
+# Added to recorded listing IDs for each synthetic copy of the explore page
+SYNTHETIC_ID_STEP = 1000000000
+
+
+def load_fixture(path):
+    """Loads a recorded JSON response, ignoring trailing data."""
+    text = Path(path).read_text()
+    data, _ = json.JSONDecoder().raw_decode(text.strip())
+    return data
+
+
+class ReplayDownloader:
+    """
+    Produces responses for explore and calendar requests
+    from recorded fixtures.
+    """
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR, listings=0):
+        fixtures_dir = Path(fixtures_dir)
+        self.explore_json = json.dumps(load_fixture(fixtures_dir / 'explore' / 'response.json'))
+        self.calendar_data = load_fixture(fixtures_dir / 'calendar' / 'response.json')
+        self.page_size = sum(1 for _ in self.iter_homes(json.loads(self.explore_json)))
+        self.listings = listings or self.page_size
+
+    @staticmethod
+    def iter_homes(data):
+        for section in data['explore_tabs'][0]['sections']:
+            for home in section.get('listings') or []:
+                yield home
+
+    def fetch(self, request):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.url).query))
+        if request.url.startswith(EXPLORE_BASE_URL):
+            data = self.create_explore_page(int(params.get('items_offset', 0)))
+        elif request.url.startswith(CALENDAR_BASE_URL):
+            data = self.create_calendar(
+                year=int(params['year']),
+                month=int(params['month']),
+                count=int(params.get('count', 1))
+            )
+        else:
+            raise ValueError(f'No recorded response for URL: {request.url}')
+        return TextResponse(
+            url=request.url,
+            body=json.dumps(data).encode('utf-8'),
+            encoding='utf-8',
+            request=request
+        )
+
+    def create_explore_page(self, items_offset=0):
+        data = json.loads(self.explore_json)
+        explore_tab = data['explore_tabs'][0]
+        index = items_offset
+        for section in explore_tab['sections']:
+            homes = []
+            for home in section.get('listings') or []:
+                if index >= self.listings:
+                    break
+                copy_index = index // self.page_size
+                home['listing']['id'] += copy_index * SYNTHETIC_ID_STEP
+                homes.append(home)
+                index += 1
+            if 'listings' in section:
+                section['listings'] = homes
+
+        pagination_metadata = explore_tab['pagination_metadata']
+        pagination_metadata['items_offset'] = index
+        pagination_metadata['has_next_page'] = index < self.listings
+        return data
+
+    def create_calendar(self, year, month, count=1):
+        recorded_months = self.calendar_data['calendar_months']
+        months = []
+        for i in range(count):
+            month_index = month - 1 + i
+            target_year = year + month_index // 12
+            target_month = month_index % 12 + 1
+            recorded_days = recorded_months[i % len(recorded_months)]['days']
+            days = []
+            for day_num in range(1, calendar.monthrange(target_year, target_month)[1] + 1):
+                day = dict(recorded_days[(day_num - 1) % len(recorded_days)])
+                day['date'] = f'{target_year:04}-{target_month:02}-{day_num:02}'
+                days.append(day)
+            months.append({
+                'month': target_month,
+                'year': target_year,
+                'days': days,
+            })
+        return {'calendar_months': months}
+
+
+class CallbackTiming:
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def add(self, wall_time, cpu_time):
+        self.calls += 1
+        self.wall_time += wall_time
+        self.cpu_time += cpu_time
+
+
+def replay(listings=0, pipeline=DEFAULT_PIPELINE, trace_memory=False, fixtures_dir=FIXTURES_DIR, spider_kwargs=None,
+           settings_overrides=None, storage=None):
+    """
+    Runs a crawl against recorded responses. Pass an
+    in-memory `storage` to crawl on top of earlier data.
+
+    Returns:
+        A report dictionary (see `format_report()`).
+    """
+    settings = Settings()
+    settings.setmodule('airbnb_scraper.settings')
+    settings.setdict(settings_overrides or {}, priority='cmdline')
+    settings.set('STORAGE_CLASS', 'airbnb_scraper.db.AirbnbMemoryDB')
+    # The spider checks which pipelines get its items
+    settings.set('ITEM_PIPELINES', {pipeline: 300}, priority='cmdline')
+    if storage is not None:
+        # Pipelines use the shared storage if it matches the settings
+        settings.set('MONGO_URI', storage.mongo_uri, priority='cmdline')
+        settings.set('MONGO_DATABASE', storage.mongo_db, priority='cmdline')
+    AirbnbStorage.set_shared(storage or AirbnbMemoryDB(
+        mongo_uri=settings.get('MONGO_URI'),
+        mongo_db=settings.get('MONGO_DATABASE'),
+        ensure_indexes=settings.getbool('MONGO_ENSURE_INDEXES')
+    ))
+
+    downloader = ReplayDownloader(fixtures_dir=fixtures_dir, listings=listings)
+    crawler = Crawler(AirbnbSpider, settings)
+    spider_kwargs = dict(spider_kwargs or {})
+    spider_kwargs.setdefault('city', 'Replay')
+    spider = AirbnbSpider.from_crawler(crawler, **spider_kwargs)
+    item_pipeline = load_object(pipeline).from_crawler(crawler)
+
+    if trace_memory:
+        tracemalloc.start()
+    timings = OrderedDict()
+    item_counts = OrderedDict()
+    requests = 0
+
+    def timed(name, func, *args):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = func(*args)
+        timing = timings.setdefault(name, CallbackTiming())
+        timing.add(time.perf_counter() - wall_start, time.process_time() - cpu_start)
+        return result
+
+    start = time.perf_counter()
+    item_pipeline.open_spider(spider)
+    queue = deque(spider.start_requests())
+    while bool(queue):
+        request = queue.popleft()
+        response = timed('download', downloader.fetch, request)
+        requests += 1
+        try:
+            outputs = timed(request.callback.__name__, lambda: list(request.callback(response)))
+        except CloseSpider:
+            break
+        for output in outputs:
+            if isinstance(output, scrapy.Request):
+                queue.append(output)
+            elif isinstance(output, (AirbnbItem, AirbnbTouch)):
+                timed('process_item', item_pipeline.process_item, output, spider)
+                item_type = output.get('item_type')
+                item_counts[item_type] = item_counts.get(item_type, 0) + 1
+    timed('close_spider', item_pipeline.close_spider, spider)
+    spider.closed('finished')
+    elapsed = time.perf_counter() - start
+
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        # Maximum resident set size, in kilobytes on Linux
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {
+        'elapsed': elapsed,
+        'requests': requests,
+        'items': item_counts,
+        'timings': timings,
+        'peak_memory': peak_memory,
+        'peak_memory_traced': trace_memory,
+        'stats': crawler.stats.get_stats(),
+    }
+
+
+def format_report(report):
+    elapsed = report['elapsed']
+    items = report['items']
+    lines = [
+        f'Elapsed: {elapsed:.2f} s, {report["requests"]} requests',
+        f'Listings: {items.get("listing", 0)} ({items.get("listing", 0) / elapsed:.1f}/s)',
+        f'Months: {items.get("month", 0)} ({items.get("month", 0) / elapsed:.1f}/s)',
+        f'Days: {items.get("day", 0)} ({items.get("day", 0) / elapsed:.1f}/s)',
+        'Callbacks:',
+    ]
+    for name, timing in report['timings'].items():
+        per_call = timing.cpu_time / timing.calls * 1000.0 if timing.calls > 0 else 0.0
+        lines.append(
+            f'  {name}: {timing.calls} calls, wall {timing.wall_time:.3f} s, '
+            f'cpu {timing.cpu_time:.3f} s ({per_call:.3f} ms/call)'
+        )
+    stats = report['stats']
+    for kind in ['explore', 'calendar']:
+        prefix = f'airbnb/json/{kind}'
+        responses = stats.get(f'{prefix}/responses', 0)
+        if responses == 0:
+            continue
+        line = (
+            f'JSON {kind}: {stats[f"{prefix}/time_ms"] / responses:.3f} ms/response '
+            f'(max {stats[f"{prefix}/time_ms_max"]:.3f} ms)'
+        )
+        if f'{prefix}/peak_memory' in stats:
+            line += (
+                f', peak {stats[f"{prefix}/peak_memory"] / responses / 1024:.0f} KiB/response '
+                f'(max {stats[f"{prefix}/peak_memory_max"] / 1024:.0f} KiB)'
+            )
+        lines.append(line)
+    memory_kind = 'traced' if report['peak_memory_traced'] else 'max RSS'
+    lines.append(f'Peak memory ({memory_kind}): {report["peak_memory"] / 1024 / 1024:.1f} MiB')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded Airbnb responses and report throughput.')
+    parser.add_argument('--listings', type=int, default=0, help='Number of listings to serve (default: as recorded)')
+    parser.add_argument('--pipeline', default=DEFAULT_PIPELINE, help='Item pipeline class path')
+    parser.add_argument('--trace-memory', action='store_true', help='Measure peak memory with tracemalloc (slower)')
+    parser.add_argument('--fixtures', default=str(FIXTURES_DIR), help='Directory of recorded responses')
+    parser.add_argument('-a', dest='spider_args', action='append', default=[], metavar='NAME=VALUE',
+                        help='Spider argument, as with scrapy crawl')
+    parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                        help='Setting override, as with scrapy crawl')
+    args = parser.parse_args(argv)
+
+    spider_kwargs = dict(arg.split('=', 1) for arg in args.spider_args)
+    report = replay(
+        listings=args.listings,
+        pipeline=args.pipeline,
+        trace_memory=args.trace_memory,
+        fixtures_dir=args.fixtures,
+        spider_kwargs=spider_kwargs,
+        settings_overrides=dict(arg.split('=', 1) for arg in args.settings)
+    )
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,9 +15,92 @@ BOT_NAME = 'airbnb_scraper'
 
 SPIDER_MODULES = ['airbnb_scraper.spiders']
 NEWSPIDER_MODULE = 'airbnb_scraper.spiders'
+COMMANDS_MODULE = 'airbnb_scraper.commands'
+
+# Item storage backend: airbnb_scraper.db.AirbnbMongoDB, or
+# airbnb_scraper.db.AirbnbMemoryDB to keep items in process memory
+STORAGE_CLASS = 'airbnb_scraper.db.AirbnbMongoDB'
 
 MONGO_URI = 'localhost:27017'
 MONGO_DATABASE = 'airbnb_1'
+# Create missing collection indexes when connecting
+MONGO_ENSURE_INDEXES = True
+
+# Buffered writes used by AirbnbMongoBulkPipeline: a collection
+# buffer is flushed when it reaches the size (items) or age (seconds)
+MONGO_BULK_SIZE = 500
+MONGO_BULK_INTERVAL = 10.0
+# Write items whose only change is `update_date` with one update per
+# collection buffer, together with the touches of unchanged items. The
+# update sets the latest update date in the buffer on all of them, so
+# it can be later than the crawl of an item by up to the buffer's age
+MONGO_COALESCE_TOUCHES = False
+
+# Yield listings and days whose source data is unchanged as touches of
+# their IDs, which only refresh `update_date`. Only applies when all item
+# pipelines are MongoDB pipelines and there are no feed exports, so that
+# exports get every item
+SKIP_UNCHANGED_ITEMS = True
+
+# Background writes used by AirbnbMongoAsyncPipeline: number of
+# writer threads and the maximum number of saves in flight
+MONGO_WRITE_THREADS = 4
+MONGO_MAX_PENDING_WRITES = 100
+
+# Store calendar days as per-day arrays in their month documents
+# instead of one document per day (migrate with `scrapy embed_days`)
+CALENDAR_EMBEDDED_DAYS = False
+
+# JSON decoding of API responses: decode only the parts of explore
+# responses which are used, from a stream of parse events (requires
+# ijson), and record peak memory per response in stats (slower)
+JSON_STREAM = False
+JSON_TRACE_MEMORY = False
+
+# File export used by AirbnbExportPipeline: output directory (default
+# `temp/export`), format ('parquet', which requires pyarrow, or 'jsonl'),
+# rows buffered per partition and rows per file
+EXPORT_DIR = ''
+EXPORT_FORMAT = 'parquet'
+EXPORT_ROW_GROUP_SIZE = 10000
+EXPORT_FILE_ROWS = 1000000
+
+# Crawl instrumentation (AirbnbInstrumentation extension): timed spider
+# callbacks, seconds between samples of queue sizes and item rates, and
+# the local address of the Prometheus metrics endpoint (0 disables it)
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_CALLBACKS = ['parse_explore', 'parse_calendar']
+INSTRUMENTATION_INTERVAL = 5.0
+INSTRUMENTATION_HOST = '127.0.0.1'
+INSTRUMENTATION_PORT = 9410
+
+# Profiling of crawls run with `-a profile=cpu` or `-a profile=mem`
+# (AirbnbProfiling extension): output directory (default `temp/profiles`),
+# profiled spider callbacks, number of functions or allocation sites
+# reported, and responses between memory snapshots
+PROFILE_DIR = ''
+PROFILE_CALLBACKS = ['parse_explore', 'parse_calendar']
+PROFILE_TOP = 25
+PROFILE_SNAPSHOT_INTERVAL = 100
+
+# Adaptive throttling of the explore and calendar endpoints, each in its
+# own download slot (AirbnbThrottleMiddleware): the delay starts at the
+# start delay and is lowered by the step down to the minimum delay, then
+# concurrency is raised up to the maximum. Both back off on 429 and 503
+# responses, on average latency above the target (seconds) and on error
+# rates above the maximum. Log every change with THROTTLE_DEBUG. A slot
+# sends at most one request per delay, so each endpoint gets at most
+# 1 / THROTTLE_MIN_DELAY requests per second. Set the minimum delay to 0
+# to let concurrency raise the rate beyond that
+THROTTLE_ENABLED = True
+THROTTLE_START_DELAY = 3.0
+THROTTLE_MIN_DELAY = 0.5
+THROTTLE_MAX_DELAY = 60.0
+THROTTLE_DELAY_STEP = 0.5
+THROTTLE_MAX_CONCURRENCY = 8
+THROTTLE_TARGET_LATENCY = 3.0
+THROTTLE_MAX_ERROR_RATE = 0.1
+THROTTLE_DEBUG = False
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'airbnb_scraper (+http://www.yourdomain.com)'
@@ -31,6 +114,8 @@ ROBOTSTXT_OBEY = True
 # Configure a delay for requests for the same website (default: 0)
 # See https://doc.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
+# API requests are throttled per endpoint by AirbnbThrottleMiddleware,
+# this delay applies to other requests
 DOWNLOAD_DELAY = 3
 # The download delay setting will honor only one of:
 #CONCURRENT_REQUESTS_PER_DOMAIN = 16
@@ -66,19 +151,25 @@ DOWNLOADER_MIDDLEWARES = {
     'scrapy_splash.SplashCookiesMiddleware': 723,
     'scrapy_splash.SplashMiddleware': 725,
     'scrapy.downloadermiddlewares.httpcompression.HttpCompressionMiddleware': 810,
+    # After the HTTP cache, and before retries of 429 and 503 responses
+    'airbnb_scraper.throttle.AirbnbThrottleMiddleware': 950,
 }
 
 # Enable or disable extensions
 # See https://doc.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'airbnb_scraper.extensions.AirbnbInstrumentation': 500,
+    'airbnb_scraper.extensions.AirbnbProfiling': 510,
+}
 
 # Configure item pipelines
 # See https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
    'airbnb_scraper.pipelines.AirbnbMongoPipeline': 100,
-#    'airbnb_scraper.pipelines.AirbnbJsonPipeline': 300,
+#    'airbnb_scraper.pipelines.AirbnbMongoBulkPipeline': 100,
+#    'airbnb_scraper.pipelines.AirbnbMongoAsyncPipeline': 100,
+#    'airbnb_scraper.pipelines.AirbnbExportPipeline': 400,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -94,11 +185,16 @@ ITEM_PIPELINES = {
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
-# Enable and configure HTTP caching (disabled by default)
+# Enable and configure HTTP caching
 # See https://doc.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = 'httpcache'
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Explore and calendar API responses are cached for the stale interval of
+# their items (see airbnb_scraper.httpcache), in gzip files of the given
+# compression level under `.scrapy/<HTTPCACHE_DIR>`. Disabled by default,
+# since items built from cached responses are saved as freshly crawled.
+# Enable it to resume an aborted crawl without fetching again
+HTTPCACHE_ENABLED = False
+HTTPCACHE_DIR = 'httpcache'
+HTTPCACHE_POLICY = 'airbnb_scraper.httpcache.AirbnbCachePolicy'
+HTTPCACHE_STORAGE = 'airbnb_scraper.httpcache.AirbnbCacheStorage'
+HTTPCACHE_COMPRESS_LEVEL = 6
 SPLASH_URL = 'http://localhost:8050'
\ No newline at end of file
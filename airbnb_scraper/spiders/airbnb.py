@@ -9,18 +9,38 @@ import math
 import arrow
 import dateutil
 import urllib
+import time
+import tracemalloc
 from scrapy_splash import SplashRequest
 from scrapy.exceptions import CloseSpider
-from airbnb_scraper.items import AirbnbListing, AirbnbListingCalendarMonth, AirbnbListingCalendarDay, ID_KEY
-from airbnb_scraper.db import AirbnbMongoDB
+from scrapy.utils.conf import build_component_list
+from scrapy.utils.misc import load_object
+from airbnb_scraper.items import AirbnbListing, AirbnbListingCalendarMonth, AirbnbListingCalendarDay, AirbnbCalendarDayRecord, AirbnbExploreTiling, AirbnbTouch, ID_KEY, INFERRED_DAY_KEYS
+from airbnb_scraper.db import AirbnbStorage
+from airbnb_scraper.pipelines import AirbnbMongoPipeline
 from airbnb_scraper import util
-from timezonefinder import TimezoneFinder
+from airbnb_scraper import decoding
+from airbnb_scraper import profiling
+from airbnb_scraper.time_zone import TimeZoneResolver
+from airbnb_scraper.endpoints import EXPLORE_BASE_URL, LISTING_BASE_URL, CALENDAR_BASE_URL
 
 REQUEST_WAIT = '0.5'
 AVAILABILITY_MONTHS = 6
-EXPLORE_BASE_URL = 'https://www.airbnb.com/api/v2/explore_tabs'
-LISTING_BASE_URL = 'https://www.airbnb.com/rooms/'
-CALENDAR_BASE_URL = 'https://www.airbnb.com/api/v2/homes_pdp_availability_calendar'
+# The explore API stops paginating after this many results
+MAX_EXPLORE_RESULTS = 300
+# Upper bound of the finite price bands when no price_max is given
+DEFAULT_SHARD_PRICE_MAX = 1000
+# Half the width of the initial tile around the city center, in degrees
+DEFAULT_TILE_RADIUS = 0.25
+# Tiles are not split below this width, in degrees
+MIN_TILE_SPAN = 0.002
+# Parts of an explore response which are read
+EXPLORE_JSON_PATHS = [
+    ('explore_tabs', 0, 'sections', '*', 'listings'),
+    ('explore_tabs', 0, 'pagination_metadata'),
+    ('explore_tabs', 0, 'home_tab_metadata', 'listings_count'),
+    ('explore_tabs', 0, 'home_tab_metadata', 'geography'),
+]
 KEY = 'd306zoyjsyarp7ifhu67rjxn52tv0t20'
 LOCALE = 'en'
 
@@ -47,7 +67,7 @@ class AirbnbSpider(scrapy.Spider):
     You don't have to override __init__ each time and can simply use self.parameter (See https://bit.ly/2Wxbkd9),
     but I find this way much more readable.
     """
-    def __init__(self, city='', currency='', months=AVAILABILITY_MONTHS, *args, **kwargs):
+    def __init__(self, city='', currency='', months=AVAILABILITY_MONTHS, price_shards=0, tiles=False, bounds='', profile='', *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.filters = dict(kwargs)
         if bool(city):
@@ -69,9 +89,22 @@ class AirbnbSpider(scrapy.Spider):
 
         self.logger.debug(f'Created crawler with filters: {self.filters}')
 
+        self.city = city
         self.currency = currency
         self.months = months
+        self.price_shards = int(price_shards)
+        self.tiles = str(tiles).lower() in ['true', '1', 'yes']
+        self.bounds = tuple(float(x) for x in bounds.split(',')) if bool(bounds) else None
+        if self.bounds is not None and len(self.bounds) != 4:
+            raise ValueError('Expected bounds as "sw_lat,sw_lng,ne_lat,ne_lng"')
+        # Profiler mode used by the AirbnbProfiling extension
+        self.profile = profile
+        if bool(self.profile) and self.profile not in profiling.MODES:
+            raise ValueError(f'Expected profile as one of: {", ".join(profiling.MODES)}')
+        self.tile_leaves = set()
+        self._skip_unchanged = None
         self.request_date = arrow.get()
+        self.seen_listing_ids = set()
 
     def base_params(self):
         params = {
@@ -89,7 +122,7 @@ class AirbnbSpider(scrapy.Spider):
         query = urllib.parse.urlencode({str(k): str(v) for k, v in params.items()})
         return base + '?' + query
 
-    def create_explore_url(self, items_offset=0, section_offset=0):
+    def create_explore_url(self, items_offset=0, section_offset=0, price_band=None, tile=None):
         params = self.base_params()
         params.update({
             '_format': 'for_explore_search_web',
@@ -115,6 +148,24 @@ class AirbnbSpider(scrapy.Spider):
                 key = FILTER_URL_KEY_MAP[key]
             params[key] = value
 
+        if price_band is not None:
+            price_min, price_max = price_band
+            params['price_min'] = price_min
+            if price_max is not None:
+                params['price_max'] = price_max
+            elif 'price_max' in params:
+                del params['price_max']
+
+        if tile is not None:
+            sw_lat, sw_lng, ne_lat, ne_lng = tile
+            params.update({
+                'search_by_map': 'true',
+                'sw_lat': sw_lat,
+                'sw_lng': sw_lng,
+                'ne_lat': ne_lat,
+                'ne_lng': ne_lng,
+            })
+
         if bool(items_offset):
             params['items_offset'] = items_offset
         if bool(section_offset):
@@ -144,19 +195,196 @@ class AirbnbSpider(scrapy.Spider):
         """
 
         # Open database connection
-        AirbnbMongoDB.shared().open()
+        AirbnbStorage.shared().open()
+
+        # Load time zone data
+        TimeZoneResolver.shared().open()
+
+        tiles = [None]
+        if self.tiles:
+            tiles = self.load_tiles()
+            if not bool(tiles):
+                # Find the city bounds before tiling
+                yield self.create_explore_request(discover_tiles=True)
+                return
+
+        for price_band in self.create_price_bands():
+            for tile in tiles:
+                yield self.create_explore_request(price_band=price_band, tile=tile)
+
+    def create_price_bands(self):
+        """
+        Splits the price filter into `price_shards` bands
+        which are explored concurrently. If there is no maximum
+        price, the last band is open ended.
+
+        Returns:
+            A list of `(price_min, price_max)` tuples, or `[None]`
+            if sharding is disabled.
+        """
+        if self.price_shards <= 1:
+            return [None]
+
+        price_min = self.filters.get('price_min', 1)
+        price_max = self.filters.get('price_max')
+        upper = price_max if price_max is not None else max(DEFAULT_SHARD_PRICE_MAX, price_min)
+        step = max(1, int(math.ceil((upper - price_min + 1) / self.price_shards)))
+
+        bands = []
+        lower = price_min
+        while lower <= upper:
+            bands.append((lower, min(lower + step - 1, upper)))
+            lower += step
+        if price_max is None:
+            bands.append((upper + 1, None))
+        return bands
+
+    def split_price_band(self, price_band):
+        """
+        Splits a price band in two. An open ended band is
+        split at twice its minimum price, so that expensive
+        listings are split until every band fits.
 
-        url = self.create_explore_url()
-        self.logger.debug(f'Starting explore: \n{url}')
-        yield scrapy.Request(
+        Returns:
+            A list of sub-bands, which is empty if the
+            band cannot be split.
+        """
+        price_min, price_max = price_band
+        if price_max is None:
+            upper = max(2 * price_min, 1)
+            return [(price_min, upper), (upper + 1, None)]
+        if price_max <= price_min:
+            return []
+        mid = (price_min + price_max) // 2
+        return [(price_min, mid), (mid + 1, price_max)]
+
+    def load_tiles(self):
+        """
+        Returns the leaf tiles saved by a previous crawl
+        of the query, or a tile covering `bounds`.
+        """
+        if self.bounds is not None:
+            self.tile_leaves = {self.bounds}
+            return [self.bounds]
+        if not self.saves_tiles:
+            return []
+        tiling = AirbnbExploreTiling.load(AirbnbExploreTiling.create_id(query=self.filters.get('query')))
+        if tiling is None:
+            return []
+        self.tile_leaves = set(tuple(tile) for tile in tiling.get('tiles') or [])
+        self.logger.debug(f'Loaded {len(self.tile_leaves)} explore tiles')
+        return sorted(self.tile_leaves)
+
+    @property
+    def saves_tiles(self):
+        """
+        Whether tiles are kept between crawls. Tilings are
+        keyed by query, so crawls without a query, or only
+        of an area within `bounds`, do not keep them.
+        """
+        return self.tiles and bool(self.filters.get('query')) and self.bounds is None
+
+    def save_tiles(self):
+        if not self.saves_tiles or not bool(self.tile_leaves):
+            return
+        tiling_id = AirbnbExploreTiling.create_id(query=self.filters.get('query'))
+        tiling = AirbnbExploreTiling.load(tiling_id)
+        if tiling is None:
+            tiling = AirbnbExploreTiling.create()
+        tiling['update_date'] = arrow.get()
+        tiling['query'] = self.filters.get('query')
+        tiling['tiles'] = [list(tile) for tile in sorted(self.tile_leaves)]
+        tiling.update_id()
+        tiling.save()
+
+    def create_root_tile(self, explore_tab):
+        geography = explore_tab.get('home_tab_metadata', {}).get('geography') or {}
+        lat = geography.get('lat')
+        lng = geography.get('lng')
+        if lat is None or lng is None:
+            return None
+        return tuple(round(x, 6) for x in [
+            lat - DEFAULT_TILE_RADIUS,
+            lng - DEFAULT_TILE_RADIUS,
+            lat + DEFAULT_TILE_RADIUS,
+            lng + DEFAULT_TILE_RADIUS,
+        ])
+
+    def split_tile(self, tile):
+        """
+        Splits a tile into four quadrants.
+
+        Returns:
+            A list of sub-tiles, which is empty if the
+            tile is too small to split.
+        """
+        sw_lat, sw_lng, ne_lat, ne_lng = tile
+        if ne_lat - sw_lat < 2 * MIN_TILE_SPAN or ne_lng - sw_lng < 2 * MIN_TILE_SPAN:
+            return []
+        mid_lat = round((sw_lat + ne_lat) / 2, 6)
+        mid_lng = round((sw_lng + ne_lng) / 2, 6)
+        return [
+            (sw_lat, sw_lng, mid_lat, mid_lng),
+            (sw_lat, mid_lng, mid_lat, ne_lng),
+            (mid_lat, sw_lng, ne_lat, mid_lng),
+            (mid_lat, mid_lng, ne_lat, ne_lng),
+        ]
+
+    def split_explore(self, price_band=None, tile=None):
+        """
+        Splits a saturated search by tile if possible,
+        otherwise by price band.
+
+        Returns:
+            A list of `(price_band, tile)` pairs covering
+            the search, which is empty if it cannot be split.
+        """
+        if tile is not None:
+            sub_tiles = self.split_tile(tile)
+            if bool(sub_tiles):
+                self.tile_leaves.discard(tile)
+                self.tile_leaves.update(sub_tiles)
+                self.inc_stat('airbnb/explore/tiles_split')
+                return [(price_band, sub_tile) for sub_tile in sub_tiles]
+
+        if price_band is not None:
+            sub_bands = self.split_price_band(price_band)
+            if bool(sub_bands):
+                self.inc_stat('airbnb/explore/bands_split')
+                return [(sub_band, tile) for sub_band in sub_bands]
+
+        return []
+
+    def create_explore_request(self, price_band=None, tile=None, items_offset=0, section_offset=0, discover_tiles=False):
+        url = self.create_explore_url(
+            items_offset=items_offset,
+            section_offset=section_offset,
+            price_band=price_band,
+            tile=tile
+        )
+        if bool(items_offset) or bool(section_offset):
+            self.logger.debug(f'Continuing explore: \n{url}')
+        else:
+            self.logger.debug(f'Starting explore: \n{url}')
+            self.inc_stat('airbnb/explore/streams')
+        return scrapy.Request(
             url=url,
             callback=self.parse_explore,
-            dont_filter=True
+            meta={
+                'price_band': price_band,
+                'tile': tile,
+                'discover_tiles': discover_tiles,
+            },
+            dont_filter=not bool(items_offset) and not bool(section_offset)
         )
 
     def closed(self, reason):
-        # Close database connection
-        AirbnbMongoDB.shared().close()
+        try:
+            # Keep the tiles for the next crawl
+            self.save_tiles()
+        finally:
+            # Close database connection
+            AirbnbStorage.shared().close()
 
     def parse_explore(self, response):
         """Parses all the URLs/ids/available fields from the initial json object and stores into dictionary
@@ -168,13 +396,17 @@ class AirbnbSpider(scrapy.Spider):
         self.logger.debug(f'Parsing explore: \n{response.url}')
         
         # Fetch and Write the response data
-        data = json.loads(response.body)
+        data = self.decode_json(response, 'explore', paths=EXPLORE_JSON_PATHS)
+        explore_tab = data.get('explore_tabs')[0]
+        price_band = response.meta.get('price_band')
+        tile = response.meta.get('tile')
 
         homes = []
-        listings = []
-        tf = TimezoneFinder()
+        homes_count = 0
+        listing_dicts = []
+        listing_ids = set()
 
-        for section in data.get('explore_tabs')[0].get('sections'):
+        for section in explore_tab.get('sections'):
             # Return a List of all homes
             try: 
                 homes = list(section.get('listings') or [])
@@ -182,21 +414,23 @@ class AirbnbSpider(scrapy.Spider):
                 homes = []
 
             for home in homes:
+                homes_count += 1
                 listing_info = home.get('listing')
                 listing_id = str(listing_info.get('id'))
+                if listing_id in self.seen_listing_ids:
+                    # Pages and price bands can overlap
+                    self.logger.debug(f'Skipping duplicate listing "{listing_id}"')
+                    self.inc_stat('airbnb/explore/duplicate_listings')
+                    continue
+                self.seen_listing_ids.add(listing_id)
+                listing_ids.add(listing_id)
                 self.logger.debug(f'Parsing listing "{listing_id}"')
 
-                lat = listing_info.get('lat')
-                lng = listing_info.get('lng')
-                time_zone = tf.timezone_at(lng=lng, lat=lat) or 'UTC'
-                # self.logger.debug(f'Listing {listing_id} time zone: {time_zone}')
-
                 url = LISTING_BASE_URL + str(listing_id)
 
                 listing_dict = {}
                 listing_dict['listing_id'] = listing_id
                 listing_dict['url'] = url
-                listing_dict['time_zone'] = time_zone
 
                 # Add data from fetch
                 for key in AirbnbListing.fields:
@@ -220,78 +454,251 @@ class AirbnbSpider(scrapy.Spider):
                 rate_with_service_fee_info = pricing_quote.get('rate_with_service_fee')
                 listing_dict['rate_with_service_fee'] = rate_with_service_fee_info.get('amount')
 
-                # # Get hash of values
-                # listing_dict['source_hash'] = util.hash_str(listing_dict)
+                listing_dicts.append(listing_dict)
+
+        if homes_count == 0:
+            if price_band is None and tile is None:
+                raise CloseSpider("No homes available in the city and price parameters")
+            self.logger.debug(f'No homes available in price band {price_band} and tile {tile}')
+            return
+
+        # A saturated search cannot be paged through, so
+        # explore its parts instead
+        is_first_page = not bool(response.meta.get('explore_page'))
+        listings_count = explore_tab.get('home_tab_metadata', {}).get('listings_count') or 0
+        sub_searches = []
+        if response.meta.get('discover_tiles'):
+            root_tile = self.create_root_tile(explore_tab)
+            if root_tile is not None:
+                self.logger.debug(f'Tiling explore from {root_tile}')
+                self.tile_leaves = {root_tile}
+                sub_searches = [(price_band, root_tile) for price_band in self.create_price_bands()]
+            else:
+                self.logger.warning('City bounds not found, exploring without tiles')
+        elif is_first_page and listings_count > MAX_EXPLORE_RESULTS \
+                and (price_band is not None or tile is not None):
+            sub_searches = self.split_explore(price_band=price_band, tile=tile)
+            if bool(sub_searches):
+                self.logger.debug(f'Splitting search with {listings_count} listings (price band {price_band}, tile {tile})')
+            else:
+                self.logger.warning(f'Search has {listings_count} listings and cannot be split (price band {price_band}, tile {tile})')
+        for sub_band, sub_tile in sub_searches:
+            yield self.create_explore_request(price_band=sub_band, tile=sub_tile)
+
+        # Fetch existing listings and their current months
+        # for the whole page at once
+        existing_listings = self.prefetch_items(AirbnbListing, listing_ids)
 
-                # Apply data to listing
-                listing = AirbnbListing.load(listing_id)
+        now = arrow.get()
+        current_month_ids = {}
+        for listing_dict in listing_dicts:
+            listing_id = listing_dict['listing_id']
+            listing_dict['time_zone'] = self.resolve_time_zone(
+                listing_dict,
+                existing_listing=existing_listings.get(listing_id)
+            )
+            # self.logger.debug(f'Listing {listing_id} time zone: {listing_dict["time_zone"]}')
+            current_month_ids[listing_id] = AirbnbListingCalendarMonth.create_id(
+                listing_id=listing_id,
+                date=now,
+                tzinfo=listing_dict['time_zone']
+            )
+        existing_months = self.prefetch_items(AirbnbListingCalendarMonth, current_month_ids.values())
+
+        resolver = TimeZoneResolver.shared()
+        self.set_stat('airbnb/time_zone/cache_hits', resolver.hits)
+        self.set_stat('airbnb/time_zone/cache_misses', resolver.misses)
+
+        # Listings whose source data is unchanged are only touched
+        unchanged_listing_ids = []
+        for listing_dict in listing_dicts:
+            listing_id = listing_dict['listing_id']
+
+            # Apply data to listing
+            listing = existing_listings.get(listing_id)
+            source_hash = util.hash_str(listing_dict)
+            if listing is not None and listing.get('source_hash') == source_hash and self.skip_unchanged:
+                self.inc_stat('airbnb/fingerprint/listings_unchanged')
+                unchanged_listing_ids.append(listing_id)
+                listing = None
+            else:
                 if listing is None:
                     listing = AirbnbListing.create()
-                listings.append(listing)
-
                 listing['update_date'] = arrow.now()
                 for key, value in listing_dict.items():
                     listing[key] = value
+                listing['source_hash'] = source_hash
                 listing.update_id()
 
-                # yield SplashRequest(
-                #     url=LISTING_BASE_URL+listing_id,
-                #     callback=self.parse_listing_details,
-                #     meta=listing,
-                #     endpoint="render.html",
-                #     args={'wait': REQUEST_WAIT}
-                # )
+            # yield SplashRequest(
+            #     url=LISTING_BASE_URL+listing_id,
+            #     callback=self.parse_listing_details,
+            #     meta=listing,
+            #     endpoint="render.html",
+            #     args={'wait': REQUEST_WAIT}
+            # )
 
-                # Save listing
+            # Save listing
+            if listing is not None:
                 yield listing
 
-                # Check if should fetch calendar
-                time_zone = listing['time_zone']
-                current_month_id = AirbnbListingCalendarMonth.create_id(
-                    listing_id=listing_id,
-                    date=arrow.get(),
-                    tzinfo=time_zone
-                )
-                current_month = AirbnbListingCalendarMonth.load(current_month_id)
-                if current_month is not None and not current_month.is_stale:
-                    # No need to refetch calendar
-                    self.logger.debug(f'Skipping listing "{listing_id}" calendar fetch')
-                    continue
+            # Check if should fetch calendar
+            time_zone = listing_dict['time_zone']
+            current_month = existing_months.get(current_month_ids[listing_id])
+            if current_month is not None and not current_month.is_stale:
+                # No need to refetch calendar
+                self.logger.debug(f'Skipping listing "{listing_id}" calendar fetch')
+                continue
 
-                # Fetch listing calendar
-                calendar_url = self.create_calendar_url(
-                    listing_id=listing_id,
-                    time_zone=time_zone
-                )
-                calendar_meta = {
-                    'listing_id': listing_id,
-                    'currency': listing_dict['currency'],
-                    'time_zone': time_zone
-                }
-                self.logger.debug(f'Fetching listing "{listing_id}" calendar: {calendar_url}')
-                yield scrapy.Request(
-                    url=calendar_url,
-                    callback=self.parse_calendar,
-                    meta=calendar_meta,
-                    dont_filter=True
-                )
+            # Fetch listing calendar
+            calendar_url = self.create_calendar_url(
+                listing_id=listing_id,
+                time_zone=time_zone
+            )
+            calendar_meta = {
+                'listing_id': listing_id,
+                'currency': listing_dict['currency'],
+                'time_zone': time_zone
+            }
+            self.logger.debug(f'Fetching listing "{listing_id}" calendar: {calendar_url}')
+            yield scrapy.Request(
+                url=calendar_url,
+                callback=self.parse_calendar,
+                meta=calendar_meta,
+                dont_filter=True
+            )
 
-        if not bool(listings):
-            raise CloseSpider("No homes available in the city and price parameters")
+        if bool(unchanged_listing_ids):
+            yield AirbnbTouch.create(AirbnbListing, unchanged_listing_ids, update_date=now)
         
         # After scraping entire listings page, check if more pages are available
-        pagination_metadata = data.get('explore_tabs')[0].get('pagination_metadata')
-        if pagination_metadata.get('has_next_page'):
+        pagination_metadata = explore_tab.get('pagination_metadata')
+        if pagination_metadata.get('has_next_page') and not bool(sub_searches):
             # If there is a next page, update url and scrape from next page
-            url = self.create_explore_url(
+            request = self.create_explore_request(
+                price_band=price_band,
+                tile=tile,
                 items_offset=pagination_metadata.get('items_offset'),
                 section_offset=pagination_metadata.get('section_offset'),
             )
-            self.logger.debug(f'Continuing explore: \n{url}')
-            yield scrapy.Request(
-                url=url,
-                callback=self.parse_explore
-            )
+            request.meta['explore_page'] = response.meta.get('explore_page', 0) + 1
+            yield request
+
+    def resolve_time_zone(self, listing_dict, existing_listing=None):
+        """
+        Returns the time zone of a listing. The stored time
+        zone is reused if the listing has not moved.
+        """
+        lat = listing_dict.get('lat')
+        lng = listing_dict.get('lng')
+        if existing_listing is not None \
+                and bool(existing_listing.get('time_zone')) \
+                and existing_listing.get('lat') == lat \
+                and existing_listing.get('lng') == lng:
+            self.inc_stat('airbnb/time_zone/reused')
+            return existing_listing['time_zone']
+        return TimeZoneResolver.shared().time_zone_at(lat=lat, lng=lng) or 'UTC'
+
+    @property
+    def skip_unchanged(self):
+        """
+        Whether listings and days with unchanged source data
+        are yielded as touches (see `SKIP_UNCHANGED_ITEMS`).
+        Only storage pipelines save touches, so unchanged
+        items are yielded whole when other pipelines or feed
+        exports are enabled.
+        """
+        if self._skip_unchanged is None:
+            settings = getattr(self, 'settings', None)
+            if settings is None or not settings.getbool('SKIP_UNCHANGED_ITEMS') or bool(settings.getdict('FEEDS')):
+                self._skip_unchanged = False
+            else:
+                pipeline_classes = [
+                    load_object(path) for path in build_component_list(settings.getwithbase('ITEM_PIPELINES'))
+                ]
+                self._skip_unchanged = bool(pipeline_classes) and all(
+                    issubclass(cls, AirbnbMongoPipeline) for cls in pipeline_classes
+                )
+        return self._skip_unchanged
+
+    @property
+    def embed_days(self):
+        """Whether days are stored in their months (see `CALENDAR_EMBEDDED_DAYS`)."""
+        settings = getattr(self, 'settings', None)
+        return settings is not None and settings.getbool('CALENDAR_EMBEDDED_DAYS')
+
+    def decode_json(self, response, kind, paths=None):
+        """
+        Decodes a JSON response body and records the decoding
+        time, and optionally peak memory, in stats under
+        `airbnb/json/<kind>/`.
+
+        If paths are given (see `decoding.load_paths()`), only
+        the values at the paths are decoded when `JSON_STREAM`
+        is enabled.
+        """
+        settings = getattr(self, 'settings', None)
+        stream = settings is not None and settings.getbool('JSON_STREAM')
+        # An outer trace (e.g. a profiler) is left alone
+        trace_memory = settings is not None and settings.getbool('JSON_TRACE_MEMORY') and not tracemalloc.is_tracing()
+
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            if paths is None:
+                data = decoding.loads(response.body)
+            else:
+                data = decoding.load_paths(response.body, paths, stream=stream)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            if trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        prefix = f'airbnb/json/{kind}'
+        self.inc_stat(f'{prefix}/responses')
+        self.inc_stat(f'{prefix}/bytes', len(response.body))
+        self.inc_stat(f'{prefix}/time_ms', elapsed_ms)
+        self.max_stat(f'{prefix}/time_ms_max', elapsed_ms)
+        if trace_memory:
+            self.inc_stat(f'{prefix}/peak_memory', peak_memory)
+            self.max_stat(f'{prefix}/peak_memory_max', peak_memory)
+        return data
+
+    def prefetch_items(self, item_cls, ids):
+        """
+        Loads existing items with the given IDs
+        in a single query.
+
+        Returns:
+            A dictionary of items keyed by ID.
+        """
+        ids = list(ids)
+        if not bool(ids):
+            return {}
+        items = item_cls.load_many(ids)
+        # One query replaces one load per ID
+        self.inc_stat('airbnb/prefetch/queries_saved', len(ids) - 1)
+        return items
+
+    def inc_stat(self, key, count=1):
+        crawler = getattr(self, 'crawler', None)
+        if crawler is None or crawler.stats is None:
+            return
+        crawler.stats.inc_value(key, count, spider=self)
+
+    def max_stat(self, key, value):
+        crawler = getattr(self, 'crawler', None)
+        if crawler is None or crawler.stats is None:
+            return
+        crawler.stats.max_value(key, value, spider=self)
+
+    def set_stat(self, key, value):
+        crawler = getattr(self, 'crawler', None)
+        if crawler is None or crawler.stats is None:
+            return
+        crawler.stats.set_value(key, value, spider=self)
 
     # def parse_listing_details(self, response):
     #     """
@@ -343,32 +750,27 @@ class AirbnbSpider(scrapy.Spider):
     def parse_calendar(self, response):
         assert response.url.startswith(CALENDAR_BASE_URL), f'Unexpected calendar response URL: {response.url}'
 
-        # Clean JSON response
-        json_str = str(response.body)
-        try:
-            json_start = json_str.index('{')
-        except Exception:
-            json_start = 0
-        try:
-            json_end = json_str.rindex('}')
-        except Exception:
-            json_end = len(json_str) - 1
-        json_str = json_str[json_start:json_end + 1]
         # self.logger.debug(f'Calendar URL:\n{response.url}')
         # self.logger.debug(f'Calendar response body:\n{response.body}')
-
-        data = json.loads(json_str)
+        data = self.decode_json(response, 'calendar')
         month_infos = data.get('calendar_months')
         listing_id = response.meta['listing_id']
         assert bool(listing_id), 'Missing listing ID'
         time_zone = response.meta['time_zone'] or 'UTC'
         currency = response.meta['currency']
 
+        embed_days = self.embed_days
+        skip_unchanged = self.skip_unchanged
         all_months = []
         all_days = []
         months_and_days = []
+        # Days with unchanged source data, with their inferred values
+        unchanged_days = []
         now = arrow.get()
 
+        # Resolve all month and day IDs first, so that
+        # existing items can be loaded in bulk
+        month_entries = []
         for month_info in month_infos:
             month_num = month_info.get('month')
             year_num = month_info.get('year')
@@ -378,8 +780,35 @@ class AirbnbSpider(scrapy.Spider):
                 date=start_date,
                 tzinfo=time_zone
             )
+            day_entries = []
+            for day_info in month_info.get('days'):
+                date = arrow.get(day_info.get('date')).replace(tzinfo=time_zone)
+                day_id = None
+                if not embed_days:
+                    day_id = AirbnbListingCalendarDay.create_id(
+                        listing_id=listing_id,
+                        date=date,
+                        tzinfo=time_zone
+                    )
+                day_entries.append((day_info, date, day_id))
+            month_entries.append((month_info, start_date, month_id, day_entries))
+
+        existing_months = self.prefetch_items(
+            AirbnbListingCalendarMonth,
+            [month_id for _, _, month_id, _ in month_entries]
+        )
+        existing_days = {}
+        if not embed_days:
+            existing_days = self.prefetch_items(
+                AirbnbCalendarDayRecord,
+                [day_id for _, _, _, day_entries in month_entries for _, _, day_id in day_entries]
+            )
+
+        for month_info, start_date, month_id, day_entries in month_entries:
+            month_num = month_info.get('month')
+            year_num = month_info.get('year')
             # self.logger.debug(f'Parsing listing "{listing_id}" month {year_num}-{month_num:02} ({month_id})')
-            month = AirbnbListingCalendarMonth.load(month_id)
+            month = existing_months.get(month_id)
             if month is None:
                 self.logger.debug(f'Creating month: {month_id}')
                 month = AirbnbListingCalendarMonth.create(creation_date=now)
@@ -395,32 +824,41 @@ class AirbnbSpider(scrapy.Spider):
             month['year'] = year_num
             
             days = []
-            day_infos = month_info.get('days')
-            for day_info in day_infos:
-                date = arrow.get(day_info.get('date')).replace(tzinfo=time_zone)
-                day_id = AirbnbListingCalendarDay.create_id(
-                    listing_id=listing_id,
-                    date=date,
-                    tzinfo=time_zone
-                )
-                day = AirbnbListingCalendarDay.load(day_id)
-                if day is None:
-                    self.logger.debug(f'Creating day: {day_id}')
-                    day = AirbnbListingCalendarDay.create(creation_date=now)
+            for day_info, date, day_id in day_entries:
+                if embed_days:
+                    # Listing, currency and time zone are stored on the month
+                    day = month.get_or_create_embedded_day(date, creation_date=now)
+                else:
+                    day = existing_days.get(day_id)
+                    if day is None:
+                        self.logger.debug(f'Creating day: {day_id}')
+                        day = AirbnbCalendarDayRecord.create(creation_date=now)
+                    day['listing_id'] = listing_id
+                    day['currency'] = currency
+                    day['time_zone'] = time_zone
                 day['update_date'] = now
 
-                day['listing_id'] = listing_id
-                day['currency'] = currency
-                day['time_zone'] = time_zone
-
                 day['date'] = date
                 day['available'] = day_info.get('available')
 
-                price_strings = re.findall(r'\d+', day_info.get('price').get('local_price_formatted') or '')
+                price_formatted = day_info.get('price').get('local_price_formatted')
+                price_strings = re.findall(r'\d+', price_formatted or '')
                 if len(price_strings) == 1:
                     day['price'] = float(price_strings[0])
 
-                day.update_id()
+                if not embed_days:
+                    day.update_id()
+                    source_hash = util.hash_str({
+                        'listing_id': listing_id,
+                        'date': day_info.get('date'),
+                        'available': day_info.get('available'),
+                        'price': price_formatted,
+                        'currency': currency,
+                        'time_zone': time_zone,
+                    })
+                    if skip_unchanged and day.get('source_hash') == source_hash:
+                        unchanged_days.append((day, tuple(day.get(key) for key in INFERRED_DAY_KEYS)))
+                    day['source_hash'] = source_hash
                 days.append(day)
                 all_days.append(day)
 
@@ -431,7 +869,7 @@ class AirbnbSpider(scrapy.Spider):
             months_and_days.append((month, days))
 
         # Update day group
-        AirbnbListingCalendarDay.update_group(all_days)
+        AirbnbCalendarDayRecord.update_group(all_days)
 
         # Update days and months with days
         for month_and_days in months_and_days:
@@ -440,7 +878,20 @@ class AirbnbSpider(scrapy.Spider):
                 day.update_inferred()
             month.update_with_days(days)
 
+        # Days whose source data and the values inferred from
+        # it are unchanged are only touched
+        skipped_days = {}
+        for day, inferred_values in unchanged_days:
+            if inferred_values == tuple(day.get(key) for key in INFERRED_DAY_KEYS):
+                skipped_days[id(day)] = day[ID_KEY]
+        self.inc_stat('airbnb/fingerprint/days_unchanged', len(skipped_days))
+
         for month in all_months:
             yield month
-        for day in all_days:
-            yield day
+        if not embed_days:
+            # Create day items one at a time, as they are consumed
+            for day in all_days:
+                if id(day) not in skipped_days:
+                    yield day.to_item()
+            if bool(skipped_days):
+                yield AirbnbTouch.create(AirbnbListingCalendarDay, skipped_days.values(), update_date=now)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive throttling of the explore and calendar API endpoints.
+
+`AirbnbThrottleMiddleware` sends the requests of each endpoint in
+`THROTTLED_ENDPOINTS` through a separate download slot, and adjusts
+the concurrency and delay of the slot with an `AimdController`:
+
+- The rate is increased additively once per window of successful
+  responses, about once per round trip. The delay is lowered by
+  `THROTTLE_DELAY_STEP` down to `THROTTLE_MIN_DELAY`, then the
+  concurrency is raised by one up to `THROTTLE_MAX_CONCURRENCY`.
+  A slot sends at most one request per delay, so the rate of an
+  endpoint is at most one request per `THROTTLE_MIN_DELAY`, and
+  concurrency is only raised while the delay is shorter than the
+  latency divided by the concurrency.
+- The rate is decreased multiplicatively on 429 and 503 responses,
+  when the average latency exceeds `THROTTLE_TARGET_LATENCY`, and
+  when the average error rate (download errors and other 5xx
+  responses) exceeds `THROTTLE_MAX_ERROR_RATE`. The concurrency is
+  halved, or the delay doubled once it is 1, and `Retry-After` is
+  honored. Decreases are at most once per round trip, so that a
+  burst of failures of requests already in flight counts once.
+
+Cached responses are ignored. The slot values, average latency,
+error rate and requests per minute of each endpoint are written to
+the crawl stats under `airbnb/throttle/<endpoint>/`.
+"""
+
+import math
+import time
+from collections import deque
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from airbnb_scraper.endpoints import EXPLORE_BASE_URL, CALENDAR_BASE_URL
+
+# Download slot names of the throttled endpoints
+THROTTLED_ENDPOINTS = {
+    EXPLORE_BASE_URL: 'explore',
+    CALENDAR_BASE_URL: 'calendar',
+}
+# Weight of the last response in the average latency and error rate
+LATENCY_SMOOTHING = 0.2
+ERROR_SMOOTHING = 0.05
+# Seconds over which requests per minute are measured
+RATE_PERIOD = 60.0
+
+
+def endpoint_slot(url):
+    """Returns the throttled slot name of a URL, or `None`."""
+    return THROTTLED_ENDPOINTS.get(url.split('?', 1)[0])
+
+
+class AimdController:
+    """
+    Additive increase, multiplicative decrease controller
+    of the concurrency and delay of a download slot.
+    """
+
+    def __init__(self, start_delay=3.0, min_delay=0.5, max_delay=60.0, max_concurrency=8, delay_step=0.5,
+                 decrease_factor=0.5, target_latency=3.0, max_error_rate=0.1):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.delay_step = delay_step
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+
+        self.concurrency = 1
+        self.delay = min(max(start_delay, min_delay), max_delay)
+        self.latency = None
+        self.error_rate = 0.0
+        self.window_successes = 0
+        self.last_decrease = None
+        self.increases = 0
+        self.decreases = 0
+        self.response_dates = deque()
+
+    def add_response(self, now, latency=None, error=False):
+        self.response_dates.append(now)
+        while now - self.response_dates[0] > RATE_PERIOD:
+            self.response_dates.popleft()
+        if latency is not None:
+            self.latency = latency if self.latency is None else (
+                LATENCY_SMOOTHING * latency + (1.0 - LATENCY_SMOOTHING) * self.latency
+            )
+        self.error_rate = ERROR_SMOOTHING * float(error) + (1.0 - ERROR_SMOOTHING) * self.error_rate
+
+    def on_success(self, now, latency=None):
+        """
+        Records a successful response.
+
+        Returns:
+            Whether the slot values changed.
+        """
+        self.add_response(now, latency=latency)
+        if self.is_congested():
+            return self.decrease(now)
+
+        self.window_successes += 1
+        if self.window_successes < self.concurrency:
+            return False
+        self.window_successes = 0
+        if self.delay > self.min_delay:
+            self.delay = max(self.min_delay, self.delay - self.delay_step)
+        elif self.concurrency < self.max_concurrency and not self.is_delay_bound():
+            self.concurrency += 1
+        else:
+            return False
+        self.increases += 1
+        return True
+
+    def on_error(self, now, latency=None):
+        """Records a download error or a server error response."""
+        self.add_response(now, latency=latency, error=True)
+        if self.is_congested():
+            return self.decrease(now)
+        return False
+
+    def on_backoff(self, now, latency=None, retry_after=None):
+        """Records a response asking to slow down (429 or 503)."""
+        self.add_response(now, latency=latency, error=True)
+        changed = self.decrease(now)
+        if retry_after is not None and retry_after > self.delay:
+            self.delay = min(self.max_delay, retry_after)
+            changed = True
+        return changed
+
+    def is_delay_bound(self):
+        """
+        Whether the delay limits the rate. A slot sends at most
+        one request per delay, so concurrency beyond the requests
+        sent during one latency does not raise it.
+        """
+        if self.delay <= 0 or self.latency is None:
+            return False
+        return self.concurrency * self.delay >= self.latency
+
+    def is_congested(self):
+        if self.latency is not None and self.latency > self.target_latency:
+            return True
+        return self.error_rate > self.max_error_rate
+
+    def decrease(self, now):
+        # Responses of requests sent before the last decrease
+        # do not reflect it yet
+        round_trip = max(self.latency or 0.0, self.delay, 1.0)
+        if self.last_decrease is not None and now - self.last_decrease < round_trip:
+            return False
+        self.last_decrease = now
+        self.window_successes = 0
+        if self.concurrency > 1:
+            self.concurrency = max(1, int(math.floor(self.concurrency * self.decrease_factor)))
+        else:
+            self.delay = min(self.max_delay, max(self.delay / self.decrease_factor, self.delay_step))
+        self.decreases += 1
+        return True
+
+    def requests_per_minute(self, now):
+        """Returns the number of responses in the last minute."""
+        while bool(self.response_dates) and now - self.response_dates[0] > RATE_PERIOD:
+            self.response_dates.popleft()
+        return len(self.response_dates) * 60.0 / RATE_PERIOD
+
+
+class AirbnbThrottleMiddleware:
+    """
+    Downloader middleware which throttles each API endpoint
+    in its own download slot (see `AimdController`).
+    """
+
+    def __init__(self, crawler, controller_kwargs=None, debug=False):
+        self.crawler = crawler
+        self.controller_kwargs = dict(controller_kwargs or {})
+        self.debug = debug
+        self.controllers = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('THROTTLE_ENABLED'):
+            raise NotConfigured()
+        middleware = cls(
+            crawler,
+            controller_kwargs=dict(
+                start_delay=settings.getfloat('THROTTLE_START_DELAY', 3.0),
+                min_delay=settings.getfloat('THROTTLE_MIN_DELAY', 0.5),
+                max_delay=settings.getfloat('THROTTLE_MAX_DELAY', 60.0),
+                max_concurrency=settings.getint('THROTTLE_MAX_CONCURRENCY', 8),
+                delay_step=settings.getfloat('THROTTLE_DELAY_STEP', 0.5),
+                target_latency=settings.getfloat('THROTTLE_TARGET_LATENCY', 3.0),
+                max_error_rate=settings.getfloat('THROTTLE_MAX_ERROR_RATE', 0.1),
+            ),
+            debug=settings.getbool('THROTTLE_DEBUG')
+        )
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def get_controller(self, name):
+        controller = self.controllers.get(name)
+        if controller is None:
+            controller = self.controllers[name] = AimdController(**self.controller_kwargs)
+        return controller
+
+    def process_request(self, request, spider):
+        name = endpoint_slot(request.url)
+        if name is None:
+            return None
+        request.meta.setdefault('download_slot', name)
+        # The slot is created by the downloader after the first request
+        self.apply(name, request.meta['download_slot'])
+        return None
+
+    def process_response(self, request, response, spider):
+        name = endpoint_slot(request.url)
+        if name is None or 'cached' in response.flags:
+            return response
+        controller = self.get_controller(name)
+        now = time.monotonic()
+        latency = request.meta.get('download_latency')
+        if response.status in (429, 503):
+            changed = controller.on_backoff(now, latency=latency, retry_after=retry_after(response))
+        elif response.status >= 500:
+            changed = controller.on_error(now, latency=latency)
+        else:
+            changed = controller.on_success(now, latency=latency)
+        self.update(name, request, response.status, changed, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        name = endpoint_slot(request.url)
+        if name is None or isinstance(exception, IgnoreRequest):
+            return None
+        changed = self.get_controller(name).on_error(time.monotonic())
+        self.update(name, request, type(exception).__name__, changed, spider)
+        return None
+
+    def update(self, name, request, outcome, changed, spider):
+        if changed:
+            self.apply(name, request.meta.get('download_slot', name))
+            if self.debug:
+                controller = self.controllers[name]
+                spider.logger.info(
+                    f'Throttle {name}: concurrency {controller.concurrency}, delay {controller.delay:.2f} s '
+                    f'after {outcome} (latency {controller.latency or 0.0:.2f} s, '
+                    f'error rate {controller.error_rate:.2f})'
+                )
+        self.write_stats(name, spider)
+
+    def apply(self, name, slot_key):
+        """Sets the values of a controller on its download slot."""
+        engine = self.crawler.engine
+        slot = engine.downloader.slots.get(slot_key) if engine is not None else None
+        if slot is None:
+            return
+        controller = self.get_controller(name)
+        slot.concurrency = controller.concurrency
+        slot.delay = controller.delay
+
+    def write_stats(self, name, spider):
+        controller = self.controllers[name]
+        stats = self.crawler.stats
+        prefix = f'airbnb/throttle/{name}'
+        stats.set_value(f'{prefix}/concurrency', controller.concurrency, spider=spider)
+        stats.set_value(f'{prefix}/delay', round(controller.delay, 3), spider=spider)
+        stats.set_value(f'{prefix}/latency', round(controller.latency or 0.0, 3), spider=spider)
+        stats.set_value(f'{prefix}/error_rate', round(controller.error_rate, 3), spider=spider)
+        stats.set_value(
+            f'{prefix}/requests_per_minute', controller.requests_per_minute(time.monotonic()), spider=spider
+        )
+        stats.set_value(f'{prefix}/increases', controller.increases, spider=spider)
+        stats.set_value(f'{prefix}/decreases', controller.decreases, spider=spider)
+
+    def spider_closed(self, spider):
+        for name in self.controllers:
+            self.write_stats(name, spider)
+
+
+def retry_after(response):
+    """Returns the seconds of a `Retry-After` header, or `None`."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # HTTP dates are not used by the API
+        return None
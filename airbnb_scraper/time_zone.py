@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from timezonefinder import TimezoneFinder
+
+_shared = None
+
+
+class TimeZoneResolver:
+    """
+    Resolves time zone names from coordinates.
+
+    Lookups are memoized in an LRU cache keyed on
+    coordinates rounded to `precision` decimal places
+    (2 places is roughly 1 km), as listings in the same
+    area nearly always share a time zone.
+    """
+
+    @classmethod
+    def shared(cls):
+        global _shared
+        if _shared is None:
+            _shared = cls()
+        return _shared
+
+    def __init__(self, precision=2, cache_size=4096):
+        self.precision = precision
+        self.cache_size = cache_size
+        self.finder = None
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def open(self):
+        # Loading the polygon data is expensive, so the
+        # finder is only created once
+        if self.finder is None:
+            self.finder = TimezoneFinder()
+
+    def time_zone_at(self, lat, lng):
+        key = (round(lat, self.precision), round(lng, self.precision))
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        self.open()
+        time_zone = self.finder.timezone_at(lng=lng, lat=lat)
+        self._cache[key] = time_zone
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return time_zone
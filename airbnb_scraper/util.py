@@ -1,4 +1,11 @@
+import hashlib
 import json
 
 def hash_str(x):
-    return abs(hash(json.dumps(x, sort_keys=True))).to_bytes(8, "big").hex()
+    """
+    Returns a stable fingerprint of a JSON serializable
+    value, which does not depend on key order or the
+    Python process.
+    """
+    data = json.dumps(x, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
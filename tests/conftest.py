@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+import pytest
+from airbnb_scraper import db
+from airbnb_scraper.db import AirbnbMemoryDB, AirbnbStorage
+
+
+@pytest.fixture
+def storage():
+    """In-memory storage shared by the items during a test."""
+    previous = db._shared
+    storage = AirbnbMemoryDB()
+    AirbnbStorage.set_shared(storage)
+    storage.open()
+    yield storage
+    storage.close()
+    AirbnbStorage.set_shared(previous)
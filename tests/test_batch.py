@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import arrow
+import pytest
+from pymongo import ASCENDING
+from airbnb_scraper.benchmark import (
+    BATCH_DAY_KEYS, BATCH_MONTH_KEYS, create_calendars, simulate_history, copy_record, group_months
+)
+from airbnb_scraper.items import AirbnbListingCalendarMonth, AirbnbCalendarDayRecord
+from airbnb_scraper.replay import replay
+
+batch = pytest.importorskip('airbnb_scraper.batch')
+
+
+def normalize(value):
+    return batch.to_micros(value) if isinstance(value, arrow.Arrow) else value
+
+
+def run_scalar(months_and_days):
+    for _, days in months_and_days:
+        for day in days:
+            day.update_inferred()
+    for month, days in months_and_days:
+        month.update_with_days(days)
+
+
+def run_batch(months_and_days):
+    day_batch = batch.DayBatch.from_months(months_and_days)
+    day_batch.update_inferred()
+    metrics = day_batch.aggregate()
+    day_batch.write_days()
+    day_batch.write_months([month for month, _ in months_and_days], metrics=metrics)
+
+
+def assert_parity(scalar, vector):
+    assert len(scalar) == len(vector)
+    for (scalar_month, scalar_days), (vector_month, vector_days) in zip(scalar, vector):
+        assert scalar_month.get_id() == vector_month.get_id()
+        for key in BATCH_MONTH_KEYS:
+            assert normalize(scalar_month.get(key)) == normalize(vector_month.get(key)), \
+                f'{scalar_month.get_id()} {key}'
+        assert len(scalar_days) == len(vector_days)
+        for scalar_day, vector_day in zip(scalar_days, vector_days):
+            for key in BATCH_DAY_KEYS:
+                assert normalize(scalar_day.get(key)) == normalize(vector_day.get(key)), \
+                    f'{scalar_day.get_id()} {key}'
+
+
+def test_parity_with_simulated_history():
+    calendars = create_calendars(listings=5, months=6)
+    histories = simulate_history(calendars, crawls=6, seed=1)
+    scalar = group_months([(tz, [copy_record(day) for day in days]) for tz, days in histories])
+    vector = group_months([(tz, [copy_record(day) for day in days]) for tz, days in histories])
+
+    run_scalar(scalar)
+    run_batch(vector)
+
+    assert_parity(scalar, vector)
+    for key in ('total_days', 'booked_days', 'blocked_days'):
+        assert sum(month[key] for month, _ in scalar) > 0, key
+
+
+def load_months_and_days(embed_days):
+    months = list(AirbnbListingCalendarMonth.find(sort=[('_id', ASCENDING)]))
+    if embed_days:
+        return [(month, month.get_embedded_days()) for month in months]
+    days_by_month = {}
+    for day in AirbnbCalendarDayRecord.find(sort=[('date', ASCENDING)]):
+        days_by_month.setdefault(day['month_id'], []).append(day)
+    return [(month, days_by_month.get(month.get_id(), [])) for month in months]
+
+
+@pytest.mark.parametrize('embed_days', [False, True])
+def test_parity_with_replayed_crawls(storage, embed_days):
+    settings = {'CALENDAR_EMBEDDED_DAYS': embed_days}
+    replay(listings=3, settings_overrides=settings, storage=storage)
+    # Crawl the calendars again two days later
+    for collection_name in ('months', 'days'):
+        for doc in storage.get_collection(collection_name).docs.values():
+            doc['update_date'] = arrow.get(doc['update_date']).shift(days=-2).datetime.replace(tzinfo=None)
+    replay(listings=3, settings_overrides=settings, storage=storage)
+
+    scalar = load_months_and_days(embed_days)
+    vector = load_months_and_days(embed_days)
+    assert bool(scalar)
+
+    run_scalar(scalar)
+    run_batch(vector)
+
+    assert_parity(scalar, vector)
+    assert sum(month['total_days'] for month, _ in scalar) > 0
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import arrow
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from airbnb_scraper.items import AirbnbListing
+from airbnb_scraper.pipelines import AirbnbMongoBulkPipeline
+
+
+class BulkSpider(Spider):
+    name = 'bulk'
+
+
+def create_listing(listing_id):
+    listing = AirbnbListing.create(listing_id=listing_id)
+    listing.update_id()
+    return listing
+
+
+def test_failed_item_does_not_lose_buffer(storage):
+    AirbnbListing.save_many([create_listing('1')])
+    invalid = AirbnbListing.load(AirbnbListing.create_id(listing_id='1'))
+    # Immutable keys cannot change
+    invalid['creation_date'] = arrow.get().shift(days=-1)
+
+    crawler = get_crawler(BulkSpider)
+    spider = BulkSpider.from_crawler(crawler)
+    stats = crawler.stats
+    pipeline = AirbnbMongoBulkPipeline(client=storage, bulk_size=10, bulk_interval=0, stats=stats)
+    pipeline.open_spider(spider)
+    for item in [create_listing('2'), invalid, create_listing('3')]:
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    assert set(storage.get_collection('listings').docs) == {
+        AirbnbListing.create_id(listing_id=x) for x in ('1', '2', '3')
+    }
+    assert stats.get_value('airbnb/mongo/bulk_items_written', spider=spider) == 2
+    assert stats.get_value('airbnb/mongo/bulk_items_failed', spider=spider) == 1
+    assert stats.get_value('airbnb/mongo/bulk_write_errors', spider=spider) == 1
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from airbnb_scraper.commands.embed_days import Command
+from airbnb_scraper.items import AirbnbListingCalendarMonth
+from airbnb_scraper.replay import replay
+
+
+def test_embed_days_queries_days_per_page(storage, monkeypatch):
+    replay(listings=3, storage=storage)
+    months = list(AirbnbListingCalendarMonth.find())
+    day_count = len(storage.get_collection('days').docs)
+
+    finds = []
+    storage.observe(lambda operation, collection_name, seconds: finds.append(collection_name)
+                    if operation == 'find' else None)
+    monkeypatch.setattr('airbnb_scraper.commands.embed_days.BATCH_SIZE', 4)
+    months_count, days_count = Command().embed_days()
+    storage.observe(None)
+
+    assert months_count == len(months)
+    assert days_count == day_count
+    # One query for the months, and one for the days of each page
+    assert finds.count('days') == (len(months) + 3) // 4
+    assert sum(len(month.get_embedded_days()) for month in AirbnbListingCalendarMonth.find()) == day_count
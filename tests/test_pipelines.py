@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from airbnb_scraper.db import AirbnbMemoryDB, AirbnbStorage
+from airbnb_scraper.pipelines import AirbnbMongoPipeline
+
+
+class PipelineSpider(Spider):
+    name = 'pipeline'
+
+
+def test_pipeline_shares_storage_of_crawler_settings(storage):
+    crawler = get_crawler(PipelineSpider, {
+        'STORAGE_CLASS': 'airbnb_scraper.db.AirbnbMemoryDB',
+        'MONGO_DATABASE': 'pipelines',
+    })
+    pipeline = AirbnbMongoPipeline.from_crawler(crawler)
+    assert isinstance(pipeline.client, AirbnbMemoryDB)
+    assert pipeline.client is not storage
+    assert pipeline.client.mongo_db == 'pipelines'
+    assert pipeline.client is AirbnbStorage.shared()
+
+
+def test_pipeline_reuses_matching_shared_storage(storage):
+    crawler = get_crawler(PipelineSpider, {
+        'STORAGE_CLASS': 'airbnb_scraper.db.AirbnbMemoryDB',
+        'MONGO_URI': storage.mongo_uri,
+        'MONGO_DATABASE': storage.mongo_db,
+    })
+    pipeline = AirbnbMongoPipeline.from_crawler(crawler)
+    assert pipeline.client is storage
+    assert AirbnbStorage.shared() is storage
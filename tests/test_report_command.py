@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from scrapy.cmdline import ScrapyArgumentParser
+from scrapy.settings import Settings
+from airbnb_scraper import analytics
+from airbnb_scraper.commands.report import Command, REPORT_COLUMNS
+
+
+def create_command(settings=None):
+    command = Command()
+    command.settings = Settings(dict(settings or {}))
+    return command
+
+
+def parse_options(command, argv):
+    # Same parser as `scrapy.cmdline.execute()`
+    parser = ScrapyArgumentParser(conflict_handler='resolve')
+    command.add_options(parser)
+    opts, args = parser.parse_known_args(args=argv)
+    command.process_options(args, opts)
+    return opts, args
+
+
+def test_parse_options():
+    command = create_command()
+    opts, args = parse_options(command, [
+        '-c', 'Auckland', '--start', '2020-01', '--end', '2021-01', '-g', 'room_type_category', '-r',
+        '-s', 'MONGO_DATABASE=reports',
+    ])
+    assert args == []
+    assert opts.city == 'Auckland'
+    assert opts.start == '2020-01'
+    assert opts.end == '2021-01'
+    assert opts.group_by == 'room_type_category'
+    assert opts.refresh
+    # `-s` is still the global `--set` option
+    assert opts.set == ['MONGO_DATABASE=reports']
+    assert command.settings.get('MONGO_DATABASE') == 'reports'
+
+
+def test_parse_default_options():
+    opts, args = parse_options(create_command(), [])
+    assert opts.city is None
+    assert opts.start is None
+    assert opts.end is None
+    assert opts.group_by == ','.join(analytics.DEFAULT_GROUP_KEYS)
+    assert not opts.refresh
+
+
+def test_run_empty_storage(storage, capsys):
+    command = create_command({'STORAGE_CLASS': 'airbnb_scraper.db.AirbnbMemoryDB'})
+    opts, args = parse_options(command, ['--start', '2020-01', '-g', 'room_type_category'])
+    command.run(args, opts)
+    output = capsys.readouterr().out
+    assert output.splitlines() == ['\t'.join(['room_type_category'] + REPORT_COLUMNS)]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from airbnb_scraper.items import AirbnbExploreTiling
+from airbnb_scraper.spiders.airbnb import AirbnbSpider
+
+TILE = (38.7, -9.2, 38.8, -9.1)
+
+
+def close_spider(spider, storage):
+    # The storage is opened by `start_requests()`
+    storage.open()
+    spider.closed('finished')
+
+
+def test_tiles_without_query_are_not_saved(storage):
+    spider = AirbnbSpider(tiles='true', bounds=','.join(str(x) for x in TILE))
+    assert spider.load_tiles() == [TILE]
+    spider.tile_leaves = {TILE}
+    close_spider(spider, storage)
+    assert len(storage.get_collection(AirbnbExploreTiling._collection_name).docs) == 0
+
+
+def test_tiles_of_bounds_are_not_saved(storage):
+    spider = AirbnbSpider(city='Lisbon', tiles='true', bounds=','.join(str(x) for x in TILE))
+    spider.load_tiles()
+    close_spider(spider, storage)
+    assert AirbnbExploreTiling.load(AirbnbExploreTiling.create_id(query='Lisbon')) is None
+
+
+def test_tiles_of_city_are_saved(storage):
+    spider = AirbnbSpider(city='Lisbon', tiles='true')
+    assert spider.load_tiles() == []
+    spider.tile_leaves = {TILE}
+    close_spider(spider, storage)
+
+    spider = AirbnbSpider(city='Lisbon', tiles='true')
+    assert spider.load_tiles() == [TILE]
+
+
+def test_tiles_without_query_or_bounds_are_not_loaded(storage):
+    spider = AirbnbSpider(tiles='true')
+    assert spider.load_tiles() == []
+
+
+def test_split_price_band():
+    spider = AirbnbSpider(city='Lisbon', price_shards='4')
+    assert spider.split_price_band((10, 20)) == [(10, 15), (16, 20)]
+    assert spider.split_price_band((10, 10)) == []
+    bands = spider.create_price_bands()
+    assert bands[-1] == (1001, None)
+    assert spider.split_price_band(bands[-1]) == [(1001, 2002), (2003, None)]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from airbnb_scraper.throttle import AimdController
+
+
+def ramp_up(controller, latency, responses=200):
+    now = 0.0
+    for _ in range(responses):
+        now += 0.1
+        controller.on_success(now, latency=latency)
+    return controller
+
+
+def test_concurrency_is_not_raised_beyond_delay():
+    controller = ramp_up(AimdController(start_delay=1.0, min_delay=0.5, max_concurrency=8), latency=1.0)
+    assert controller.delay == 0.5
+    # Two requests in flight already send one per delay
+    assert controller.concurrency == 2
+
+
+def test_concurrency_is_raised_without_delay():
+    controller = ramp_up(AimdController(start_delay=1.0, min_delay=0.0, max_concurrency=8), latency=1.0)
+    assert controller.delay == 0.0
+    assert controller.concurrency == 8
+
+
+def test_backoff_from_zero_delay():
+    controller = AimdController(start_delay=0.0, min_delay=0.0, delay_step=0.5)
+    controller.on_backoff(1.0)
+    assert controller.concurrency == 1
+    assert controller.delay == 0.5
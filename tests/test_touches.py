@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import arrow
+import pytest
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from airbnb_scraper.replay import replay
+from airbnb_scraper.spiders.airbnb import AirbnbSpider
+
+PIPELINES = [
+    ('airbnb_scraper.pipelines.AirbnbMongoPipeline', False),
+    ('airbnb_scraper.pipelines.AirbnbMongoBulkPipeline', False),
+    ('airbnb_scraper.pipelines.AirbnbMongoBulkPipeline', True),
+]
+
+
+@pytest.mark.parametrize('pipeline, coalesce_touches', PIPELINES)
+def test_unchanged_items_are_touched(storage, pipeline, coalesce_touches):
+    settings = {'MONGO_COALESCE_TOUCHES': coalesce_touches}
+    replay(listings=3, pipeline=pipeline, settings_overrides=settings, storage=storage)
+    # Make the calendars stale, so that they are crawled again
+    old_date = arrow.get().shift(days=-2).datetime.replace(tzinfo=None)
+    for collection_name in ('listings', 'months', 'days'):
+        for doc in storage.get_collection(collection_name).docs.values():
+            doc['update_date'] = old_date
+
+    report = replay(listings=3, pipeline=pipeline, settings_overrides=settings, storage=storage)
+    assert report['items']['touch'] > 0
+    for collection_name in ('listings', 'days'):
+        docs = list(storage.get_collection(collection_name).docs.values())
+        assert bool(docs)
+        assert all(doc['update_date'] > old_date for doc in docs)
+
+
+
+@pytest.mark.parametrize('settings, skip_unchanged', [
+    ({}, True),
+    ({'SKIP_UNCHANGED_ITEMS': False}, False),
+    ({'FEEDS': {'out.jl': {'format': 'jsonlines'}}}, False),
+    ({'ITEM_PIPELINES': {
+        'airbnb_scraper.pipelines.AirbnbMongoBulkPipeline': 100,
+        'airbnb_scraper.pipelines.AirbnbExportPipeline': 400,
+    }}, False),
+])
+def test_touches_only_with_storage_pipelines(settings, skip_unchanged):
+    project_settings = Settings()
+    project_settings.setmodule('airbnb_scraper.settings')
+    project_settings.setdict(settings, priority='cmdline')
+    spider = AirbnbSpider.from_crawler(get_crawler(AirbnbSpider, project_settings.copy_to_dict()), city='Lisbon')
+    assert spider.skip_unchanged == skip_unchanged